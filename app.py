@@ -27,7 +27,6 @@ import os
 import io
 from zipfile import ZipFile
 import urllib.parse
-from scipy import integrate
 import pandas as pd
 import uuid
 import numpy as np
@@ -37,7 +36,7 @@ from collections import defaultdict
 import uuid
 import base64
 import redis
-from time import sleep
+import celery
 import requests
 from datetime import datetime
 
@@ -54,10 +53,17 @@ import utils
 import download
 import ms2
 import lcms_map
+import lcms_store
+import lcms_tiles
+import ion_index
+import shared_cache
+import utils_generation
+import utils_wait
 import tasks
 import tasks_conversion
 from formula_utils import get_adduct_mass
 import xic
+import integration
 from sync import _sychronize_save_state, _sychronize_load_state
 import shorturl
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -116,6 +122,11 @@ else:
 
 server = app.server
 
+# Server threads are reused, a callback only ever sees the generation it started itself
+@server.before_request
+def _clear_request_generation():
+    utils_generation.clear_generation()
+
 app.index_string = """<!DOCTYPE html>
 <html>
     <head>
@@ -552,6 +563,8 @@ DATASELECTION_CARD = [
                                             {'label': 'MS1 Sum', 'value': 'MS1SUM'},
                                             {'label': 'AUC', 'value': 'AUC'},
                                             {'label': 'MAXPEAKHEIGHT', 'value': 'MAXPEAKHEIGHT'},
+                                            {'label': 'MS1 Sum - Peak', 'value': 'PEAKMS1SUM'},
+                                            {'label': 'AUC - Peak', 'value': 'PEAKAUC'},
                                         ],
                                         searchable=False,
                                         clearable=False,
@@ -1154,6 +1167,11 @@ MIDDLE_DASHBOARD = [
         [
             html.Br(),
             html.Div(id='map_plot_zoom', style={'display': 'none'}),
+            html.Div(id='map_plot_viewport', style={'display': 'none'}),
+            html.Div(id='map_plot_view', style={'display': 'none'}),
+            html.Div(id='map_plot_shown', style={'display': 'none'}),
+            dcc.Store(id='map_plot_coarse'),
+            dcc.Store(id='map_plot_refined'),
             html.Div(id='highlight_box', style={'display': 'none'}),
             dcc.Graph(
                 id='map-plot',
@@ -1209,6 +1227,7 @@ SECOND_DATAEXPLORATION_DASHBOARD = [
 BODY = dbc.Container(
     [
         dcc.Location(id='url', refresh=False),        
+        dcc.Store(id='client_session', storage_type='session'), # Random id of this browser tab, so newer requests can supersede older ones
         html.Div(
             [
                 dcc.Link(id="query_link", href="#", target="_blank"),
@@ -1409,19 +1428,23 @@ def _resolve_usi(usi, temp_folder="temp"):
 
     if download._resolve_exists_local(usi):
         # We can do it in line because we know that it won't actually do the call
-        return download._resolve_usi(usi)
+        remote_link, local_filename = download._resolve_usi(usi)
+
+        # Caches written with an older schema are rebuilt in the background, until then we read the file itself
+        if (lcms_store.store_outdated(local_filename) or lcms_tiles.tiles_outdated(local_filename)) and _is_worker_up():
+            try:
+                tasks_conversion._convert_file_feather.delay(usi, temp_folder=temp_folder)
+            except:
+                pass
+
+        return remote_link, local_filename
     else:
         if _is_worker_up():
             # If we have the celery instance up, we'll push it
             result = tasks_conversion._download_convert_file.delay(usi, temp_folder=temp_folder)
 
-            # Waiting
-            while(1):
-                if result.ready():
-                    break
-                sleep(1)
-            result = result.get()
-            return result
+            # Other views of the same file are waiting on this download too, so it is never cancelled
+            return _wait_for_tasks([{"result": result}], "download", cancellable=False)[0]
         else:
             # If we have the celery instance is not up, we'll do it local
             print("Downloading Local")
@@ -1840,6 +1863,7 @@ def draw_fastsearch_massivekb(usi, usi_select, ms2_identifier):
 
                 Output("comment", "value"),
 
+                Output("map_plot_render_mode", "value"),
                 Output("map_plot_color_scale", "value"),
                 Output("map_plot_quantization_level", "value"),
 
@@ -1900,6 +1924,7 @@ def draw_fastsearch_massivekb(usi, usi_select, ms2_identifier):
 
                   State("comment", 'value'),
 
+                  State('map_plot_render_mode', 'value'),
                   State('map_plot_color_scale', 'value'),
                   State('map_plot_quantization_level', 'value'),
 
@@ -1963,6 +1988,7 @@ def determine_url_only_parameters(  search,
 
                                     existing_comment,
                                     
+                                    existing_map_plot_render_mode,
                                     existing_map_plot_color_scale,
                                     existing_map_plot_quantization_level,
                                     
@@ -1971,7 +1997,7 @@ def determine_url_only_parameters(  search,
 
     # Here we clicked a button
     if "darkmode_button" in triggered_id:
-        output = [dash.no_update] * 36
+        output = [dash.no_update] * 37
         output[-1] = "plotly_dark"
         output[-3] = "Turbo"
         return output
@@ -2055,6 +2081,7 @@ def determine_url_only_parameters(  search,
     comment = _get_param_from_url(search, "", "comment", dash.no_update, session_dict=session_dict, old_value=existing_comment, no_change_default=dash.no_update)
 
     # Advanced Visualization Options
+    map_plot_render_mode = _get_param_from_url(search, "", "map_plot_render_mode", dash.no_update, session_dict=session_dict, old_value=existing_map_plot_render_mode, no_change_default=dash.no_update)
     map_plot_color_scale = _get_param_from_url(search, "", "map_plot_color_scale", dash.no_update, session_dict=session_dict, old_value=existing_map_plot_color_scale, no_change_default=dash.no_update)
     map_plot_quantization_level = _get_param_from_url(search, "", "map_plot_quantization_level", dash.no_update, session_dict=session_dict, old_value=existing_map_plot_quantization_level, no_change_default=dash.no_update)
 
@@ -2120,6 +2147,7 @@ def determine_url_only_parameters(  search,
             sychronization_session_id,
             chromatogram_options, 
             comment,
+            map_plot_render_mode,
             map_plot_color_scale,
             map_plot_quantization_level,
             plot_theme]
@@ -2449,6 +2477,103 @@ def determine_xic_target(search, clickData, sychronization_load_session_button_c
     return [xic_mz, xic_rt_window]
 
 
+def _cancel_tasks(pending_tasks):
+    for pending_task in pending_tasks:
+        utils_generation.cancel_task(pending_task["result"], task=pending_task.get("task", None), args=pending_task.get("args", None), kwargs=pending_task.get("kwargs", None))
+
+def _abandon_if_stale(pending_tasks=None):
+    """
+    Stops a callback whose request has been superseded, the pending tasks are revoked so they don't take worker slots
+
+    Args:
+        pending_tasks (list, optional): dicts with the result, and the task with its args and kwargs for QueueOnce tasks. Defaults to None.
+    """
+
+    if pending_tasks is None:
+        pending_tasks = []
+
+    if not utils_generation.is_stale():
+        return
+
+    print("ABANDONING STALE REQUEST", utils_generation.current_generation(), file=sys.stderr, flush=True)
+
+    _cancel_tasks(pending_tasks)
+
+    # Nothing is memoized and the browser keeps whatever the newer request draws
+    raise dash.exceptions.PreventUpdate
+
+def _iterate_tasks(pending_tasks, task_name, cancellable=True, propagate=True):
+    """
+    Waits on celery tasks, yielding each result as soon as it lands, all of them share the deadline for task_name
+
+    Args:
+        pending_tasks (list): dicts with the result, and the task with its args and kwargs for QueueOnce tasks
+        task_name (str): kind of task, see utils_wait.TASK_WAIT_TIMEOUT_SECONDS
+        cancellable (bool, optional): whether we revoke the tasks when the request is superseded or times out, shared work like downloads is left running. Defaults to True.
+        propagate (bool, optional): re-raise the error of a failed task, otherwise it is yielded as its result. Defaults to True.
+
+    Raises:
+        TimeoutError: the tasks didn't finish in time
+
+    Yields:
+        tuple: position of the task in pending_tasks, and its result
+    """
+
+    finished_positions = set()
+    def _unfinished_tasks():
+        return [pending_task for position, pending_task in enumerate(pending_tasks) if position not in finished_positions]
+
+    on_check = None
+    if cancellable:
+        on_check = lambda: _abandon_if_stale(_unfinished_tasks())
+
+    try:
+        for position, result in utils_wait.iterate_results([pending_task["result"] for pending_task in pending_tasks], redis_client, task_name, on_check=on_check, propagate=propagate):
+            finished_positions.add(position)
+            yield position, result
+    except TimeoutError:
+        if cancellable:
+            _cancel_tasks(_unfinished_tasks())
+        raise
+
+def _wait_for_tasks(pending_tasks, task_name, cancellable=True):
+    """
+    Waits on celery tasks, see _iterate_tasks
+
+    Returns:
+        list: results in the same order as the tasks
+    """
+
+    all_results = [None] * len(pending_tasks)
+    for position, result in _iterate_tasks(pending_tasks, task_name, cancellable=cancellable):
+        all_results[position] = result
+
+    return all_results
+
+def _get_lcms_aggregation(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", map_viewport=None):
+    # Views the tiles cover are summed right here from the tile arrays, which all the server processes share
+    try:
+        tiles_result = lcms_map._aggregate_lcms_map_grid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, tiles_only=True, array_loader=shared_cache.load_npy_arrays)
+        if tiles_result is not None:
+            return tiles_result
+    except:
+        print("SHARED TILES FAILED", file=sys.stderr, flush=True)
+
+    _abandon_if_stale()
+
+    # The raw peaks are only read on the compute queue
+    if _is_worker_up():
+        result = tasks.task_lcms_aggregate.delay(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, generation=utils_generation.current_generation())
+        payload = _wait_for_tasks([{"result": result}], "lcms_aggregate")[0]
+    else:
+        payload = tasks.task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, cache=False, map_viewport=map_viewport)
+
+    # The worker skipped it, a newer view was already requested
+    if payload is None:
+        raise dash.exceptions.PreventUpdate
+
+    return lcms_map._decode_aggregation(payload)
+
 @cache.memoize()
 def _create_map_fig(filename, 
                     map_selection=None, 
@@ -2459,26 +2584,18 @@ def _create_map_fig(filename,
                     map_plot_color_scale="Hot_r", 
                     template="plotly_light",
                     ms2marker_color="blue",
-                    ms2marker_size=5):
+                    ms2marker_size=5,
+                    map_plot_render_mode="Heatmap",
+                    map_viewport=None,
+                    store_state=None):
+    # store_state is only part of the cache key, so that maps drawn from a partially written store are redrawn as it fills in
 
     min_rt, max_rt, min_mz, max_mz = utils._determine_rendering_bounds(map_selection)
 
     import time
     start = time.time()
 
-    if _is_worker_up():
-        result = tasks.task_lcms_aggregate.delay(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level)
-
-        # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(0.1)
-        agg_dict, msn_results = result.get()
-        msn_results = pd.DataFrame(msn_results) # This comes as a list, due to serialization
-    else:
-        agg_dict, msn_results = tasks.task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, cache=False)
-        msn_results = pd.DataFrame(msn_results) # This comes as a list, due to serialization
+    agg_dict, msn_results = _get_lcms_aggregation(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport)
 
     print("GETTING LCMS AGG", time.time() - start, file=sys.stderr, flush=True)
 
@@ -2491,7 +2608,8 @@ def _create_map_fig(filename,
                                             color_scale=map_plot_color_scale, 
                                             template=template,
                                             ms2marker_color=ms2marker_color,
-                                            ms2marker_size=int(ms2marker_size))
+                                            ms2marker_size=int(ms2marker_size),
+                                            render_mode=map_plot_render_mode)
 
     print("DRAWING LCMS MAP", time.time() - start, file=sys.stderr, flush=True)
     return lcms_fig
@@ -2518,14 +2636,9 @@ def _perform_feature_finding(filename, feature_finding=None):
     # Checking if local or worker
     if _is_worker_up():
         # If we have the celery instance up, we'll push it
-        result = tasks.task_featurefinding.delay(filename, json.dumps(feature_finding))
-
-        # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(1)
-        features_list = result.get()
+        task_args = (filename, json.dumps(feature_finding))
+        result = tasks.task_featurefinding.delay(*task_args)
+        features_list = _wait_for_tasks([{"result": result, "task": tasks.task_featurefinding, "args": task_args, "kwargs": {}}], "featurefinding")[0]
     else:
         features_list = tasks.task_featurefinding(filename, json.dumps(feature_finding))
 
@@ -2693,8 +2806,13 @@ def _integrate_overlay(overlay_usi, lcms_fig, overlay_mz, overlay_rt, overlay_fi
                 Input("tic_option", "value"),
                 Input("polarity_filtering", "value"),
                 Input("show_multiple_tic", "value")
+              ],
+              [
+                State('client_session', 'data'),
               ])
-def draw_tic(usi, usi_select, export_format, plot_theme, tic_option, polarity_filter, show_multiple_tic):
+def draw_tic(usi, usi_select, export_format, plot_theme, tic_option, polarity_filter, show_multiple_tic, client_session):
+    utils_generation.begin_generation(redis_client, client_session, "tic")
+
     # Calculating all TICs for all USIs
     all_usi = usi.split("\n")
 
@@ -2707,20 +2825,8 @@ def draw_tic(usi, usi_select, export_format, plot_theme, tic_option, polarity_fi
         RENDER_MODE = "svg"
 
     if len(all_usi) > 1 and show_multiple_tic is True:
-        all_usi_tic_df = []
-
-        for current_usi in all_usi:
-            if len(current_usi) < 2:
-                continue
-
-            try:
-                tic_df = _perform_tic(current_usi, tic_option=tic_option, polarity_filter=polarity_filter)
-                tic_df["USI"] = download._get_usi_display_filename(current_usi)
-                all_usi_tic_df.append(tic_df)
-            except:
-                pass
-
-        merged_tic_df = pd.concat(all_usi_tic_df)
+        merged_tic_df = _perform_batch_tic(all_usi, tic_option=tic_option, polarity_filter=polarity_filter)
+        merged_tic_df["USI"] = merged_tic_df["USI"].apply(lambda x: download._get_usi_display_filename(x))
         try:
             fig = px.line(merged_tic_df, x="rt", y="tic", title='TIC Plot', template=plot_theme, color="USI", render_mode=RENDER_MODE)
             status = html.H6([dbc.Badge("Ready", color="success", className="ml-1")])
@@ -2765,8 +2871,13 @@ def draw_tic(usi, usi_select, export_format, plot_theme, tic_option, polarity_fi
                   Input("tic_option", "value"),
                   Input("polarity_filtering2", "value"),
                   Input("show_multiple_tic", "value")
+              ],
+              [
+                  State('client_session', 'data'),
               ])
-def draw_tic2(usi, export_format, plot_theme, tic_option, polarity_filter, show_multiple_tic):
+def draw_tic2(usi, export_format, plot_theme, tic_option, polarity_filter, show_multiple_tic, client_session):
+    utils_generation.begin_generation(redis_client, client_session, "tic2")
+
     # Calculating all TICs for all USIs
     all_usi = usi.split("\n")
     all_usi = [x for x in all_usi if len(x) > 2]
@@ -2780,22 +2891,14 @@ def draw_tic2(usi, export_format, plot_theme, tic_option, polarity_filter, show_
         RENDER_MODE = "svg"
 
     if len(all_usi) > 1 and show_multiple_tic is True:
-        all_usi_tic_df = []
-
-        for current_usi in all_usi:
-            if len(current_usi) < 2:
-                continue
-
-            try:
-                tic_df = _perform_tic(current_usi, tic_option=tic_option, polarity_filter=polarity_filter)
-                tic_df["USI"] = download._get_usi_display_filename(current_usi)
-                all_usi_tic_df.append(tic_df)
-            except:
-                pass
-
-        merged_tic_df = pd.concat(all_usi_tic_df)
-        fig = px.line(merged_tic_df, x="rt", y="tic", title='TIC Plot', template=plot_theme, color="USI", render_mode=RENDER_MODE)
-        status = html.H6([dbc.Badge("Ready", color="success", className="ml-1")])
+        merged_tic_df = _perform_batch_tic(all_usi, tic_option=tic_option, polarity_filter=polarity_filter)
+        merged_tic_df["USI"] = merged_tic_df["USI"].apply(lambda x: download._get_usi_display_filename(x))
+        try:
+            fig = px.line(merged_tic_df, x="rt", y="tic", title='TIC Plot', template=plot_theme, color="USI", render_mode=RENDER_MODE)
+            status = html.H6([dbc.Badge("Ready", color="success", className="ml-1")])
+        except:
+            fig = dash.no_update
+            status = html.H6([dbc.Badge("Draw Error", color="warning", className="ml-1")])
     elif len(all_usi) > 0:
         tic_df = _perform_tic(usi.split("\n")[0], tic_option=tic_option, polarity_filter=polarity_filter)
         fig = px.line(tic_df, x="rt", y="tic", title='TIC Plot', template=plot_theme, render_mode=RENDER_MODE)
@@ -2817,118 +2920,282 @@ def draw_tic2(usi, export_format, plot_theme, tic_option, polarity_filter, show_
 def _perform_tic(usi, tic_option="TIC", polarity_filter="None"):
     remote_link, local_filename = _resolve_usi(usi)
 
+    _abandon_if_stale()
+
     if _is_worker_up():
         result = tasks.task_tic.delay(local_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+        pending_task = {"result": result, "task": tasks.task_tic, "args": (local_filename,), "kwargs": {"tic_option": tic_option, "polarity_filter": polarity_filter}}
 
-        # Waiting
-        while(1):
-            if result.ready():
-                break
-            sleep(1)
-        result = result.get()
+        result = _wait_for_tasks([pending_task], "tic")[0]
         return pd.DataFrame(result)
     else:
         return pd.DataFrame(tasks.task_tic(local_filename, tic_option=tic_option, polarity_filter=polarity_filter))
 
 
+def _resolve_usi_list(usi_list, temp_folder="temp"):
+    """
+    Resolves many USIs at once, the files that still need downloading are fetched side by side
+
+    Args:
+        usi_list (list): USIs to resolve
+        temp_folder (str, optional): Defaults to "temp".
+
+    Returns:
+        list: local filename of each USI, None for the ones that couldn't be resolved
+    """
+
+    # A USI listed twice is downloaded once, a second delay would block on the QueueOnce lock of the first
+    unique_usi_list = list(dict.fromkeys(usi_list))
+
+    usi_filenames = {}
+    pending_tasks = []
+    download_usi_list = []
+
+    for usi in unique_usi_list:
+        if _is_worker_up() and not download._resolve_exists_local(usi):
+            try:
+                pending_task = {}
+                pending_task["result"] = tasks_conversion._download_convert_file.delay(usi, temp_folder=temp_folder)
+                pending_tasks.append(pending_task)
+                download_usi_list.append(usi)
+            except:
+                print("DOWNLOAD NOT QUEUED", usi, file=sys.stderr, flush=True)
+            continue
+
+        try:
+            remote_link, local_filename = _resolve_usi(usi, temp_folder=temp_folder)
+            usi_filenames[usi] = local_filename
+        except:
+            pass
+
+    # Other views of the same files are waiting on these downloads too, so they are never cancelled
+    try:
+        for task_position, result in _iterate_tasks(pending_tasks, "download", cancellable=False, propagate=False):
+            if isinstance(result, Exception):
+                continue
+
+            remote_link, local_filename = result
+            usi_filenames[download_usi_list[task_position]] = local_filename
+    except TimeoutError:
+        # The downloads that finished are plotted, the rest are picked up by the next request
+        pass
+
+    return [usi_filenames.get(usi) for usi in usi_list]
+
+def _get_tic_cache_key(local_filename, tic_option, polarity_filter):
+    return "tic_file:{}:{}:{}".format(local_filename, tic_option, polarity_filter)
+
+def _perform_batch_tic(usi_list, tic_option="TIC", polarity_filter="None"):
+    """
+    TICs of many files in long format, all the files are computed side by side so it takes about as long as the slowest one
+
+    Each file is cached on its own, so a file that failed or didn't finish in time is tried again on the next request.
+
+    Args:
+        usi_list (list): USIs to plot, short entries are skipped
+        tic_option (str, optional): "TIC" or "BPI". Defaults to "TIC".
+        polarity_filter (str, optional): Defaults to "None".
+
+    Returns:
+        pd.DataFrame: tic, rt and USI columns, in the order of usi_list, only for the files that finished
+    """
+
+    usi_list = [usi for usi in usi_list if len(usi) >= 2]
+    local_filename_list = _resolve_usi_list(usi_list)
+
+    _abandon_if_stale()
+
+    # The same file listed twice is only computed once
+    unique_filenames = list(dict.fromkeys([local_filename for local_filename in local_filename_list if local_filename is not None]))
+
+    tic_results = {}
+    for local_filename in unique_filenames:
+        tic_result = cache.get(_get_tic_cache_key(local_filename, tic_option, polarity_filter))
+        if tic_result is not None:
+            tic_results[local_filename] = tic_result
+
+    missing_filenames = [local_filename for local_filename in unique_filenames if local_filename not in tic_results]
+
+    if _is_worker_up() and len(missing_filenames) > 0:
+        pending_tasks = []
+        try:
+            # Sent as a single group, every task gets a worker as soon as one is free
+            group_result = celery.group([tasks.task_tic.signature((local_filename,), {"tic_option": tic_option, "polarity_filter": polarity_filter}) for local_filename in missing_filenames]).apply_async()
+
+            for local_filename, result in zip(missing_filenames, group_result.results):
+                pending_task = {"result": result, "task": tasks.task_tic, "args": (local_filename,), "kwargs": {"tic_option": tic_option, "polarity_filter": polarity_filter}}
+                pending_tasks.append(pending_task)
+        except:
+            print("TIC TASKS NOT QUEUED", file=sys.stderr, flush=True)
+
+        # A file that fails or runs out of time is left out of the plot
+        try:
+            for task_position, result in _iterate_tasks(pending_tasks, "tic", propagate=False):
+                if isinstance(result, Exception):
+                    continue
+
+                tic_results[missing_filenames[task_position]] = result
+                cache.set(_get_tic_cache_key(missing_filenames[task_position], tic_option, polarity_filter), result)
+        except TimeoutError:
+            pass
+    else:
+        for local_filename in missing_filenames:
+            _abandon_if_stale()
+
+            try:
+                tic_results[local_filename] = tasks.task_tic(local_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+                cache.set(_get_tic_cache_key(local_filename, tic_option, polarity_filter), tic_results[local_filename])
+            except:
+                pass
+
+    all_usi_tic_df = []
+    for usi, local_filename in zip(usi_list, local_filename_list):
+        if local_filename not in tic_results:
+            continue
+
+        tic_df = pd.DataFrame(tic_results[local_filename])
+        tic_df["USI"] = usi
+        all_usi_tic_df.append(tic_df)
+
+    if len(all_usi_tic_df) == 0:
+        return pd.DataFrame(columns=["tic", "rt", "USI"])
+
+    return pd.concat(all_usi_tic_df)
+
 @cache.memoize()
 def _perform_xic(usi, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
     # This is the business end of XIC extraction
     remote_link, local_filename = _resolve_usi(usi)
 
     # If we are able, we will split up the query, one per file
-    return xic.xic_file(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+    return xic.xic_file_cached(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+
+def _perform_xic_shared(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
+    # The ion index arrays are shared by all the server processes, so this is a few binary searches on pages already in memory
+    xic_df, ms2_data = xic._xic_file_ion_index(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, array_loader=shared_cache.load_npy_arrays)
+
+    if get_ms2 is True:
+        ms2_data = xic._xic_ms2_scan_index(local_filename, xic_df, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+
+    return xic_df, ms2_data
+
+def _format_xic_long(xic_df, usi_element, usi1_list):
+    # Formatting for Plotting
+    target_names = list(xic_df.columns)
+    target_names.remove("rt")
+    df_long = pd.melt(xic_df, id_vars="rt", value_vars=target_names)
+    df_long["USI"] = usi_element
+
+    if usi_element in usi1_list:
+        df_long["GROUP"] = "TOP"
+    else:
+        df_long["GROUP"] = "BOTTOM"
+
+    return df_long
+
+def _normalize_xic_long(merged_df_long):
+    # Every trace of every file is scaled to its own maximum
+    try:
+        trace_max = merged_df_long.groupby(["USI", "variable"])["value"].transform("max")
+        merged_df_long["value"] = merged_df_long["value"] / trace_max
+    except:
+        pass
+
+    return merged_df_long
 
 @cache.memoize()
-def _perform_batch_xic(usi_list, usi1_list, usi2_list, xic_norm, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, 
-                       rt_min, rt_max, polarity_filter,
-                       extras_metadata_text, extras_metadata_column):
+def _gather_batch_xic(usi_list, usi1_list, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
     GET_MS2 = False
     ms2_data = {}
 
-    xic_df_list = []
+    if len(usi_list) == 1 and len(all_xic_values) == 1:
+        GET_MS2 = True
+
+    # Long format per file, in the order of usi_list however the files finish
+    df_long_list = [None] * len(usi_list)
     
     if _is_worker_up():
         result_list = []
+        task_positions = {}
+        shared_results = {}
 
-        for usi_element in usi_list:
-            if len(usi_list) == 1 and len(all_xic_values) == 1:
-                GET_MS2 = True
+        for position, usi_element in enumerate(usi_list):
+            _abandon_if_stale()
 
             # Doing it async with tasks
             remote_link, local_filename = _resolve_usi(usi_element)
 
-            for xic_value in all_xic_values:
-                result = tasks.task_xic.delay(local_filename, json.dumps([xic_value]), xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=GET_MS2)
-                result_dict = {}
+            # Files with an ion index don't need a worker
+            if ion_index.ion_index_exists(local_filename):
+                try:
+                    if local_filename not in shared_results:
+                        shared_results[local_filename] = _perform_xic_shared(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=GET_MS2)
+
+                    xic_df, ms2_data = shared_results[local_filename]
+                    df_long_list[position] = _format_xic_long(xic_df, usi_element, usi1_list)
+                    continue
+                except:
+                    print("SHARED XIC FAILED", local_filename, file=sys.stderr, flush=True)
+
+            # One task per file, extracting all the targets in a single pass
+            task_args = (local_filename, json.dumps(all_xic_values), xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+            task_kwargs = {"get_ms2": GET_MS2}
+
+            # The same file listed twice is only extracted once
+            if task_args in task_positions:
+                result_list[task_positions[task_args]]["usi_positions"].append(position)
+                continue
+            task_positions[task_args] = len(result_list)
+
+            result_dict = {}
+            result_dict["task"] = tasks.task_xic
+            result_dict["args"] = task_args
+            result_dict["kwargs"] = task_kwargs
+            result_dict["usi_positions"] = [position]
+            result_list.append(result_dict)
+
+        # Sent as a single group, every task gets a worker as soon as one is free
+        if len(result_list) > 0:
+            group_result = celery.group([tasks.task_xic.signature(result_dict["args"], result_dict["kwargs"]) for result_dict in result_list]).apply_async()
+            for result_dict, result in zip(result_list, group_result.results):
                 result_dict["result"] = result
-                result_dict["usi_element"] = usi_element
-                result_list.append(result_dict)
-
-        # Waiting
-        for result_dict in result_list:
-            result = result_dict["result"]
-            usi_element = result_dict["usi_element"]
-            while(1):
-                if result.ready():
-                    break
-                sleep(0.5)
-
-            # Waiting on results
-            xic_list, ms2_data = result.get()
-            xic_df = pd.DataFrame(xic_list)
-
-            xic_dict = {}
-            xic_dict["df"] = xic_df
-            xic_dict["usi"] = usi_element
-            xic_df_list.append(xic_dict)
+
+        # Formatting each file as soon as it lands
+        for task_position, (xic_list, file_ms2_data) in _iterate_tasks(result_list, "xic"):
+            ms2_data = file_ms2_data
+
+            for position in result_list[task_position]["usi_positions"]:
+                try:
+                    df_long_list[position] = _format_xic_long(pd.DataFrame(xic_list), usi_list[position], usi1_list)
+                except:
+                    pass
 
     else:
-        for usi_element in usi_list:
-            if len(usi_list) == 1 and len(all_xic_values) == 1:
-                GET_MS2 = True
+        for position, usi_element in enumerate(usi_list):
+            _abandon_if_stale()
             
             # Doing it all local
             xic_df, ms2_data = _perform_xic(usi_element, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=GET_MS2)
 
-            xic_dict = {}
-            xic_dict["df"] = xic_df
-            xic_dict["usi"] = usi_element
-            xic_df_list.append(xic_dict)
-    
-    # Performing Normalization and formatting
-    df_long_list = []
-    for xic_dict in xic_df_list:
-        try:
-            xic_df = xic_dict["df"]
-            usi_element = xic_dict["usi"]
-
-            # Performing Normalization only if we have multiple XICs available
-            if xic_norm is True:
-                try:
-                    for key in xic_df.columns:
-                        if key == "rt":
-                            continue
-                        xic_df[key] = xic_df[key] / max(xic_df[key])
-                except:
-                    pass
+            try:
+                df_long_list[position] = _format_xic_long(xic_df, usi_element, usi1_list)
+            except:
+                pass
 
-            # Formatting for Plotting
-            target_names = list(xic_df.columns)
-            target_names.remove("rt")
-            df_long = pd.melt(xic_df, id_vars="rt", value_vars=target_names)
-            df_long["USI"] = usi_element
+    df_long_list = [df_long for df_long in df_long_list if df_long is not None]
 
-            if usi_element in usi1_list:
-                df_long["GROUP"] = "TOP"
-            else:
-                df_long["GROUP"] = "BOTTOM"
+    return pd.concat(df_long_list), ms2_data
 
-            df_long_list.append(df_long)
-        except:
-            pass
+def _perform_batch_xic(usi_list, usi1_list, usi2_list, xic_norm, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, 
+                       rt_min, rt_max, polarity_filter,
+                       extras_metadata_text, extras_metadata_column):
+    # Normalization and metadata are applied to the gathered traces, so toggling them doesn't extract anything again
+    merged_df_long, ms2_data = _gather_batch_xic(usi_list, usi1_list, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+    merged_df_long = merged_df_long.copy()
 
-    merged_df_long = pd.concat(df_long_list)
+    # Performing Normalization only if we have multiple XICs available
+    if xic_norm is True:
+        merged_df_long = _normalize_xic_long(merged_df_long)
 
     # Parsing the metadata if possible
     try:
@@ -2995,21 +3262,12 @@ def _is_worker_up():
 
 
 def _integrate_files(long_data_df, xic_integration_type):
-    grouped_df = pd.DataFrame()
-    # Integrating Data
-    if xic_integration_type == "MS1SUM":
-        grouped_df = long_data_df.groupby(["variable", "USI", "GROUP"]).sum().reset_index()
-        grouped_df = grouped_df.drop("rt", axis=1)
-    elif xic_integration_type == "AUC":
-        intermediate_grouped_df = long_data_df.groupby(["variable", "USI", "GROUP"])
-        grouped_df = long_data_df.groupby(["variable", "USI", "GROUP"]).sum().reset_index()
-        grouped_df["value"] = [integrate.trapezoid(group_df["value"], x=group_df["rt"]) for name, group_df in intermediate_grouped_df]
-        grouped_df = grouped_df.drop("rt", axis=1)
-    elif xic_integration_type == "MAXPEAKHEIGHT":
-        grouped_df = long_data_df.groupby(["variable", "USI", "GROUP"]).max().reset_index()
-        grouped_df = grouped_df.drop("rt", axis=1)
-
-    return grouped_df
+    # The PEAK options only integrate the peak around the apex of each trace
+    peak_bounded = xic_integration_type.startswith("PEAK")
+    if peak_bounded:
+        xic_integration_type = xic_integration_type[len("PEAK"):]
+
+    return integration.integrate_xic(long_data_df, xic_integration_type, peak_bounded=peak_bounded)
 
 ##################################
 # XIC Chromatogram Options
@@ -3063,6 +3321,9 @@ def create_chromatogram_options(usi, usi_select, usi2):
                   Input('map_plot_color_scale', 'value'),
                   Input('extras_metadata_text', 'value'),
                   Input('extras_metadata_column', 'value'),
+              ],
+              [
+                  State('client_session', 'data'),
               ])
 def draw_xic(   usi, 
                 usi2, 
@@ -3070,10 +3331,13 @@ def draw_xic(   usi,
                 xic_formula, xic_peptide, xic_tolerance, xic_ppm_tolerance, 
                 xic_tolerance_unit, xic_rt_window, xic_integration_type, xic_norm, xic_file_grouping, 
                 chromatogram_list, polarity_filter, export_format, plot_theme, map_plot_color_scale, 
-                extras_metadata_text, extras_metadata_column):
+                extras_metadata_text, extras_metadata_column,
+                client_session):
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
     print("TRIGGERED XIC PLOT", dash.callback_context.triggered, file=sys.stderr, flush=True)
 
+    utils_generation.begin_generation(redis_client, client_session, "xic")
+
     # For Drawing and Exporting
     graph_config = {
         "toImageButtonOptions":{
@@ -3460,12 +3724,50 @@ def render_initial_file_load(usi, usi_select, usi2):
     return [status]
 
 
+def _create_coarse_map_fig(filename, 
+                            map_selection=None, 
+                            show_ms2_markers=True, 
+                            polarity_filter="None", 
+                            map_plot_quantization_level="Medium", 
+                            map_plot_color_scale="Hot_r", 
+                            template="plotly_light",
+                            ms2marker_color="blue",
+                            ms2marker_size=5,
+                            map_plot_render_mode="Heatmap",
+                            map_viewport=None):
+    # Drawn in this process from the tiles only, None until the tiles are built or past their deepest level
+    min_rt, max_rt, min_mz, max_mz = utils._determine_rendering_bounds(map_selection)
+
+    coarse_result = lcms_map._aggregate_lcms_map_grid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, coarse=True, array_loader=shared_cache.load_npy_arrays)
+    if coarse_result is None:
+        return None
+
+    agg, msn_results = coarse_result
+
+    return lcms_map._create_map_fig(agg, msn_results, 
+                                    map_selection=map_selection, 
+                                    show_ms2_markers=show_ms2_markers, 
+                                    polarity_filter=polarity_filter, 
+                                    color_scale=map_plot_color_scale, 
+                                    template=template,
+                                    ms2marker_color=ms2marker_color,
+                                    ms2marker_size=int(ms2marker_size),
+                                    render_mode=map_plot_render_mode)
+
+def _parse_map_viewport(map_plot_viewport):
+    # Size of the plotting area reported by the browser, None before it has been measured
+    try:
+        map_viewport = json.loads(map_plot_viewport)
+        return {"width": int(map_viewport["width"]), "height": int(map_viewport["height"]), "pixel_ratio": float(map_viewport["pixel_ratio"])}
+    except:
+        return None
+
 # Inspiration for structure from
 # https://github.com/plotly/dash-datashader
 # https://community.plotly.com/t/heatmap-is-slow-for-large-data-arrays/21007/2
 
 @app.callback([
-                Output('map-plot', 'figure'), 
+                Output('map_plot_refined', 'data'), 
                 Output('map-plot', 'config'), 
                 Output('download-link', 'children'), 
                 Output("feature-finding-table", 'children'),
@@ -3476,9 +3778,11 @@ def render_initial_file_load(usi, usi_select, usi2):
                 Input('usi', 'value'), 
                 Input('usi_select', 'value'),
                 Input('map_plot_zoom', 'children'), 
+                Input('map_plot_viewport', 'children'),
                 Input('highlight_box', 'children'),
                 Input('map_plot_quantization_level', 'value'), 
                 Input('map_plot_color_scale', 'value'),
+                Input('map_plot_render_mode', 'value'),
                 Input('show_ms2_markers', 'value'),
                 Input('ms2marker_color', 'value'),
                 Input('ms2marker_size', 'value'),
@@ -3498,7 +3802,8 @@ def render_initial_file_load(usi, usi_select, usi2):
                 Input('run_massql_query_button', 'n_clicks'),
 
                 Input('image_export_format', 'value'),
-                Input("plot_theme", "value")
+                Input("plot_theme", "value"),
+                Input('map_plot_view', 'children'),
               ],
               [
                 State('feature_finding_ppm', 'value'),
@@ -3507,9 +3812,10 @@ def render_initial_file_load(usi, usi_select, usi2):
                 State('feature_finding_max_peak_rt', 'value'),
                 State('feature_finding_rt_tolerance', 'value'),
                 State('massql_statement', 'value'),
+                State('client_session', 'data'),
               ])
 def draw_file(url_search, usi, usi_select,
-                map_plot_zoom, highlight_box_zoom, map_plot_quantization_level, map_plot_color_scale,
+                map_plot_zoom, map_plot_viewport, highlight_box_zoom, map_plot_quantization_level, map_plot_color_scale, map_plot_render_mode,
                 show_ms2_markers, ms2marker_color, ms2marker_size, polarity_filter, 
                 overlay_usi, overlay_mz, overlay_rt, overlay_size, overlay_color, overlay_hover, overlay_filter_column, overlay_filter_value, overlay_tabular_data,
                 feature_finding_type,
@@ -3517,17 +3823,21 @@ def draw_file(url_search, usi, usi_select,
                 run_massql_query_button_click,
                 export_format,
                 plot_theme,
+                map_plot_view,
                 feature_finding_ppm,
                 feature_finding_noise,
                 feature_finding_min_peak_rt,
                 feature_finding_max_peak_rt, 
                 feature_finding_rt_tolerance,
-                massql_statement):
+                massql_statement,
+                client_session):
 
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
 
     print("TRIGGERED MAP PLOT", triggered_id, file=sys.stderr, flush=True)
 
+    utils_generation.begin_generation(redis_client, client_session, "map")
+
     plot_usi = utils.determine_usi_to_use(usi, usi_select)
     remote_link, local_filename = _resolve_usi(plot_usi)
 
@@ -3553,6 +3863,7 @@ def draw_file(url_search, usi, usi_select,
         feature_finding_params["params"]["massql_statement"] = massql_statement
 
     current_map_selection = json.loads(map_plot_zoom)
+    current_map_viewport = _parse_map_viewport(map_plot_viewport)
     highlight_box = None
     try:
         highlight_box = json.loads(highlight_box_zoom)
@@ -3569,7 +3880,10 @@ def draw_file(url_search, usi, usi_select,
                                 map_plot_color_scale=map_plot_color_scale,
                                 template=plot_theme,
                                 ms2marker_color=ms2marker_color,
-                                ms2marker_size=ms2marker_size)
+                                ms2marker_size=ms2marker_size,
+                                map_plot_render_mode=map_plot_render_mode,
+                                map_viewport=current_map_viewport,
+                                store_state=lcms_store.store_state(local_filename))
 
     # Adding on Feature Finding data
     map_fig, features_df = _integrate_feature_finding(local_filename, map_fig, map_selection=current_map_selection, feature_finding=feature_finding_params)
@@ -3621,8 +3935,62 @@ def draw_file(url_search, usi, usi_select,
     # Writing output status
     status = html.H6([dbc.Badge("Ready", color="success", className="ml-1")])
 
-    return [map_fig, graph_config, remote_link, feature_finding_figures, status]
+    # Only drawn if the user is still looking at this view
+    refined_map = {"view": map_plot_view, "figure": map_fig}
+
+    return [refined_map, graph_config, remote_link, feature_finding_figures, status]
+
+
+# First pass of the map, so something is on screen while the full resolution map is computed
+@app.callback([
+                Output('map_plot_coarse', 'data'),
+              ],
+              [
+                Input('map_plot_view', 'children'),
+              ],
+              [
+                State('usi', 'value'), 
+                State('usi_select', 'value'),
+                State('map_plot_zoom', 'children'), 
+                State('map_plot_viewport', 'children'),
+                State('map_plot_quantization_level', 'value'), 
+                State('map_plot_color_scale', 'value'),
+                State('map_plot_render_mode', 'value'),
+                State('show_ms2_markers', 'value'),
+                State('ms2marker_color', 'value'),
+                State('ms2marker_size', 'value'),
+                State('polarity_filtering', 'value'),
+                State("plot_theme", "value"),
+              ])
+def draw_file_coarse(map_plot_view, usi, usi_select, 
+                map_plot_zoom, map_plot_viewport, map_plot_quantization_level, map_plot_color_scale, map_plot_render_mode,
+                show_ms2_markers, ms2marker_color, ms2marker_size, polarity_filter, plot_theme):
+
+    coarse_map = {"view": map_plot_view, "figure": None}
+
+    # Never waiting on a download here
+    plot_usi = utils.determine_usi_to_use(usi, usi_select)
+    if not download._resolve_exists_local(plot_usi):
+        return [coarse_map]
+
+    try:
+        remote_link, local_filename = download._resolve_usi(plot_usi)
+
+        coarse_map["figure"] = _create_coarse_map_fig(local_filename, 
+                                map_selection=json.loads(map_plot_zoom), 
+                                show_ms2_markers=(show_ms2_markers == 1), 
+                                polarity_filter=polarity_filter, 
+                                map_plot_quantization_level=map_plot_quantization_level,
+                                map_plot_color_scale=map_plot_color_scale,
+                                template=plot_theme,
+                                ms2marker_color=ms2marker_color,
+                                ms2marker_size=ms2marker_size,
+                                map_plot_render_mode=map_plot_render_mode,
+                                map_viewport=_parse_map_viewport(map_plot_viewport))
+    except:
+        print("COARSE MAP FAILED", file=sys.stderr, flush=True)
 
+    return [coarse_map]
 
 @app.callback([
                 Output('map-plot2', 'figure'),
@@ -3632,17 +4000,23 @@ def draw_file(url_search, usi, usi_select,
               [
                 Input('usi2', 'value'), 
                 Input('map_plot_zoom', 'children'),
+                Input('map_plot_viewport', 'children'),
                 Input('map_plot_quantization_level', 'value'), 
                 Input('map_plot_color_scale', 'value'),
+                Input('map_plot_render_mode', 'value'),
                 Input('show_ms2_markers', 'value'),
                 Input("show_lcms_2nd_map", "value"),
                 Input('polarity_filtering2', 'value'),
                 Input('image_export_format', 'value'),
                 Input('plot_theme', 'value')
+              ],
+              [
+                State('client_session', 'data'),
               ])
 def draw_file2( usi, 
-                map_plot_zoom, map_plot_quantization_level, map_plot_color_scale,
-                show_ms2_markers, show_lcms_2nd_map, polarity_filter, export_format, plot_theme):
+                map_plot_zoom, map_plot_viewport, map_plot_quantization_level, map_plot_color_scale, map_plot_render_mode,
+                show_ms2_markers, show_lcms_2nd_map, polarity_filter, export_format, plot_theme,
+                client_session):
 
     if show_lcms_2nd_map is False:
         status = html.H6([dbc.Badge("Not Shown", color="secondary", className="ml-1")])
@@ -3650,6 +4024,8 @@ def draw_file2( usi,
 
     triggered_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
 
+    utils_generation.begin_generation(redis_client, client_session, "map2")
+
     usi_list = usi.split("\n")
 
     remote_link, local_filename = _resolve_usi(usi_list[0])
@@ -3660,6 +4036,7 @@ def draw_file2( usi,
         show_ms2_markers = False
 
     current_map_selection = json.loads(map_plot_zoom)
+    current_map_viewport = _parse_map_viewport(map_plot_viewport)
 
     # Doing LCMS Map
     map_fig = _create_map_fig(local_filename, 
@@ -3668,7 +4045,10 @@ def draw_file2( usi,
                                 polarity_filter=polarity_filter, 
                                 map_plot_quantization_level=map_plot_quantization_level,
                                 map_plot_color_scale=map_plot_color_scale,
-                                template=plot_theme)
+                                template=plot_theme,
+                                map_plot_render_mode=map_plot_render_mode,
+                                map_viewport=current_map_viewport,
+                                store_state=lcms_store.store_state(local_filename))
 
     # Heatmap Config
     graph_config = {
@@ -3797,6 +4177,7 @@ def create_gnps_mzmine2_link(usi, usi2, feature_finding_type, feature_finding_pp
 
                 Input("comment", "value"),
 
+                Input("map_plot_render_mode", "value"),
                 Input("map_plot_color_scale", "value"),
                 Input("map_plot_quantization_level", "value"),
 
@@ -3815,7 +4196,7 @@ def create_link(usi, usi_select, usi2, xic_mz, xic_formula, xic_peptide,
                 sychronization_save_session_button_clicks, sychronization_set_type_button_clicks, sychronization_session_id, synchronization_leader_token, 
                 chromatogram_options, 
                 comment,
-                map_plot_color_scale, map_plot_quantization_level, plot_theme,
+                map_plot_render_mode, map_plot_color_scale, map_plot_quantization_level, plot_theme,
                 synchronization_type):
 
     url_params = {}
@@ -3873,6 +4254,7 @@ def create_link(usi, usi_select, usi2, xic_mz, xic_formula, xic_peptide,
     url_params["comment"] = comment
 
     # Advanced Viz options
+    url_params["map_plot_render_mode"] = map_plot_render_mode
     url_params["map_plot_color_scale"] = map_plot_color_scale
     url_params["map_plot_quantization_level"] = map_plot_quantization_level
 
@@ -4003,6 +4385,136 @@ app.clientside_callback(
     ]
 )
 
+# Giving the browser tab an id that survives reloads of the same tab
+app.clientside_callback(
+    """
+    function(search, existing_session) {
+        if (existing_session) {
+            return window.dash_clientside.no_update;
+        }
+        return Math.random().toString(36).substring(2) + Date.now().toString(36);
+    }
+    """,
+    Output('client_session', 'data'),
+    [
+        Input('url', 'search'),
+    ],
+    [
+        State('client_session', 'data'),
+    ]
+)
+
+# Everything that decides what the map shows, the coarse and refined maps are tagged with it
+app.clientside_callback(
+    """
+    function() {
+        return JSON.stringify(Array.from(arguments));
+    }
+    """,
+    Output('map_plot_view', 'children'),
+    [
+        Input('usi', 'value'),
+        Input('usi_select', 'value'),
+        Input('map_plot_zoom', 'children'),
+        Input('map_plot_viewport', 'children'),
+        Input('map_plot_quantization_level', 'value'),
+        Input('map_plot_color_scale', 'value'),
+        Input('map_plot_render_mode', 'value'),
+        Input('show_ms2_markers', 'value'),
+        Input('ms2marker_color', 'value'),
+        Input('ms2marker_size', 'value'),
+        Input('polarity_filtering', 'value'),
+        Input('plot_theme', 'value'),
+    ]
+)
+
+# Showing the coarse map until the refined one for the same view arrives, maps for views we have left are dropped
+app.clientside_callback(
+    """
+    function(coarse_map, refined_map, current_view, shown_map) {
+        var no_update = window.dash_clientside.no_update;
+        var triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+
+        var shown = {};
+        try {
+            shown = JSON.parse(shown_map) || {};
+        } catch (error) {
+        }
+
+        if (triggered.includes('map_plot_refined.data') && refined_map && refined_map.view == current_view) {
+            return [refined_map.figure, JSON.stringify({"view": current_view, "phase": "refined"})];
+        }
+
+        if (triggered.includes('map_plot_coarse.data') && coarse_map && coarse_map.figure && coarse_map.view == current_view) {
+            if (shown.view == current_view && shown.phase == "refined") {
+                return [no_update, no_update];
+            }
+            return [coarse_map.figure, JSON.stringify({"view": current_view, "phase": "coarse"})];
+        }
+
+        return [no_update, no_update];
+    }
+    """,
+    [
+        Output('map-plot', 'figure'),
+        Output('map_plot_shown', 'children'),
+    ],
+    [
+        Input('map_plot_coarse', 'data'),
+        Input('map_plot_refined', 'data'),
+    ],
+    [
+        State('map_plot_view', 'children'),
+        State('map_plot_shown', 'children'),
+    ]
+)
+
+# Measuring the map so the aggregation matches the pixels on screen, small size changes are ignored so we don't redraw for nothing
+app.clientside_callback(
+    """
+    function(search, relayout_data, existing_viewport) {
+        var graph = document.getElementById('map-plot');
+        if (!graph) {
+            return window.dash_clientside.no_update;
+        }
+
+        var plot = graph.querySelector('.js-plotly-plot');
+        var width = graph.offsetWidth - 180;
+        var height = 450;
+        if (plot && plot._fullLayout && plot._fullLayout._size) {
+            width = plot._fullLayout._size.w;
+            height = plot._fullLayout._size.h;
+        }
+
+        if (width <= 0 || height <= 0) {
+            return window.dash_clientside.no_update;
+        }
+
+        var viewport = {"width": Math.round(width), "height": Math.round(height), "pixel_ratio": window.devicePixelRatio || 1};
+
+        try {
+            var existing = JSON.parse(existing_viewport);
+            if (existing.pixel_ratio == viewport.pixel_ratio && 
+                Math.abs(existing.width - viewport.width) <= existing.width * 0.1 && 
+                Math.abs(existing.height - viewport.height) <= existing.height * 0.1) {
+                return window.dash_clientside.no_update;
+            }
+        } catch (error) {
+        }
+
+        return JSON.stringify(viewport);
+    }
+    """,
+    Output('map_plot_viewport', 'children'),
+    [
+        Input('url', 'search'),
+        Input('map-plot', 'relayoutData'),
+    ],
+    [
+        State('map_plot_viewport', 'children'),
+    ]
+)
+
 # Sychronization Callbacks
 app.clientside_callback(
     """
@@ -4855,6 +5367,10 @@ def shorturlresolve():
 def logo():
     return send_from_directory("assets", "dashboard_logo_final_transparent.png")
 
+@server.route("/sharedcachemetrics")
+def sharedcachemetrics():
+    return json.dumps(shared_cache.get_metrics())
+
 # DEBUGGING
 @server.route("/overlayresolve")
 def resolveoverlay():
@@ -1,6 +1,7 @@
 import pandas as pd
 from utils import _spectrum_generator
 from utils import _get_scan_polarity
+import lcms_store
 import uuid
 import os
 import pathlib
@@ -47,6 +48,17 @@ def _trivial_feature_finding(filename):
     min_mz = 0
     max_mz = 2000
 
+    # Reading from the store if we have all of it
+    if lcms_store.store_complete(filename):
+        peaks_df = lcms_store.query_ms1(filename, min_rt, max_rt, min_mz, max_mz, columns=["mz", "i", "rt", "index"])
+        peaks_df = peaks_df.sort_values(by=["i"])
+        peaks_df = peaks_df.groupby("index").tail(2)
+
+        features_df = peaks_df[["mz", "i", "rt"]].sort_values(by=['i'])
+        features_df = features_df.head(50).reset_index(drop=True)
+
+        return features_df
+
     all_mz = []
     all_i = []
     all_rt = []
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+# Columns that make up one trace in the long format XIC data
+TRACE_COLUMNS = ["variable", "USI", "GROUP"]
+
+# Peak bounded integration walks out from the apex until the trace drops below this fraction of the apex
+PEAK_BOUNDARY_FRACTION = 0.05
+
+def _trace_segments(long_data_df):
+    trace_codes = long_data_df.groupby(TRACE_COLUMNS, sort=True).ngroup().values
+    if len(trace_codes) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # Traces come in as runs of rows, so sorting the runs is enough to put each trace together with its points in their original order
+    run_starts = np.flatnonzero(np.r_[True, trace_codes[1:] != trace_codes[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(trace_codes)])
+    run_codes = trace_codes[run_starts]
+
+    # Rows with a missing key don't belong to any trace
+    run_order = np.argsort(run_codes, kind="stable")
+    run_order = run_order[run_codes[run_order] >= 0]
+
+    sorted_run_starts = run_starts[run_order]
+    sorted_run_lengths = run_lengths[run_order]
+    sorted_run_offsets = np.cumsum(sorted_run_lengths) - sorted_run_lengths
+    row_order = np.arange(int(sorted_run_lengths.sum())) + np.repeat(sorted_run_starts - sorted_run_offsets, sorted_run_lengths)
+
+    sorted_run_codes = run_codes[run_order]
+    segment_runs = np.flatnonzero(np.r_[True, sorted_run_codes[1:] != sorted_run_codes[:-1]]) if len(sorted_run_codes) > 0 else np.array([], dtype=np.int64)
+    segment_starts = sorted_run_offsets[segment_runs]
+
+    return row_order, segment_starts
+
+def _segment_ends(segment_starts, number_rows):
+    return np.r_[segment_starts[1:], number_rows].astype(np.int64)
+
+def _peak_mask(values, segment_starts, segment_ends, segment_ids):
+    """
+    Marks the points of each trace that belong to the peak around its apex
+
+    Args:
+        values (np.array): intensities sorted by trace
+        segment_starts (np.array): first row of each trace
+        segment_ends (np.array): one past the last row of each trace
+        segment_ids (np.array): trace of every row
+
+    Returns:
+        np.array: boolean mask over the rows
+    """
+
+    number_rows = len(values)
+    row_positions = np.arange(number_rows)
+
+    apex_values = np.fmax.reduceat(values, segment_starts)
+
+    # First point that reaches the apex, traces that are all nan take the whole trace
+    apex_candidates = np.where(values == apex_values[segment_ids], row_positions, number_rows)
+    apex_rows = np.minimum.reduceat(apex_candidates, segment_starts)
+    apex_rows = np.where(apex_rows < segment_ends, apex_rows, segment_starts)
+
+    below_boundary = values < (apex_values * PEAK_BOUNDARY_FRACTION)[segment_ids]
+
+    # Last point below the boundary up to each row, never reaching back into the previous trace
+    last_below = np.maximum.accumulate(np.where(below_boundary, row_positions, segment_starts[segment_ids] - 1))
+
+    # First point below the boundary from each row on, never reaching into the next trace
+    first_below = np.minimum.accumulate(np.where(below_boundary, row_positions, segment_ends[segment_ids])[::-1])[::-1]
+
+    peak_starts = last_below[apex_rows] + 1
+    peak_ends = first_below[apex_rows]
+
+    return (row_positions >= peak_starts[segment_ids]) & (row_positions < peak_ends[segment_ids])
+
+def integrate_xic(long_data_df, integration_type, peak_bounded=False):
+    """
+    Integrates every trace of the long format XIC data in one pass over the rows sorted by trace
+
+    Args:
+        long_data_df (pd.DataFrame): rt, variable, value, USI and GROUP columns, other columns are carried over from the first row of each trace
+        integration_type (str): "AUC", "MS1SUM" or "MAXPEAKHEIGHT"
+        peak_bounded (bool, optional): only integrate the peak around the apex of each trace, see PEAK_BOUNDARY_FRACTION. Defaults to False.
+
+    Returns:
+        pd.DataFrame: one row per trace, variable, USI, GROUP and value first
+    """
+
+    row_order, segment_starts = _trace_segments(long_data_df)
+
+    # Only the first row of every trace is needed from the other columns
+    extra_columns = [column for column in long_data_df.columns if column not in TRACE_COLUMNS + ["rt", "value"]]
+    first_rows_df = long_data_df.iloc[row_order[segment_starts]].reset_index(drop=True)
+
+    integral_df = first_rows_df[TRACE_COLUMNS].copy()
+
+    number_rows = len(row_order)
+    number_segments = len(segment_starts)
+    if number_segments == 0:
+        integral_df["value"] = np.array([], dtype=np.float64)
+        for column in extra_columns:
+            integral_df[column] = first_rows_df[column]
+        return integral_df
+
+    segment_ends = _segment_ends(segment_starts, number_rows)
+    segment_ids = np.repeat(np.arange(number_segments), segment_ends - segment_starts)
+
+    values = long_data_df["value"].values.astype(np.float64)[row_order]
+
+    in_peak = np.ones(number_rows, dtype=bool)
+    if peak_bounded:
+        in_peak = _peak_mask(values, segment_starts, segment_ends, segment_ids)
+
+    if integration_type == "MS1SUM":
+        integral_values = np.bincount(segment_ids[in_peak], weights=np.nan_to_num(values[in_peak]), minlength=number_segments)
+    elif integration_type == "AUC":
+        rt_values = long_data_df["rt"].values.astype(np.float64)[row_order]
+
+        # Trapezoids between neighbouring points of the same trace
+        is_pair = (segment_ids[1:] == segment_ids[:-1]) & in_peak[1:] & in_peak[:-1]
+        pair_areas = (rt_values[1:] - rt_values[:-1]) * (values[1:] + values[:-1]) / 2
+        integral_values = np.bincount(segment_ids[:-1][is_pair], weights=pair_areas[is_pair], minlength=number_segments)
+    elif integration_type == "MAXPEAKHEIGHT":
+        integral_values = np.fmax.reduceat(values, segment_starts)
+    else:
+        raise Exception("Unknown integration type {}".format(integration_type))
+
+    integral_df["value"] = integral_values.astype(np.float64)
+
+    for column in extra_columns:
+        integral_df[column] = first_rows_df[column]
+
+    return integral_df
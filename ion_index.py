@@ -0,0 +1,147 @@
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+
+import lcms_store
+import scan_index
+
+# Enum for polarity, matching lcms_map
+POLARITY_POS = 1
+POLARITY_NEG = 2
+
+# Sorting all the peaks of a file at once needs them in memory, about 40 bytes per peak at the peak of the build,
+# so this stays well under the memory cap of a worker child. Larger files keep using the store
+ION_INDEX_MAX_PEAKS = int(os.environ.get("ION_INDEX_MAX_PEAKS", 20000000))
+
+def _get_ion_index_folder(filename):
+    # Lives inside the build of the store, and goes away with it when the store is rebuilt
+    return os.path.join(lcms_store._get_build_folder(filename), "ionindex")
+
+def ion_index_exists(filename):
+    return lcms_store.store_exists(filename) and os.path.exists(os.path.join(_get_ion_index_folder(filename), "manifest.json"))
+
+def can_build_ion_index(filename):
+    if not lcms_store.store_complete(filename) or not scan_index.scan_index_exists(filename):
+        return False
+
+    manifest = lcms_store.load_manifest(filename)
+    return sum([chunk["rows"] for chunk in manifest["chunks"]]) <= ION_INDEX_MAX_PEAKS
+
+def build_ion_index(filename):
+    """
+    Sorts every MS1 peak of the file by mz, with the intensity and spectrum of each peak as parallel arrays,
+    next to a table with the rt and polarity of every MS1 spectrum
+
+    Args:
+        filename (str): local mzML filename, the complete peak store and the scan index have to exist
+    """
+
+    store_folder = lcms_store._get_store_folder(filename)
+    manifest = lcms_store.load_manifest(filename)
+
+    all_mz = []
+    all_i = []
+    all_spectrum = []
+    for chunk in manifest["chunks"]:
+        chunk_table = lcms_store._read_table(os.path.join(store_folder, chunk["filename"]), columns=["mz", "i", "index"])
+        all_mz.append(chunk_table["mz"].to_numpy())
+        all_i.append(chunk_table["i"].to_numpy())
+
+        # The store counts MS1 spectra from 1
+        all_spectrum.append(chunk_table["index"].to_numpy() - 1)
+
+    if len(all_mz) > 0:
+        peaks_mz = np.concatenate(all_mz)
+        peaks_i = np.concatenate(all_i)
+        peaks_spectrum = np.concatenate(all_spectrum).astype(np.int32)
+    else:
+        peaks_mz = np.array([], dtype=np.float64)
+        peaks_i = np.array([], dtype=np.float32)
+        peaks_spectrum = np.array([], dtype=np.int32)
+
+    mz_order = np.argsort(peaks_mz, kind="stable")
+
+    # Every MS1 spectrum, including the ones without peaks, so they are reported as zero
+    scans_df = scan_index.load_scan_index(filename)
+    ms1_scans_df = scans_df[scans_df["ms_level"] == 1]
+
+    ion_index_folder = _get_ion_index_folder(filename)
+    temp_ion_index_folder = "{}.tmp-{}".format(ion_index_folder, str(uuid.uuid4()).replace("-", ""))
+    os.makedirs(temp_ion_index_folder)
+
+    np.save(os.path.join(temp_ion_index_folder, "mz.npy"), peaks_mz[mz_order])
+    np.save(os.path.join(temp_ion_index_folder, "i.npy"), peaks_i[mz_order])
+    np.save(os.path.join(temp_ion_index_folder, "spectrum.npy"), peaks_spectrum[mz_order])
+    np.save(os.path.join(temp_ion_index_folder, "spectra_rt.npy"), ms1_scans_df["rt"].values.astype(np.float64))
+    np.save(os.path.join(temp_ion_index_folder, "spectra_polarity.npy"), ms1_scans_df["polarity"].values.astype(np.int8))
+
+    ion_index_manifest = {}
+    ion_index_manifest["number_peaks"] = int(len(peaks_mz))
+    ion_index_manifest["number_spectra"] = int(len(ms1_scans_df))
+
+    # The manifest goes last, it marks the index as complete
+    with open(os.path.join(temp_ion_index_folder, "manifest.json"), "w") as manifest_file:
+        json.dump(ion_index_manifest, manifest_file)
+
+    # Another worker might have finished it first, either copy is fine
+    if os.path.exists(ion_index_folder):
+        shutil.rmtree(temp_ion_index_folder, ignore_errors=True)
+        return
+
+    os.rename(temp_ion_index_folder, ion_index_folder)
+
+def _load_npy_arrays(folder, names):
+    return {name: np.load(os.path.join(folder, "{}.npy".format(name)), mmap_mode="r") for name in names}
+
+def query_ion_index(filename, min_rt, max_rt, lower_mz, upper_mz, polarity_filter="None", array_loader=_load_npy_arrays):
+    """
+    Sums the intensity of many mz windows per MS1 spectrum, each window is two binary searches and a bincount
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): inclusive lower rt bound
+        max_rt (float): inclusive upper rt bound
+        lower_mz (np.array): inclusive lower mz bound per window
+        upper_mz (np.array): inclusive upper mz bound per window
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+        array_loader (function, optional): reads named .npy files of a folder, e.g. shared_cache.load_npy_arrays. Defaults to memory mapping them.
+
+    Returns:
+        tuple: rt of the spectra in the window, and their summed intensity with one column per mz window
+    """
+
+    ion_index_arrays = array_loader(_get_ion_index_folder(filename), ["mz", "i", "spectrum", "spectra_rt", "spectra_polarity"])
+    peaks_mz = ion_index_arrays["mz"]
+    peaks_i = ion_index_arrays["i"]
+    peaks_spectrum = ion_index_arrays["spectrum"]
+    spectra_rt = ion_index_arrays["spectra_rt"]
+    spectra_polarity = ion_index_arrays["spectra_polarity"]
+
+    lower_mz = np.asarray(lower_mz, dtype=np.float64)
+    upper_mz = np.asarray(upper_mz, dtype=np.float64)
+    number_spectra = len(spectra_rt)
+    number_windows = len(lower_mz)
+
+    window_starts = np.searchsorted(peaks_mz, lower_mz, side="left")
+    window_lengths = np.maximum(np.searchsorted(peaks_mz, upper_mz, side="right") - window_starts, 0)
+
+    # Peaks of all the windows laid end to end
+    window_offsets = np.cumsum(window_lengths) - window_lengths
+    peak_rows = np.arange(int(window_lengths.sum())) - np.repeat(window_offsets, window_lengths) + np.repeat(window_starts, window_lengths)
+    peak_windows = np.repeat(np.arange(number_windows), window_lengths)
+
+    peak_spectra = peaks_spectrum[peak_rows].astype(np.int64)
+    in_table = peak_spectra < number_spectra
+
+    summed_intensity = np.bincount(peak_spectra[in_table] * number_windows + peak_windows[in_table], weights=peaks_i[peak_rows[in_table]], minlength=number_spectra * number_windows)
+    summed_intensity = summed_intensity.reshape(number_spectra, number_windows)
+
+    spectra_mask = (spectra_rt >= min_rt) & (spectra_rt <= max_rt)
+    if polarity_filter == "Positive":
+        spectra_mask &= spectra_polarity == POLARITY_POS
+    elif polarity_filter == "Negative":
+        spectra_mask &= spectra_polarity == POLARITY_NEG
+
+    return np.asarray(spectra_rt[spectra_mask]), summed_intensity[spectra_mask]
@@ -237,6 +237,30 @@ ADVANCED_VISUALIZATION_MODAL = [
                     )),
                 ]),
                 html.Hr(),
+                dbc.Row([
+                    dbc.Col(
+                        dbc.Row(
+                            [
+                                dbc.Label("LCMS Map Rendering", width=4.8, style={"width":"250px"}),
+                                dcc.Dropdown(
+                                    id='map_plot_render_mode',
+                                    options=[
+                                        {'label': 'Interactive Heatmap', 'value': 'Heatmap'},
+                                        {'label': 'Server Image (Faster)', 'value': 'Image'},
+                                    ],
+                                    searchable=False,
+                                    clearable=False,
+                                    value="Heatmap",
+                                    style={
+                                        "width":"60%"
+                                    }
+                                )  
+                            ],
+                            className="mb-3",
+                            style={"margin-left": "4px"}
+                    )),
+                ]),
+                html.Hr(),
                 dbc.Row([
                     dbc.Col(
                         dbc.InputGroup(
@@ -1,51 +1,127 @@
 
 import os
+import itertools
 import pymzml
 import numpy as np
 import datashader as ds
+import io
 import json
+import base64
 import pandas as pd
 import xarray
 import time
+import traceback
 import utils
+import lcms_store
+import lcms_tiles
+import scan_index
+
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
 
 import plotly.express as px
 import plotly.graph_objects as go 
+import plotly.colors
 
 from utils import _spectrum_generator
 from utils import _get_scan_polarity
+from utils import _get_spectrum_identifier
 
 # Enum for polarity
 POLARITY_POS = 1
 POLARITY_NEG = 2
 
-def _get_spectrum_identifier(spec, use_scans=True):
-    spectrum_identifier = spec.ID
-    if use_scans is False:
-        try:
-            # Keys that matter for Sciex Data
-            key_order = ['sample', 'period', 'cycle', 'experiment']
-            spectrum_identifier = " ".join(["{}={}".format(key, spec.id_dict[key]) for key in key_order])
-        except:
-            pass
+# Building the store in parallel, shards of the scan index per process. Every conversion task that runs at the same time
+# starts its own pool, so by default the cores are split over the most conversion tasks the worker autoscales to
+CONVERSION_WORKER_CONCURRENCY = int(os.environ.get("CONVERSION_WORKER_CONCURRENCY", 8))
+STORE_BUILD_PROCESSES = int(os.environ.get("STORE_BUILD_PROCESSES", max((os.cpu_count() or 1) // CONVERSION_WORKER_CONCURRENCY, 1)))
+STORE_BUILD_SHARD_SPECTRA = 2000
 
-    return spectrum_identifier
+# Spectra read at a time in the sequential build, the store is published every chunk worth of peaks
+STORE_PUBLISH_SPECTRA = 500
 
-def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100, include_polarity=False):
-    all_mz = []
-    all_rt = []
-    all_polarity = []
-    all_i = []
-    all_scan = []
-    all_index = []
-    spectrum_index = 0
-    number_spectra = 0
+# Most intense peaks per spectrum drawn on the map, per quantization level
+MAP_TOP_SPECTRUM_PEAKS = {"Low": 50, "Medium": 100, "High": 200}
 
-    all_msn_mz = []
-    all_msn_rt = []
-    all_msn_polarity = []
-    all_msn_scan = []
-    all_msn_level = []
+# Bins per screen pixel for each quantization level, when the client tells us the size of the map
+MAP_QUANTIZATION_PIXEL_SCALE = {"Low": 0.5, "Medium": 1, "High": 2}
+MAP_MIN_PIXELS = 20
+MAP_MAX_PIXELS = 4096
+
+# First pass of a progressive map, a raster this many times smaller per side from the most intense peaks
+MAP_COARSE_SCALE = 4
+MAP_COARSE_SPECTRUM_PEAKS = 50
+
+# Past this many MSn markers in view, markers are binned into cells of the map raster and one per cell is drawn
+MSN_MARKER_DETAIL_THRESHOLD = 5000
+MSN_MARKER_CELL_PIXELS = 8
+
+# Server shaded map images, the most intense cells keep an invisible point for hovering and clicking
+MAP_IMAGE_COLORS = 256
+MAP_IMAGE_HOVER_POINTS = 5000
+
+# Binary layout for aggregation results passed from the workers to the server
+AGGREGATION_MAGIC = b"LCMSAGG1"
+AGGREGATION_ALIGNMENT = 8
+
+def _spectrum_peak_arrays(spec, min_mz, max_mz, top_spectrum_peaks, min_intensity=lcms_store.MAP_MIN_INTENSITY):
+    """
+    Returns the filtered mz and intensity arrays of a spectrum, keeping only its most intense peaks
+
+    Args:
+        spec (pymzml.spec.Spectrum): MS1 spectrum
+        min_mz (float): inclusive lower mz bound
+        max_mz (float): inclusive upper mz bound
+        top_spectrum_peaks (int): most intense peaks to keep
+        min_intensity (float, optional): lowest intensity kept, peaks without any intensity are always dropped. Defaults to lcms_store.MAP_MIN_INTENSITY.
+
+    Returns:
+        tuple: mz and intensity numpy arrays
+    """
+
+    mz = np.asarray(spec.mz, dtype=np.float64)
+    intensity = np.asarray(spec.i, dtype=np.float64)
+
+    # Filtering out zero rows
+    peak_mask = (mz >= 1.0) & (intensity >= min_intensity) & (intensity > 0)
+
+    # Filtering peaks by mz
+    if not (min_mz <= 0 and max_mz >= 2000):
+        peak_mask &= (mz >= min_mz) & (mz <= max_mz)
+
+    mz = mz[peak_mask]
+    intensity = intensity[peak_mask]
+
+    # Keeping the most intense peaks, no need for a full sort
+    if len(intensity) > top_spectrum_peaks:
+        top_positions = np.argpartition(intensity, len(intensity) - top_spectrum_peaks)[-top_spectrum_peaks:]
+        mz = mz[top_positions]
+        intensity = intensity[top_positions]
+
+    return mz, intensity
+
+def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100, include_polarity=False):
+    """
+    Reads the MS1 peaks and MSn precursors within a window from the file
+
+    Peaks are collected as one numpy array per spectrum and concatenated once at the end,
+    the per spectrum values (rt, index, scan, polarity) are only expanded to peaks at that point.
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): lower rt bound
+        max_rt (float): upper rt bound
+        min_mz (float): lower mz bound
+        max_mz (float): upper mz bound
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+        top_spectrum_peaks (int, optional): most intense peaks kept per spectrum. Defaults to 100.
+        include_polarity (bool, optional): adds a polarity column to both results. Defaults to False.
+
+    Returns:
+        tuple: ms1 peaks dataframe, number of MS1 spectra, msn precursors dataframe
+    """
 
     use_scans = True
     # Checking the first spectrum to see if we should use scans or nativeIDs
@@ -58,8 +134,47 @@ def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=
 
     # Iterating through all data with a custom scan iterator
     # It handles custom bounds on RT
-    for spec in _spectrum_generator(filename, min_rt, max_rt):
-        rt = spec.scan_time_in_minutes()
+    spectra = _spectrum_generator(filename, min_rt, max_rt)
+
+    return _gather_lcms_spectra(spectra, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, top_spectrum_peaks=top_spectrum_peaks, include_polarity=include_polarity, use_scans=use_scans)
+
+def _gather_lcms_spectra(spectra, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100, include_polarity=False, use_scans=True, first_spectrum_number=1, min_intensity=lcms_store.MAP_MIN_INTENSITY):
+    """
+    Collects the peaks and precursors of an iterable of spectra, the engine behind _gather_lcms_data
+
+    Args:
+        spectra (iterable): pymzml spectra in file order
+        first_spectrum_number (int, optional): index given to the first MS1 spectrum, for spectra that do not start at the
+            beginning of the file. Defaults to 1.
+
+    Returns:
+        tuple: ms1 peaks dataframe, number of MS1 spectra, msn precursors dataframe
+    """
+
+    # One entry per MS1 spectrum
+    all_mz = []
+    all_i = []
+    all_spectrum_rt = []
+    all_spectrum_index = []
+    all_spectrum_scan = []
+    all_spectrum_polarity = []
+    number_spectra = 0
+
+    all_msn_mz = []
+    all_msn_rt = []
+    all_msn_polarity = []
+    all_msn_scan = []
+    all_msn_level = []
+
+    for spec in spectra:
+        # Spectra without an rt can't be placed, MS1s are still counted so the numbering matches the scan index
+        try:
+            rt = spec.scan_time_in_minutes()
+        except:
+            if spec.ms_level == 1:
+                number_spectra += 1
+            continue
+
         try:
             # Still waiting for the window
             if rt < min_rt:
@@ -71,48 +186,29 @@ def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=
         except:
             pass
 
-        if polarity_filter == "None":
-            pass
-        else:
+        # Determining polarity once per spectrum, only when we need it
+        polarity_code = None
+        if polarity_filter != "None" or include_polarity is True:
             scan_polarity = _get_scan_polarity(spec)
-            if polarity_filter != scan_polarity:
+            if polarity_filter != "None" and polarity_filter != scan_polarity:
                 continue
+
+            polarity_code = POLARITY_POS if scan_polarity == "Positive" else POLARITY_NEG
         
         if spec.ms_level == 1:
-            spectrum_index += 1
             number_spectra += 1
 
             try:
-                # Filtering peaks by mz
-                if min_mz <= 0 and max_mz >= 2000:
-                    peaks = spec.peaks("raw")
-                else:
-                    peaks = spec.reduce(mz_range=(min_mz, max_mz))
-
-                # Filtering out zero rows
-                peaks = peaks[~np.any(peaks < 1.0, axis=1)]
-
-                # Sorting by intensity
-                peaks = peaks[peaks[:,1].argsort()]
-                peaks = peaks[-1 * top_spectrum_peaks:]
-
-                mz, intensity = zip(*peaks)
-
-                spectrum_identifier = _get_spectrum_identifier(spec, use_scans=use_scans)
+                mz, intensity = _spectrum_peak_arrays(spec, min_mz, max_mz, top_spectrum_peaks, min_intensity=min_intensity)
+                if len(mz) == 0:
+                    continue
 
-                all_mz += list(mz)
-                all_i += list(intensity)
-                all_rt += len(mz) * [rt]
-                all_index += len(mz) * [number_spectra]
-                all_scan += len(mz) * [spectrum_identifier]
-
-                # Adding polarity
-                if include_polarity is True:
-                    scan_polarity = _get_scan_polarity(spec)
-                    if scan_polarity == "Positive":
-                        all_polarity += len(mz) * [POLARITY_POS]
-                    else:
-                        all_polarity += len(mz) * [POLARITY_NEG]
+                all_mz.append(mz)
+                all_i.append(intensity)
+                all_spectrum_rt.append(rt)
+                all_spectrum_index.append(first_spectrum_number + number_spectra - 1)
+                all_spectrum_scan.append(_get_spectrum_identifier(spec, use_scans=use_scans))
+                all_spectrum_polarity.append(polarity_code)
             except:
                 pass
         elif spec.ms_level > 1:
@@ -127,23 +223,22 @@ def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=
                 all_msn_rt.append(rt)
                 all_msn_level.append(spec.ms_level)
                 all_msn_scan.append(spectrum_identifier)
-
-                # Adding polarity
-                if include_polarity is True:
-                    scan_polarity = _get_scan_polarity(spec)
-                    if scan_polarity == "Positive":
-                        all_msn_polarity.append(POLARITY_POS)
-                    else:
-                        all_msn_polarity.append(POLARITY_NEG)
+                all_msn_polarity.append(polarity_code)
             except:
                 pass
-        
+
+    # Expanding the per spectrum values to peaks in one go
+    peak_counts = np.array([len(mz) for mz in all_mz], dtype=np.int64)
+
+    # Scans are stored as integer codes into a lookup table of identifiers
+    spectrum_scans = pd.Categorical(all_spectrum_scan)
+
     ms1_results = {}
-    ms1_results["mz"] = all_mz
-    ms1_results["rt"] = all_rt
-    ms1_results["i"] = all_i
-    ms1_results["scan"] = all_scan
-    ms1_results["index"] = all_index
+    ms1_results["mz"] = np.concatenate(all_mz) if len(all_mz) > 0 else np.array([], dtype=np.float64)
+    ms1_results["rt"] = np.repeat(np.array(all_spectrum_rt, dtype=np.float64), peak_counts)
+    ms1_results["i"] = np.concatenate(all_i) if len(all_i) > 0 else np.array([], dtype=np.float64)
+    ms1_results["scan"] = pd.Categorical.from_codes(np.repeat(spectrum_scans.codes, peak_counts), categories=spectrum_scans.categories)
+    ms1_results["index"] = np.repeat(np.array(all_spectrum_index, dtype=np.int64), peak_counts)
 
     msn_results = {}
     msn_results["precursor_mz"] = all_msn_mz
@@ -153,7 +248,7 @@ def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=
 
     # Adding polarity
     if include_polarity is True:
-        ms1_results["polarity"] = all_polarity
+        ms1_results["polarity"] = np.repeat(np.array(all_spectrum_polarity, dtype=np.int64), peak_counts)
         msn_results["polarity"] = all_msn_polarity
 
     ms1_results = pd.DataFrame(ms1_results)
@@ -161,62 +256,218 @@ def _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=
 
     return ms1_results, number_spectra, msn_results
 
-def _get_feather_filenames(filename):
-    output_ms1_filename = filename + ".ms1.feather"
-    output_msn_filename = filename + ".msn.feather"
+def _gather_lcms_shard(filename, start, end, first_spectrum_number, use_scans):
+    # All peaks of the spectra at positions start to end of the scan index, run in a worker process
+    spectra = scan_index.spectrum_range_generator(filename, start, end)
+
+    return _gather_lcms_spectra(spectra, 0, 1000000, 0, 10000, polarity_filter="None", top_spectrum_peaks=100000, include_polarity=True, use_scans=use_scans, first_spectrum_number=first_spectrum_number, min_intensity=0)
+
+def _merge_lcms_shards(shard_results):
+    all_ms1_results = [ms1_results for ms1_results, number_spectra, msn_results in shard_results]
+    all_msn_results = [msn_results for ms1_results, number_spectra, msn_results in shard_results]
+
+    # Keeping the scans dictionary encoded across shards
+    scan_categoricals = [ms1_results["scan"] for ms1_results in all_ms1_results if len(ms1_results) > 0]
+    merged_scans = union_categoricals(scan_categoricals) if len(scan_categoricals) > 0 else pd.Categorical([])
+
+    ms1_results = pd.concat([ms1_results.drop(columns=["scan"]) for ms1_results in all_ms1_results], ignore_index=True)
+    ms1_results["scan"] = merged_scans
+    msn_results = pd.concat(all_msn_results, ignore_index=True)
+
+    return ms1_results, msn_results
+
+@contextmanager
+def _allow_child_processes():
+    """
+    Celery prefork workers are daemonic processes, which multiprocessing doesn't let start children. The pool is always
+    shut down and joined before we leave, so its processes can't outlive the task.
+    """
+
+    current_process = multiprocessing.current_process()
+    was_daemon = current_process.daemon
+
+    if was_daemon:
+        current_process._config["daemon"] = False
+
+    try:
+        yield
+    finally:
+        if was_daemon:
+            current_process._config["daemon"] = True
+
+def _iterate_lcms_shards(filename, processes=STORE_BUILD_PROCESSES, shard_spectra=STORE_BUILD_SHARD_SPECTRA):
+    """
+    Reads every peak of the file in shards of the scan index, seeking through the byte offsets in a pool of processes
+
+    Args:
+        filename (str): local mzML filename, with a scan index that has offsets
+        processes (int, optional): worker processes. Defaults to STORE_BUILD_PROCESSES.
+        shard_spectra (int, optional): spectra per shard. Defaults to STORE_BUILD_SHARD_SPECTRA.
+
+    Yields:
+        tuple: gathered results of a shard and the number of spectra it covers, in file order
+    """
+
+    scans_df = scan_index.load_scan_index(filename)
+    number_scans = len(scans_df)
+
+    # Checking the first spectrum to see if we should use scans or nativeIDs
+    use_scans = True
+    for spec in scan_index.spectrum_range_generator(filename, 0, 1):
+        use_scans = "scan" in spec.id_dict
+
+    # Enough shards to keep every process busy
+    number_shards = max(processes, int(np.ceil(number_scans / shard_spectra)), 1)
+    shard_boundaries = np.unique(np.linspace(0, number_scans, number_shards + 1).astype(int))
+
+    # MS1 numbering continues across shards
+    ms1_before = np.r_[0, np.cumsum(scans_df["ms_level"].values == 1)]
+
+    shard_arguments = []
+    for start, end in zip(shard_boundaries[:-1], shard_boundaries[1:]):
+        shard_arguments.append((filename, int(start), int(end), int(ms1_before[start]) + 1, use_scans))
+
+    if processes > 1 and len(shard_arguments) > 1:
+        with _allow_child_processes(), ProcessPoolExecutor(max_workers=processes) as executor:
+            # Results come back in order, as soon as each shard is done
+            for arguments, shard_result in zip(shard_arguments, executor.map(_gather_lcms_shard, *zip(*shard_arguments))):
+                yield shard_result, arguments[2] - arguments[1]
+    else:
+        for arguments in shard_arguments:
+            yield _gather_lcms_shard(*arguments), arguments[2] - arguments[1]
+
+def _iterate_lcms_batches(filename, batch_spectra=STORE_PUBLISH_SPECTRA):
+    """
+    Reads every peak of the file in a single sequential pass, a batch of spectra at a time
+
+    Yields:
+        tuple: gathered results of a batch and the number of spectra it covers, in file order
+    """
+
+    spectra = _spectrum_generator(filename, 0, 1000000)
+
+    use_scans = True
+    number_ms1 = 0
+    while True:
+        batch = list(itertools.islice(spectra, batch_spectra))
+        if len(batch) == 0:
+            break
+
+        # Checking the first spectrum to see if we should use scans or nativeIDs
+        if number_ms1 == 0:
+            use_scans = "scan" in batch[0].id_dict
+
+        batch_result = _gather_lcms_spectra(batch, 0, 1000000, 0, 10000, polarity_filter="None", top_spectrum_peaks=100000, include_polarity=True, use_scans=use_scans, first_spectrum_number=number_ms1 + 1, min_intensity=0)
+        number_ms1 += batch_result[1]
+
+        yield batch_result, len(batch)
+
+def _gather_lcms_data_parallel(filename, processes=STORE_BUILD_PROCESSES, shard_spectra=STORE_BUILD_SHARD_SPECTRA):
+    """
+    Reads every peak of the file with _iterate_lcms_shards
+
+    Returns:
+        tuple: ms1 peaks dataframe and msn precursors dataframe, numbered the same as a single pass
+    """
 
-    return output_ms1_filename, output_msn_filename
+    shard_results = [shard_result for shard_result, shard_spectra_count in _iterate_lcms_shards(filename, processes=processes, shard_spectra=shard_spectra)]
+
+    return _merge_lcms_shards(shard_results)
+
+def _publish_lcms_batches(filename, manifest, batches):
+    # Appending to the store whenever we have a chunk worth of peaks, so the early part of the run is queryable right away
+    pending_results = []
+    pending_peaks = 0
+    spectra_ingested = 0
+
+    for batch_result, batch_spectra_count in batches:
+        pending_results.append(batch_result)
+        pending_peaks += len(batch_result[0])
+        spectra_ingested += batch_spectra_count
+
+        if pending_peaks >= lcms_store.STORE_CHUNK_PEAKS:
+            ms1_results, msn_results = _merge_lcms_shards(pending_results)
+            lcms_store.append_store(filename, manifest, ms1_results, msn_results, spectra_ingested=spectra_ingested)
+
+            pending_results = []
+            pending_peaks = 0
+
+    if len(pending_results) > 0:
+        ms1_results, msn_results = _merge_lcms_shards(pending_results)
+        lcms_store.append_store(filename, manifest, ms1_results, msn_results, spectra_ingested=spectra_ingested)
 
 # These are caching layers for fast loading
 def _save_lcms_data_feather(filename):
-    output_ms1_filename, output_msn_filename = _get_feather_filenames(filename)
-    
-    ms1_results, number_spectra, msn_results = _gather_lcms_data(filename, 0, 1000000, 0, 10000, polarity_filter="None", top_spectrum_peaks=100000, include_polarity=True)
-    ms1_results = ms1_results.sort_values(by='i', ascending=False).reset_index()
+    spectra_total = None
+    if scan_index.scan_index_exists(filename):
+        spectra_total = len(scan_index.load_scan_index(filename))
 
-    ms1_results.to_feather(output_ms1_filename)
-    msn_results.to_feather(output_msn_filename)
+    # Sharded over processes when we can seek through the file, a single sequential pass is faster on one core
+    if STORE_BUILD_PROCESSES > 1 and scan_index.scan_index_exists(filename) and scan_index.has_offsets(filename):
+        try:
+            start_time = time.time()
+            manifest = lcms_store.begin_store(filename, spectra_total=spectra_total)
+            _publish_lcms_batches(filename, manifest, _iterate_lcms_shards(filename))
+            lcms_store.finish_store(filename, manifest)
+            print("PARALLEL GATHER", STORE_BUILD_PROCESSES, "processes", time.time() - start_time)
 
-def _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None"):
-    ms1_filename, msn_filename = _get_feather_filenames(filename)
+            return
+        except:
+            print("PARALLEL GATHER FAILED, READING SEQUENTIALLY")
+            traceback.print_exc()
+
+    manifest = lcms_store.begin_store(filename, spectra_total=spectra_total)
+    _publish_lcms_batches(filename, manifest, _iterate_lcms_batches(filename))
+    lcms_store.finish_store(filename, manifest)
+
+def _top_spectrum_peaks(ms1_results, top_spectrum_peaks):
+    # Most intense peaks per spectrum, without a groupby
+    spectrum_index = ms1_results["index"].values
+    order = np.lexsort((-ms1_results["i"].values, spectrum_index))
+    sorted_index = spectrum_index[order]
+
+    spectrum_starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+    spectrum_lengths = np.diff(np.r_[spectrum_starts, len(sorted_index)])
+    position_in_spectrum = np.arange(len(order)) - np.repeat(spectrum_starts, spectrum_lengths)
+
+    return ms1_results.iloc[order[position_in_spectrum < top_spectrum_peaks]].reset_index(drop=True)
+
+def _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", top_spectrum_peaks=100):
+    # We don't see the store, so lets just do the classic thing
+    if not lcms_store.store_exists(filename):
+        print("STORE NOT PRESENT")
+        return _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, top_spectrum_peaks=top_spectrum_peaks)
+    else:
+        print("STORE PRESENT")
+
+    # Reading only the chunks that overlap the window
+    if lcms_store.has_rank(filename) and lcms_store.covers_mz_range(filename, min_mz, max_mz):
+        # The stored ranks are the ranks within the window, so the top peaks are a single predicate,
+        # the peaks too faint for the map rank below all the others so they can be dropped afterwards
+        ms1_results = lcms_store.query_ms1(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, max_rank=top_spectrum_peaks)
+        ms1_results = ms1_results[ms1_results["i"] >= lcms_store.MAP_MIN_INTENSITY].reset_index(drop=True)
+    else:
+        ms1_results = lcms_store.query_ms1(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+        ms1_results = ms1_results[ms1_results["i"] >= lcms_store.MAP_MIN_INTENSITY].reset_index(drop=True)
+        ms1_results = _top_spectrum_peaks(ms1_results, top_spectrum_peaks)
 
-    delta_rt = max_rt - min_rt
+    msn_results = lcms_store.query_msn(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
 
-    # We don't see the feather files, so lets just do the classic thing
-    if not os.path.exists(ms1_filename) or delta_rt < 1:
-        print("FEATHER NOT PRESENT")
-        return _gather_lcms_data(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
-    else:
-        print("FEATHER PRESENT")
-
-    # Reading and filtering data
-    ms1_results = pd.read_feather(ms1_filename)
-    ms1_results = ms1_results[(ms1_results["rt"] > min_rt) & (ms1_results["rt"] < max_rt) & (ms1_results["mz"] > min_mz) & (ms1_results["mz"] < max_mz)]
-    if polarity_filter == "Positive":
-        ms1_results = ms1_results[ms1_results["polarity"] == POLARITY_POS]
-    elif polarity_filter == "Negative":
-        ms1_results = ms1_results[ms1_results["polarity"] == POLARITY_NEG] 
-    ms1_results = ms1_results.groupby('scan').head(100).reset_index(drop=True) # Getting the top 100 peaks per scan
-
-    msn_results = pd.read_feather(msn_filename)
-    msn_results = msn_results[(msn_results["rt"] > min_rt) & (msn_results["rt"] < max_rt) & (msn_results["precursor_mz"] > min_mz) & (msn_results["precursor_mz"] < max_mz)]
-    if polarity_filter == "Positive":
-        msn_results = msn_results[msn_results["polarity"] == POLARITY_POS]
-    elif polarity_filter == "Negative":
-        msn_results = msn_results[msn_results["polarity"] == POLARITY_NEG] 
-
-    number_spectra = len(set(ms1_results["scan"]))
+    number_spectra = ms1_results["index"].nunique()
 
     return ms1_results, number_spectra, msn_results
 
-def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium"):
-    import time
-    start_time = time.time()
-    ms1_results, number_spectra, msn_results = _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
-    end_time = time.time()
-    print("READ FILE", end_time - start_time)
+def _determine_map_size(number_spectra, min_mz, max_mz, map_plot_quantization_level="Medium", map_viewport=None, size_scale=1):
+    # Targeting the raster that is actually displayed, in device pixels
+    if map_viewport is not None:
+        try:
+            pixel_scale = MAP_QUANTIZATION_PIXEL_SCALE.get(map_plot_quantization_level, 1) * float(map_viewport.get("pixel_ratio", 1)) / size_scale
+            width = int(float(map_viewport["width"]) * pixel_scale)
+            height = int(float(map_viewport["height"]) * pixel_scale)
 
-    start_time = time.time()
+            return min(max(width, MAP_MIN_PIXELS), MAP_MAX_PIXELS), min(max(height, MAP_MIN_PIXELS), MAP_MAX_PIXELS)
+        except:
+            print("INVALID VIEWPORT", map_viewport)
 
     min_size = min(number_spectra, int(max_mz - min_mz))
     width = max(min(min_size*4, 500), 20)
@@ -233,33 +484,366 @@ def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filte
         width = int(width * 2)
         height = int(height * 2)
 
-    print("Datashader Len", len(ms1_results))
+    if size_scale != 1:
+        width = max(int(width / size_scale), MAP_MIN_PIXELS)
+        height = max(int(height / size_scale), MAP_MIN_PIXELS)
+
+    return width, height
+
+def _aggregate_lcms_map_tiles(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", map_viewport=None, size_scale=1, top_spectrum_peaks=100, array_loader=lcms_tiles._load_npy_arrays):
+    if not lcms_tiles.tiles_exist(filename):
+        return None
+
+    number_spectra = lcms_tiles.count_spectra(filename, min_rt, max_rt, polarity_filter=polarity_filter, array_loader=array_loader)
+    width, height = _determine_map_size(number_spectra, min_mz, max_mz, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, size_scale=size_scale)
+
+    agg = lcms_tiles.aggregate_map(filename, min_rt, max_rt, min_mz, max_mz, width, height, polarity_filter=polarity_filter, top_spectrum_peaks=top_spectrum_peaks, array_loader=array_loader)
+    if agg is None:
+        return None
+
+    msn_results = lcms_store.query_msn(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter)
+
+    return agg, msn_results
 
-    cvs = ds.Canvas(plot_width=width, plot_height=height)
-    agg = cvs.points(ms1_results,'rt','mz', agg=ds.sum("i"))
+def _decimate_msn_markers(msn_results, rt_range, mz_range, width, height, detail_threshold=MSN_MARKER_DETAIL_THRESHOLD, cell_pixels=MSN_MARKER_CELL_PIXELS):
+    """
+    Keeps one marker per screen cell and MS level once there are too many to draw individually
+
+    Args:
+        msn_results (pd.DataFrame): MSn markers sorted by rt
+        rt_range (tuple): rt extent of the map
+        mz_range (tuple): mz extent of the map
+        width (int): map raster width
+        height (int): map raster height
+        detail_threshold (int, optional): most markers that are drawn individually. Defaults to MSN_MARKER_DETAIL_THRESHOLD.
+        cell_pixels (int, optional): cell size in raster pixels. Defaults to MSN_MARKER_CELL_PIXELS.
+
+    Returns:
+        pd.DataFrame: the markers drawn, with a count column of the markers each one stands for
+    """
+
+    if len(msn_results) <= detail_threshold:
+        msn_results = msn_results.reset_index(drop=True)
+        msn_results["count"] = np.ones(len(msn_results), dtype=np.int64)
+        return msn_results
+
+    rt_cells = max(int(width) // cell_pixels, 1)
+    mz_cells = max(int(height) // cell_pixels, 1)
+
+    rt_span = max(float(rt_range[1]) - float(rt_range[0]), 1e-9)
+    mz_span = max(float(mz_range[1]) - float(mz_range[0]), 1e-9)
+    rt_cell = np.clip(((msn_results["rt"].values - float(rt_range[0])) / rt_span * rt_cells).astype(np.int64), 0, rt_cells - 1)
+    mz_cell = np.clip(((msn_results["precursor_mz"].values - float(mz_range[0])) / mz_span * mz_cells).astype(np.int64), 0, mz_cells - 1)
+
+    cell = (msn_results["level"].values.astype(np.int64) * mz_cells + mz_cell) * rt_cells + rt_cell
+
+    # The earliest marker in each cell represents it
+    cell_order = np.argsort(cell, kind="stable")
+    unique_cells, first_positions, cell_counts = np.unique(cell[cell_order], return_index=True, return_counts=True)
+    representative_order = np.argsort(cell_order[first_positions], kind="stable")
+
+    decimated_results = msn_results.iloc[cell_order[first_positions][representative_order]].reset_index(drop=True)
+    decimated_results["count"] = cell_counts[representative_order].astype(np.int64)
+
+    return decimated_results
+
+def _aggregate_lcms_map_grid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", top_spectrum_peaks=None, map_viewport=None, coarse=False, tiles_only=False, array_loader=lcms_tiles._load_npy_arrays):
+    import time
+    start_time = time.time()
+
+    if top_spectrum_peaks is None:
+        top_spectrum_peaks = MAP_TOP_SPECTRUM_PEAKS.get(map_plot_quantization_level, 100)
+
+    # The coarse map is drawn in the web process, so it only ever reads the tiles, never the raw peaks
+    size_scale = 1
+    if coarse:
+        tiles_only = True
+        size_scale = MAP_COARSE_SCALE
+        top_spectrum_peaks = min(top_spectrum_peaks, MAP_COARSE_SPECTRUM_PEAKS)
+
+    if tiles_only and not lcms_tiles.tiles_exist(filename):
+        return None
+
+    # Trying the pre-aggregated tiles first, they cover everything but the deepest zoom
+    tiles_result = None
+    try:
+        tiles_result = _aggregate_lcms_map_tiles(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, size_scale=size_scale, top_spectrum_peaks=top_spectrum_peaks, array_loader=array_loader)
+    except:
+        print("TILES FAILED")
+        traceback.print_exc()
+
+    # Past the deepest level the refined map has to go back to the raw peaks on the compute queue
+    if tiles_result is None and tiles_only:
+        return None
+
+    if tiles_result is not None:
+        agg, msn_results = tiles_result
+        print("TILES Agg", time.time() - start_time)
+    else:
+        ms1_results, number_spectra, msn_results = _gather_lcms_data_cached(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, top_spectrum_peaks=top_spectrum_peaks)
+        end_time = time.time()
+        print("READ FILE", end_time - start_time)
+
+        start_time = time.time()
+
+        width, height = _determine_map_size(number_spectra, min_mz, max_mz, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport, size_scale=size_scale)
+
+        print("Datashader Len", len(ms1_results))
+
+        cvs = ds.Canvas(plot_width=width, plot_height=height)
+        agg = cvs.points(ms1_results,'rt','mz', agg=ds.sum("i"))
+
+        print("Datashader Agg", time.time() - start_time)
 
-    print("Datashader Agg", time.time() - start_time)
     start_time = time.time()
 
     zero_mask = agg.values == 0
     agg.values = np.log10(agg.values, where=np.logical_not(zero_mask))
-    agg_dict = agg.to_dict()
 
     print("Datashader Post Processing", time.time() - start_time)
 
-    return agg_dict, msn_results
+    # Binning the markers against the same raster, so dense runs don't send every precursor
+    start_time = time.time()
+    rt_range = agg.attrs.get("x_range", (min_rt, max_rt))
+    mz_range = agg.attrs.get("y_range", (min_mz, max_mz))
+    msn_results = _decimate_msn_markers(msn_results, rt_range, mz_range, agg.shape[1], agg.shape[0])
+
+    print("MSn Markers", len(msn_results), time.time() - start_time)
+
+    return agg, msn_results
+
+def _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", top_spectrum_peaks=None, map_viewport=None):
+    agg, msn_results = _aggregate_lcms_map_grid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, top_spectrum_peaks=top_spectrum_peaks, map_viewport=map_viewport)
 
+    return agg.to_dict(), msn_results
+
+def _pack_arrays(arrays, metadata):
+    """
+    Lays out arrays back to back after a small json header, so that they can be read back without parsing
+
+    Args:
+        arrays (dict): name to numpy array, object and categorical arrays are stored as newline joined utf-8 strings
+        metadata (dict): json serializable extras
+
+    Returns:
+        bytes: the packed buffer
+    """
+
+    all_entries = []
+    all_buffers = []
+    data_offset = 0
+    for name in arrays:
+        values = arrays[name]
+
+        entry = {"name": name}
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            entry["kind"] = "strings"
+            entry["count"] = len(values)
+            buffer = "\n".join([str(value) for value in values]).encode("utf-8")
+        else:
+            values = np.ascontiguousarray(values)
+            entry["kind"] = "array"
+            entry["dtype"] = values.dtype.str
+            entry["shape"] = list(values.shape)
+            buffer = values.tobytes()
+
+        entry["offset"] = data_offset
+        entry["nbytes"] = len(buffer)
+        padding = -len(buffer) % AGGREGATION_ALIGNMENT
+
+        all_entries.append(entry)
+        all_buffers.append(buffer)
+        all_buffers.append(b"\0" * padding)
+        data_offset += len(buffer) + padding
+
+    header = json.dumps({"arrays": all_entries, "metadata": metadata}).encode("utf-8")
+    header += b" " * (-len(header) % AGGREGATION_ALIGNMENT)
+
+    return b"".join([AGGREGATION_MAGIC, np.uint64(len(header)).tobytes(), header] + all_buffers)
+
+def _unpack_arrays(buffer):
+    """
+    Reads back a buffer from _pack_arrays, numeric arrays are views on the buffer, nothing is copied
+
+    Returns:
+        tuple: (dict of arrays, metadata dict)
+    """
+
+    buffer = memoryview(buffer).cast("B")
+    if bytes(buffer[:len(AGGREGATION_MAGIC)]) != AGGREGATION_MAGIC:
+        raise Exception("Not a packed aggregation")
+
+    header_start = len(AGGREGATION_MAGIC) + 8
+    header_length = int(np.frombuffer(buffer, dtype=np.uint64, count=1, offset=len(AGGREGATION_MAGIC))[0])
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode("utf-8"))
+    data_start = header_start + header_length
+
+    arrays = {}
+    for entry in header["arrays"]:
+        start = data_start + entry["offset"]
+        if entry["kind"] == "strings":
+            if entry["count"] == 0:
+                arrays[entry["name"]] = np.array([], dtype=object)
+            else:
+                arrays[entry["name"]] = np.array(bytes(buffer[start:start + entry["nbytes"]]).decode("utf-8").split("\n"), dtype=object)
+        else:
+            dtype = np.dtype(entry["dtype"])
+            count = int(np.prod(entry["shape"], dtype=np.int64))
+            arrays[entry["name"]] = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).reshape(entry["shape"])
+
+    return arrays, header["metadata"]
+
+def _encode_aggregation(agg, msn_results):
+    """
+    Packs the map grid and the MSn marker table into one base64 string, which goes through the json result backend as is
+
+    Args:
+        agg (xarray.DataArray): log scaled map grid
+        msn_results (pd.DataFrame): MSn markers
+
+    Returns:
+        str: base64 encoded buffer
+    """
+
+    arrays = {}
+
+    # Log scaled intensities for coloring, single precision is plenty
+    arrays["agg"] = agg.values.astype(np.float32)
+    for coord in agg.dims:
+        arrays["coords/" + coord] = agg.coords[coord].values
+
+    for column in msn_results.columns:
+        arrays["msn/" + str(column)] = msn_results[column].values
+
+    metadata = {}
+    metadata["dims"] = list(agg.dims)
+    metadata["name"] = agg.name
+    metadata["attrs"] = json.loads(json.dumps(agg.attrs, default=lambda value: np.asarray(value).tolist()))
+    metadata["msn_columns"] = [str(column) for column in msn_results.columns]
+
+    return base64.b64encode(_pack_arrays(arrays, metadata)).decode("ascii")
+
+def _decode_aggregation(payload):
+    """
+    Unpacks _encode_aggregation output, either the base64 string or the raw buffer
+
+    Returns:
+        tuple: (xarray.DataArray, pd.DataFrame) backed by the buffer
+    """
+
+    if isinstance(payload, str):
+        payload = base64.b64decode(payload)
+
+    arrays, metadata = _unpack_arrays(payload)
+
+    coords = {coord: arrays["coords/" + coord] for coord in metadata["dims"]}
+    agg = xarray.DataArray(arrays["agg"], coords=coords, dims=metadata["dims"], attrs=metadata["attrs"], name=metadata["name"])
+
+    msn_results = pd.DataFrame({column: arrays["msn/" + column] for column in metadata["msn_columns"]}, columns=metadata["msn_columns"], copy=False)
+
+    return agg, msn_results
+
+
+def _map_image_extent(agg, dim, attr_range):
+    # Coordinates are bin centers, the image spans the bin edges
+    centers = agg.coords[dim].values
+    if len(centers) < 2:
+        return tuple(agg.attrs.get(attr_range, (centers[0] - 0.5, centers[0] + 0.5)))
+
+    half_step = (centers[-1] - centers[0]) / (len(centers) - 1) / 2
+    return centers[0] - half_step, centers[-1] + half_step
+
+def _shade_map_image(agg, color_scale="Hot_r"):
+    """
+    Shades the log scaled grid into a png, with empty cells left transparent
+
+    Args:
+        agg (xarray.DataArray): log scaled grid with dims (mz, rt)
+        color_scale (str, optional): plotly color scale name. Defaults to "Hot_r".
+
+    Returns:
+        tuple: (png data uri, color min, color max)
+    """
+    from PIL import Image
+
+    values = np.asarray(agg.values, dtype=np.float64)
+    filled = np.isfinite(values)
+
+    color_min, color_max = 0.0, 1.0
+    if filled.any():
+        color_min, color_max = float(values[filled].min()), float(values[filled].max())
+
+    all_colors = plotly.colors.sample_colorscale(plotly.colors.get_colorscale(color_scale), list(np.linspace(0, 1, MAP_IMAGE_COLORS)))
+    color_table = np.full((MAP_IMAGE_COLORS, 4), 255, dtype=np.uint8)
+    color_table[:, :3] = np.round([plotly.colors.unlabel_rgb(color) for color in all_colors])
+
+    color_position = np.zeros(values.shape, dtype=np.int64)
+    if color_max > color_min:
+        color_position[filled] = np.round((values[filled] - color_min) / (color_max - color_min) * (MAP_IMAGE_COLORS - 1))
+
+    image = color_table[color_position]
+    image[~filled, 3] = 0
+
+    # Rows go up in mz, images go down
+    image_bytes = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(image[::-1]), "RGBA").save(image_bytes, format="PNG")
+    image_uri = "data:image/png;base64," + base64.b64encode(image_bytes.getvalue()).decode("ascii")
+
+    return image_uri, color_min, color_max
+
+def _create_map_image_fig(agg, color_scale="Hot_r", template="plotly_white"):
+    image_uri, color_min, color_max = _shade_map_image(agg, color_scale=color_scale)
+    min_rt, max_rt = _map_image_extent(agg, "rt", "x_range")
+    min_mz, max_mz = _map_image_extent(agg, "mz", "y_range")
+
+    # The first trace stays the MS1 trace for clicks, so it holds the most intense cells
+    values = np.asarray(agg.values, dtype=np.float64)
+    filled_positions = np.flatnonzero(np.isfinite(values))
+    if len(filled_positions) > MAP_IMAGE_HOVER_POINTS:
+        filled_positions = filled_positions[np.argpartition(-values.ravel()[filled_positions], MAP_IMAGE_HOVER_POINTS)[:MAP_IMAGE_HOVER_POINTS]]
+    mz_positions, rt_positions = np.unravel_index(filled_positions, values.shape)
+
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=agg.coords["rt"].values[rt_positions], 
+                                y=agg.coords["mz"].values[mz_positions], 
+                                mode='markers', 
+                                marker=dict(color=values.ravel()[filled_positions], coloraxis="coloraxis", opacity=0),
+                                hovertemplate="rt: %{x}<br>mz: %{y}<br>Log10(abundance): %{marker.color:.2f}<extra></extra>",
+                                showlegend=False))
+
+    fig.add_layout_image(source=image_uri, xref="x", yref="y", x=min_rt, y=max_mz, sizex=max_rt - min_rt, sizey=max_mz - min_mz, sizing="stretch", xanchor="left", yanchor="top", layer="below")
+
+    fig.update_layout(coloraxis=dict(colorscale=color_scale, cmin=color_min, cmax=color_max), height=600, template=template)
+    fig.update_xaxes(title="rt", range=[min_rt, max_rt], showgrid=False, zeroline=False)
+    fig.update_yaxes(title="mz", showgrid=False, zeroline=False)
+
+    return fig
+
+def _msn_marker_hover(msn_results):
+    # Binned markers say how many scans they stand for, zoom in to see them all
+    if "count" not in msn_results or (msn_results["count"] <= 1).all():
+        return {}
+
+    return dict(text=msn_results["count"], hovertemplate="rt: %{x}<br>precursor mz: %{y}<br>scan: %{customdata}<br>scans in this area: %{text}")
 
 # Creates the figure for map plot
 # overlay_data is a dataframe that includes the overlay, rt and mz are the expected columns
-def _create_map_fig(agg_dict, msn_results, map_selection=None, show_ms2_markers=True, polarity_filter="None", highlight_box=None, color_scale="Hot_r", template="plotly_white", ms2marker_color="blue", ms2marker_size=5):
+def _create_map_fig(agg_dict, msn_results, map_selection=None, show_ms2_markers=True, polarity_filter="None", highlight_box=None, color_scale="Hot_r", template="plotly_white", ms2marker_color="blue", ms2marker_size=5, render_mode="Heatmap"):
     min_rt, max_rt, min_mz, max_mz = utils._determine_rendering_bounds(map_selection)
     
-    agg = xarray.DataArray.from_dict(agg_dict)
+    # Decoded aggregations are already arrays
+    if isinstance(agg_dict, xarray.DataArray):
+        agg = agg_dict
+    else:
+        agg = xarray.DataArray.from_dict(agg_dict)
 
     # Creating the figures
-    fig = px.imshow(agg, origin='lower', labels={'color':'Log10(abundance)'}, color_continuous_scale=color_scale, height=600, template=template)
-    fig.update_traces(hoverongaps=False)
+    if render_mode == "Image":
+        # Shaded on the server, so the browser gets a png instead of the whole grid
+        fig = _create_map_image_fig(agg, color_scale=color_scale, template=template)
+    else:
+        fig = px.imshow(agg, origin='lower', labels={'color':'Log10(abundance)'}, color_continuous_scale=color_scale, height=600, template=template)
+        fig.update_traces(hoverongaps=False)
     fig.update_layout(coloraxis_colorbar=dict(title='Abundance', tickprefix='1.e'))
 
     fig.update_yaxes(showline=True, linewidth=1, linecolor='black', gridwidth=3, range=[min_mz, max_mz])
@@ -280,11 +864,11 @@ def _create_map_fig(agg_dict, msn_results, map_selection=None, show_ms2_markers=
        too_many_ms2 = True
     
     if show_ms2_markers is True and too_many_ms2 is False and len(ms2_results) > 0:
-        scatter_fig = go.Scattergl(x=ms2_results["rt"], y=ms2_results["precursor_mz"], mode='markers', customdata=ms2_results["scan"], marker=dict(color=ms2marker_color, size=ms2marker_size, symbol="x"), name="MS2s")
+        scatter_fig = go.Scattergl(x=ms2_results["rt"], y=ms2_results["precursor_mz"], mode='markers', customdata=ms2_results["scan"], marker=dict(color=ms2marker_color, size=ms2marker_size, symbol="x"), name="MS2s", **_msn_marker_hover(ms2_results))
         fig.add_trace(scatter_fig)
 
     if show_ms2_markers is True and too_many_ms2 is False and len(ms3_results) > 0:
-        scatter_ms3_fig = go.Scatter(x=ms3_results["rt"], y=ms3_results["precursor_mz"], mode='markers', customdata=ms3_results["scan"], marker=dict(color='green', size=ms2marker_size, symbol="x"), name="MS3s")
+        scatter_ms3_fig = go.Scatter(x=ms3_results["rt"], y=ms3_results["precursor_mz"], mode='markers', customdata=ms3_results["scan"], marker=dict(color='green', size=ms2marker_size, symbol="x"), name="MS3s", **_msn_marker_hover(ms3_results))
         fig.add_trace(scatter_ms3_fig)
 
     if highlight_box is not None:
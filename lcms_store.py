@@ -0,0 +1,576 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+# Enum for polarity, matching lcms_map
+POLARITY_POS = 1
+POLARITY_NEG = 2
+
+# Target number of peaks per RT chunk, chunks are always split on spectrum boundaries
+STORE_CHUNK_PEAKS = 500000
+
+# Bumped whenever the layout or dtypes of the store change, stores from other versions are rebuilt
+STORE_SCHEMA_VERSION = 6
+
+# The store keeps every peak with an intensity, so the XICs read from it sum the same peaks as the raw file,
+# the map only draws the peaks at or above this intensity
+MAP_MIN_INTENSITY = 1.0
+
+# Within a chunk, peaks are grouped by their intensity rank in the spectrum, so the top N peaks are a prefix of rows,
+# and are sorted by mz within each group, so an mz window is a slice of every group
+RANK_TIERS = [50, 100, 200]
+
+# A rebuild writes into a new build folder, the one it replaces is kept this long for queries that already loaded its manifest
+STORE_BUILD_GRACE_SECONDS = 600
+
+def _get_store_folder(filename):
+    return filename + ".lcmsstore"
+
+def _get_build_folder(filename):
+    # Folder of the build the manifest points to, the ion index and the tiles are built into it as well
+    return os.path.join(_get_store_folder(filename), load_manifest(filename)["build"])
+
+def _get_manifest_filename(filename):
+    return os.path.join(_get_store_folder(filename), "manifest.json")
+
+def load_manifest(filename):
+    with open(_get_manifest_filename(filename)) as manifest_file:
+        return json.load(manifest_file)
+
+def _store_schema_version(filename):
+    try:
+        return load_manifest(filename).get("schema_version", 1)
+    except:
+        return None
+
+def store_exists(filename):
+    # Only stores of the current schema count, older ones are treated as missing until they are rebuilt
+    if not os.path.exists(_get_manifest_filename(filename)):
+        return False
+
+    return _store_schema_version(filename) == STORE_SCHEMA_VERSION
+
+def store_outdated(filename):
+    if not os.path.exists(_get_manifest_filename(filename)):
+        return False
+
+    return _store_schema_version(filename) != STORE_SCHEMA_VERSION
+
+def _compact_ms1(ms1_results):
+    # Intensity and rt do not need double precision, mz does
+    compact_df = pd.DataFrame()
+    compact_df["mz"] = ms1_results["mz"].astype(np.float64)
+    compact_df["rt"] = ms1_results["rt"].astype(np.float32)
+    compact_df["i"] = ms1_results["i"].astype(np.float32)
+
+    # Dictionary encoded, the scan identifier is written once per spectrum
+    compact_df["scan"] = ms1_results["scan"].astype("category")
+    compact_df["index"] = ms1_results["index"].astype(np.int32)
+    compact_df["polarity"] = ms1_results["polarity"].astype(np.int8)
+    compact_df["rank"] = ms1_results["rank"].astype(np.int32)
+
+    return compact_df
+
+def _compact_msn(msn_results):
+    compact_df = pd.DataFrame()
+    compact_df["precursor_mz"] = msn_results["precursor_mz"].astype(np.float64)
+    compact_df["rt"] = msn_results["rt"].astype(np.float32)
+    compact_df["scan"] = msn_results["scan"].values
+    compact_df["level"] = msn_results["level"].astype(np.int8)
+    compact_df["polarity"] = msn_results["polarity"].astype(np.int8)
+
+    return compact_df
+
+def _write_table(df, output_filename):
+    # Uncompressed so that the chunks can be memory mapped at query time
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, output_filename, compression="uncompressed")
+
+def _read_table(input_filename, columns=None):
+    return feather.read_table(input_filename, columns=columns, memory_map=True)
+
+def _chunk_boundaries(spectrum_index, chunk_peaks):
+    """
+    Splits RT sorted peaks into chunks of roughly chunk_peaks rows, never splitting a spectrum across chunks
+
+    Args:
+        spectrum_index (np.array): spectrum index per peak, sorted by rt
+        chunk_peaks (int): target rows per chunk
+
+    Returns:
+        list: (start, end) row offsets per chunk
+    """
+
+    if len(spectrum_index) == 0:
+        return []
+
+    spectrum_starts = np.flatnonzero(np.r_[True, spectrum_index[1:] != spectrum_index[:-1]])
+    spectrum_starts = np.r_[spectrum_starts, len(spectrum_index)]
+
+    boundaries = []
+    chunk_start = 0
+    for spectrum_start in spectrum_starts[1:]:
+        if spectrum_start - chunk_start >= chunk_peaks or spectrum_start == len(spectrum_index):
+            boundaries.append((int(chunk_start), int(spectrum_start)))
+            chunk_start = spectrum_start
+
+    return boundaries
+
+def _spectrum_intensity_rank(spectrum_index, intensity):
+    """
+    Ranks every peak by intensity within its spectrum, 0 being the most intense
+
+    Args:
+        spectrum_index (np.array): spectrum index per peak
+        intensity (np.array): intensity per peak
+
+    Returns:
+        np.array: rank per peak
+    """
+
+    if len(spectrum_index) == 0:
+        return np.array([], dtype=np.int32)
+
+    order = np.lexsort((-intensity, spectrum_index))
+    sorted_index = spectrum_index[order]
+
+    spectrum_starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+    spectrum_lengths = np.diff(np.r_[spectrum_starts, len(sorted_index)])
+
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order)) - np.repeat(spectrum_starts, spectrum_lengths)
+
+    return rank
+
+def _publish_manifest(store_folder, manifest):
+    # Swapped in whole, so readers always see a consistent set of chunks
+    temp_manifest_filename = os.path.join(store_folder, "manifest.json.tmp")
+    with open(temp_manifest_filename, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    os.replace(temp_manifest_filename, os.path.join(store_folder, "manifest.json"))
+
+def remove_superseded_builds(store_folder, grace_seconds=STORE_BUILD_GRACE_SECONDS):
+    """
+    Removes what an older build left in the store folder, once nothing has touched it for grace_seconds
+
+    Args:
+        store_folder (str): store folder
+        grace_seconds (int, optional): age past which leftovers are removed. Defaults to STORE_BUILD_GRACE_SECONDS.
+    """
+
+    try:
+        with open(os.path.join(store_folder, "manifest.json")) as manifest_file:
+            current_build = json.load(manifest_file).get("build")
+    except:
+        return
+
+    for entry in os.listdir(store_folder):
+        if entry in ["manifest.json", "manifest.json.tmp", current_build]:
+            continue
+
+        entry_path = os.path.join(store_folder, entry)
+        try:
+            if time.time() - os.stat(entry_path).st_mtime < grace_seconds:
+                continue
+
+            print("REMOVING SUPERSEDED BUILD", entry_path)
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+        except:
+            pass
+
+def begin_store(filename, spectra_total=None):
+    """
+    Starts an empty store that is published chunk by chunk, replacing any existing store
+
+    The chunks go into a new build folder, the previous build stays on disk until remove_superseded_builds,
+    so queries that loaded the previous manifest can still read its chunks.
+
+    Args:
+        filename (str): local mzML filename
+        spectra_total (int, optional): spectra in the file, to report progress. Defaults to None.
+
+    Returns:
+        dict: the manifest, to be passed to append_store and finish_store
+    """
+
+    store_folder = _get_store_folder(filename)
+    build = "build-{}".format(uuid.uuid4().hex)
+    os.makedirs(os.path.join(store_folder, build))
+
+    # The grace period of what is there now starts when the new build replaces it
+    for entry in os.listdir(store_folder):
+        if entry != build:
+            os.utime(os.path.join(store_folder, entry))
+
+    manifest = {}
+    manifest["schema_version"] = STORE_SCHEMA_VERSION
+    manifest["build"] = build
+    manifest["chunks"] = []
+    manifest["msn_chunks"] = []
+    manifest["number_spectra"] = 0
+    manifest["rank_tiers"] = RANK_TIERS
+    manifest["complete"] = False
+    manifest["spectra_total"] = spectra_total
+    manifest["spectra_ingested"] = 0
+
+    _publish_manifest(store_folder, manifest)
+
+    remove_superseded_builds(store_folder)
+
+    return manifest
+
+def append_store(filename, manifest, ms1_results, msn_results, spectra_ingested=None, chunk_peaks=STORE_CHUNK_PEAKS):
+    """
+    Writes the peaks of a batch of whole spectra as new RT chunks and publishes them, so they can be queried right away
+
+    Args:
+        filename (str): local mzML filename
+        manifest (dict): manifest from begin_store
+        ms1_results (pd.DataFrame): peaks with mz, rt, i, scan, index and polarity columns
+        msn_results (pd.DataFrame): precursors with precursor_mz, rt, scan, level and polarity columns
+        spectra_ingested (int, optional): spectra read from the file so far. Defaults to None.
+        chunk_peaks (int, optional): target rows per chunk. Defaults to STORE_CHUNK_PEAKS.
+    """
+
+    store_folder = _get_store_folder(filename)
+
+    ms1_results = ms1_results.reset_index(drop=True)
+    ms1_results["rank"] = _spectrum_intensity_rank(ms1_results["index"].values, ms1_results["i"].values)
+    ms1_results = _compact_ms1(ms1_results.sort_values(by=["rt", "index"], kind="stable").reset_index(drop=True))
+
+    for start, end in _chunk_boundaries(ms1_results["index"].values, chunk_peaks):
+        chunk_df = ms1_results.iloc[start:end]
+
+        # Rank tiers first, mz order within each tier
+        chunk_tiers = np.searchsorted(RANK_TIERS, chunk_df["rank"].values, side="right")
+        tier_order = np.lexsort((chunk_df["mz"].values, chunk_tiers))
+        chunk_df = chunk_df.iloc[tier_order]
+        chunk_tiers = chunk_tiers[tier_order]
+
+        chunk_filename = os.path.join(manifest["build"], "ms1_{:05d}.feather".format(len(manifest["chunks"])))
+        _write_table(chunk_df, os.path.join(store_folder, chunk_filename))
+
+        chunk_stats = {}
+        chunk_stats["filename"] = chunk_filename
+        chunk_stats["rows"] = int(end - start)
+        chunk_stats["tier_rows"] = [int(tier_rows) for tier_rows in np.searchsorted(chunk_tiers, np.arange(len(RANK_TIERS)), side="right")]
+        chunk_stats["rt_min"] = float(chunk_df["rt"].min())
+        chunk_stats["rt_max"] = float(chunk_df["rt"].max())
+        chunk_stats["mz_min"] = float(chunk_df["mz"].min())
+        chunk_stats["mz_max"] = float(chunk_df["mz"].max())
+        manifest["chunks"].append(chunk_stats)
+
+    if len(msn_results) > 0:
+        msn_results = _compact_msn(msn_results.sort_values(by="rt", kind="stable").reset_index(drop=True))
+        msn_filename = os.path.join(manifest["build"], "msn_{:05d}.feather".format(len(manifest["msn_chunks"])))
+        _write_table(msn_results, os.path.join(store_folder, msn_filename))
+        manifest["msn_chunks"].append(msn_filename)
+
+    manifest["number_spectra"] += int(ms1_results["index"].nunique())
+    if spectra_ingested is not None:
+        manifest["spectra_ingested"] = int(spectra_ingested)
+
+    # The manifest goes last, it only lists chunks that are fully written
+    _publish_manifest(store_folder, manifest)
+
+def finish_store(filename, manifest):
+    manifest["complete"] = True
+    if manifest["spectra_total"] is not None:
+        manifest["spectra_ingested"] = manifest["spectra_total"]
+
+    _publish_manifest(_get_store_folder(filename), manifest)
+
+    remove_superseded_builds(_get_store_folder(filename))
+
+def build_store(filename, ms1_results, msn_results, chunk_peaks=STORE_CHUNK_PEAKS):
+    """
+    Writes the RT chunked store for a file in one go, replacing any existing store
+
+    Args:
+        filename (str): local mzML filename
+        ms1_results (pd.DataFrame): peaks with mz, rt, i, scan, index and polarity columns
+        msn_results (pd.DataFrame): precursors with precursor_mz, rt, scan, level and polarity columns
+        chunk_peaks (int, optional): target rows per chunk. Defaults to STORE_CHUNK_PEAKS.
+    """
+
+    manifest = begin_store(filename)
+    append_store(filename, manifest, ms1_results, msn_results, chunk_peaks=chunk_peaks)
+    finish_store(filename, manifest)
+
+def store_complete(filename):
+    if not store_exists(filename):
+        return False
+
+    return load_manifest(filename).get("complete", False)
+
+def store_progress(filename):
+    """
+    Fraction of the spectra in the file that are in the store
+
+    Returns:
+        float: between 0 and 1, or None when there is no store or the total is unknown
+    """
+
+    if not store_exists(filename):
+        return None
+
+    manifest = load_manifest(filename)
+    if manifest.get("complete", False):
+        return 1.0
+
+    if not manifest.get("spectra_total"):
+        return None
+
+    return min(manifest["spectra_ingested"] / manifest["spectra_total"], 1.0)
+
+def store_state(filename):
+    """
+    Short description of what the store holds, it changes whenever more of the file is published
+
+    Returns:
+        str: "none", "complete" or "partial-<spectra ingested>"
+    """
+
+    if not store_exists(filename):
+        return "none"
+
+    manifest = load_manifest(filename)
+    if manifest.get("complete", False):
+        return "complete"
+
+    return "partial-{}".format(manifest["spectra_ingested"])
+
+def _filter_polarity(table, polarity_filter):
+    if polarity_filter == "Positive":
+        return table.filter(pc.equal(table["polarity"], POLARITY_POS))
+    elif polarity_filter == "Negative":
+        return table.filter(pc.equal(table["polarity"], POLARITY_NEG))
+
+    return table
+
+def _rt_bounds(min_rt, max_rt):
+    # Rt is stored in single precision, comparing at that precision keeps the window inclusive
+    return float(np.float32(min_rt)), float(np.float32(max_rt))
+
+def _overlapping_chunks(manifest, min_rt, max_rt, min_mz, max_mz):
+    min_rt, max_rt = _rt_bounds(min_rt, max_rt)
+    return [chunk for chunk in manifest["chunks"] if chunk["rt_max"] >= min_rt and chunk["rt_min"] <= max_rt and chunk["mz_max"] >= min_mz and chunk["mz_min"] <= max_mz]
+
+def has_rank(filename):
+    return "rank_tiers" in load_manifest(filename)
+
+def covers_mz_range(filename, min_mz, max_mz):
+    """
+    Checks if an mz window includes every peak in the store, in which case the per spectrum ranks also hold within the window
+    """
+
+    manifest = load_manifest(filename)
+    if len(manifest["chunks"]) == 0:
+        return True
+
+    return min_mz <= min([chunk["mz_min"] for chunk in manifest["chunks"]]) and max_mz >= max([chunk["mz_max"] for chunk in manifest["chunks"]])
+
+def _tier_rows(manifest, chunk, max_rank):
+    # Rows of the chunk that can hold peaks ranked below max_rank
+    for tier_bound, tier_rows in zip(manifest["rank_tiers"], chunk["tier_rows"]):
+        if max_rank <= tier_bound:
+            return tier_rows
+
+    return chunk["rows"]
+
+def _tier_bounds(chunk, tier_rows=None):
+    # Row ranges of the rank tiers, the last range holds the peaks ranked past the deepest tier
+    tier_ends = chunk["tier_rows"] + [chunk["rows"]]
+    tier_starts = [0] + chunk["tier_rows"]
+
+    if tier_rows is None:
+        tier_rows = chunk["rows"]
+
+    return [(tier_start, min(tier_end, tier_rows)) for tier_start, tier_end in zip(tier_starts, tier_ends) if tier_start < tier_rows]
+
+def _mz_slices(mz_values, tier_bounds, lower_mz, upper_mz):
+    """
+    Finds the rows of every mz window in every tier with binary searches, the tiers are mz sorted
+
+    Args:
+        mz_values (np.array): mz of the chunk
+        tier_bounds (list): (start, end) rows of each tier
+        lower_mz (np.array): inclusive lower bound per window
+        upper_mz (np.array): inclusive upper bound per window
+
+    Returns:
+        tuple: start rows, end rows and window of each slice
+    """
+
+    all_starts = []
+    all_ends = []
+    all_windows = []
+    for tier_start, tier_end in tier_bounds:
+        tier_mz = mz_values[tier_start:tier_end]
+        all_starts.append(tier_start + np.searchsorted(tier_mz, lower_mz, side="left"))
+        all_ends.append(tier_start + np.searchsorted(tier_mz, upper_mz, side="right"))
+        all_windows.append(np.arange(len(lower_mz)))
+
+    if len(all_starts) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    return np.concatenate(all_starts), np.concatenate(all_ends), np.concatenate(all_windows)
+
+def query_ms1(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", columns=None, max_rank=None):
+    """
+    Reads the MS1 peaks inside the window, only touching the chunks whose statistics overlap it
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): inclusive lower rt bound
+        max_rt (float): inclusive upper rt bound
+        min_mz (float): inclusive lower mz bound
+        max_mz (float): inclusive upper mz bound
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+        columns (list, optional): columns to return, all when None. Defaults to None.
+        max_rank (int, optional): only peaks ranked below this within their spectrum, all when None. Defaults to None.
+
+    Returns:
+        pd.DataFrame: peaks within the window
+    """
+
+    manifest = load_manifest(filename)
+    store_folder = _get_store_folder(filename)
+    min_rt, max_rt = _rt_bounds(min_rt, max_rt)
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(list(columns) + ["rt", "mz", "polarity"] + (["rank"] if max_rank is not None else [])))
+
+    all_tables = []
+    for chunk in _overlapping_chunks(manifest, min_rt, max_rt, min_mz, max_mz):
+        table = _read_table(os.path.join(store_folder, chunk["filename"]), columns=read_columns)
+
+        # The top ranked peaks are a prefix of the chunk, and the mz window is a slice of each of its tiers
+        tier_bounds = _tier_bounds(chunk, _tier_rows(manifest, chunk, max_rank) if max_rank is not None else None)
+        if chunk["mz_min"] < min_mz or chunk["mz_max"] > max_mz:
+            slice_starts, slice_ends, slice_windows = _mz_slices(table["mz"].to_numpy(), tier_bounds, np.array([min_mz]), np.array([max_mz]))
+        else:
+            slice_starts = np.array([tier_start for tier_start, tier_end in tier_bounds])
+            slice_ends = np.array([tier_end for tier_start, tier_end in tier_bounds])
+        table = pa.concat_tables([table.slice(slice_start, slice_end - slice_start) for slice_start, slice_end in zip(slice_starts, slice_ends) if slice_end > slice_start] + [table.slice(0, 0)])
+
+        if max_rank is not None:
+            table = table.filter(pc.less(table["rank"], max_rank))
+
+        # Only paying for the rt mask when the chunk straddles the window
+        if chunk["rt_min"] < min_rt or chunk["rt_max"] > max_rt:
+            table = table.filter(pc.and_(pc.greater_equal(table["rt"], min_rt), pc.less_equal(table["rt"], max_rt)))
+
+        table = _filter_polarity(table, polarity_filter)
+
+        all_tables.append(table)
+
+    if len(all_tables) > 0:
+        ms1_results = pa.concat_tables(all_tables).to_pandas()
+    elif len(manifest["chunks"]) > 0:
+        # Keeping the dtypes even when nothing is in the window
+        ms1_results = _read_table(os.path.join(store_folder, manifest["chunks"][0]["filename"]), columns=read_columns).schema.empty_table().to_pandas()
+    else:
+        ms1_results = pd.DataFrame(columns=read_columns if read_columns is not None else ["mz", "rt", "i", "scan", "index", "polarity", "rank"])
+
+    if columns is not None:
+        ms1_results = ms1_results[list(columns)]
+
+    return ms1_results
+
+def query_msn(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None"):
+    manifest = load_manifest(filename)
+    store_folder = _get_store_folder(filename)
+    min_rt, max_rt = _rt_bounds(min_rt, max_rt)
+
+    all_tables = []
+    for msn_filename in manifest["msn_chunks"]:
+        table = _read_table(os.path.join(store_folder, msn_filename))
+
+        # Each part is sorted by rt, so the window is a slice and only it gets scanned for the precursor range
+        rt_values = table["rt"].to_numpy()
+        start = np.searchsorted(rt_values, min_rt, side="left")
+        end = np.searchsorted(rt_values, max_rt, side="right")
+
+        table = table.slice(start, max(end - start, 0))
+        table = table.filter(pc.and_(pc.greater_equal(table["precursor_mz"], min_mz), pc.less_equal(table["precursor_mz"], max_mz)))
+        table = _filter_polarity(table, polarity_filter)
+
+        all_tables.append(table)
+
+    if len(all_tables) == 0:
+        return pd.DataFrame(columns=["precursor_mz", "rt", "scan", "level", "polarity"])
+
+    return pa.concat_tables(all_tables).to_pandas()
+
+def query_ms1_windows(filename, min_rt, max_rt, lower_mz, upper_mz, ms1_index):
+    """
+    Sums the intensity of many mz windows per spectrum, every window is a few slices of the chunks, found by binary search
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): inclusive lower rt bound
+        max_rt (float): inclusive upper rt bound
+        lower_mz (np.array): inclusive lower mz bound per window
+        upper_mz (np.array): inclusive upper mz bound per window
+        ms1_index (np.array): index of the spectra to sum, they already satisfy the rt window and polarity, the rest are ignored
+
+    Returns:
+        np.array: summed intensity, one row per spectrum in ms1_index and one column per window
+    """
+
+    manifest = load_manifest(filename)
+    store_folder = _get_store_folder(filename)
+
+    lower_mz = np.asarray(lower_mz, dtype=np.float64)
+    upper_mz = np.asarray(upper_mz, dtype=np.float64)
+    ms1_index = np.asarray(ms1_index, dtype=np.int64)
+
+    number_windows = len(lower_mz)
+    number_spectra = len(ms1_index)
+    summed_intensity = np.zeros(number_spectra * number_windows, dtype=np.float64)
+
+    if number_windows == 0 or number_spectra == 0:
+        return summed_intensity.reshape(number_spectra, number_windows)
+
+    # Spectrum index to output row, -1 for spectra we were not asked about
+    spectrum_rows = np.full(int(ms1_index.max()) + 1, -1, dtype=np.int64)
+    spectrum_rows[ms1_index] = np.arange(number_spectra)
+
+    for chunk in _overlapping_chunks(manifest, min_rt, max_rt, float(lower_mz.min()), float(upper_mz.max())):
+        table = _read_table(os.path.join(store_folder, chunk["filename"]), columns=["mz", "i", "index"])
+
+        slice_starts, slice_ends, slice_windows = _mz_slices(table["mz"].to_numpy(), _tier_bounds(chunk), lower_mz, upper_mz)
+        slice_lengths = slice_ends - slice_starts
+
+        has_peaks = slice_lengths > 0
+        slice_starts = slice_starts[has_peaks]
+        slice_lengths = slice_lengths[has_peaks]
+        slice_windows = slice_windows[has_peaks]
+        if len(slice_lengths) == 0:
+            continue
+
+        # Rows of all the slices laid end to end
+        slice_offsets = np.cumsum(slice_lengths) - slice_lengths
+        peak_rows = np.arange(int(slice_lengths.sum())) - np.repeat(slice_offsets, slice_lengths) + np.repeat(slice_starts, slice_lengths)
+        peak_windows = np.repeat(slice_windows, slice_lengths)
+
+        peak_index = table["index"].to_numpy()[peak_rows]
+        peak_spectrum_rows = np.where(peak_index < len(spectrum_rows), spectrum_rows[np.minimum(peak_index, len(spectrum_rows) - 1)], -1)
+
+        wanted = peak_spectrum_rows >= 0
+        summed_intensity += np.bincount(peak_spectrum_rows[wanted] * number_windows + peak_windows[wanted], weights=table["i"].to_numpy()[peak_rows[wanted]], minlength=number_spectra * number_windows)
+
+    return summed_intensity.reshape(number_spectra, number_windows)
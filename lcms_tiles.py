@@ -0,0 +1,406 @@
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+import xarray
+import pyarrow.compute as pc
+
+import lcms_store
+
+# Enum for polarity, matching lcms_map
+POLARITY_POS = 1
+POLARITY_NEG = 2
+
+# Every level is cut into square tiles of this many bins, only non empty cells are kept
+TILE_SIZE = 256
+
+# Resolution of the deepest level, beyond this we go back to the raw peaks
+MAX_RT_BINS = 2048
+MAX_MZ_BINS = 8192
+
+# Level bins have to be this many times finer than the output bins
+LEVEL_OVERSAMPLING = 2
+
+# Bumped whenever the layout of the tiles changes, older tiles are rebuilt
+TILES_VERSION = 3
+
+def _get_tiles_folder(filename):
+    return os.path.join(lcms_store._get_build_folder(filename), "tiles")
+
+def _get_tiles_manifest_filename(filename):
+    return os.path.join(_get_tiles_folder(filename), "manifest.json")
+
+def load_tiles_manifest(filename):
+    with open(_get_tiles_manifest_filename(filename)) as manifest_file:
+        return json.load(manifest_file)
+
+def tiles_exist(filename):
+    # Tiles live inside the build of the store, and go away with it when the store is rebuilt
+    if not lcms_store.store_exists(filename) or not os.path.exists(_get_tiles_manifest_filename(filename)):
+        return False
+
+    try:
+        return load_tiles_manifest(filename).get("version") == TILES_VERSION
+    except:
+        return False
+
+def tiles_outdated(filename):
+    if not lcms_store.store_exists(filename) or not os.path.exists(_get_tiles_manifest_filename(filename)):
+        return False
+
+    return not tiles_exist(filename)
+
+def _tile_set_name(polarity_filter, top_spectrum_peaks):
+    return "{}-{}".format(polarity_filter, top_spectrum_peaks)
+
+def _deepest_rt_bins(number_spectra):
+    # Powers of two multiples of the tile size, so every level halves cleanly
+    rt_bins = TILE_SIZE
+    while rt_bins < number_spectra and rt_bins < MAX_RT_BINS:
+        rt_bins *= 2
+
+    return rt_bins
+
+def _downsample(grid, rt_factor, mz_factor):
+    rt_bins, mz_bins = grid.shape
+    return grid.reshape(rt_bins // rt_factor, rt_factor, mz_bins // mz_factor, mz_factor).sum(axis=(1, 3))
+
+def _level_shapes(rt_bins, mz_bins):
+    # From deepest to coarsest, halving every axis that is still larger than a tile
+    shapes = [(rt_bins, mz_bins)]
+    while rt_bins > TILE_SIZE or mz_bins > TILE_SIZE:
+        rt_bins = rt_bins // 2 if rt_bins > TILE_SIZE else rt_bins
+        mz_bins = mz_bins // 2 if mz_bins > TILE_SIZE else mz_bins
+        shapes.append((rt_bins, mz_bins))
+
+    return shapes
+
+def _accumulate_grid(grid, cell_positions, intensity):
+    # Summing per occupied cell first, so the temporaries are as large as the chunk rather than the grid
+    cells, cell_inverse = np.unique(cell_positions, return_inverse=True)
+    grid.reshape(-1)[cells] += np.bincount(cell_inverse, weights=intensity, minlength=len(cells))
+
+def _write_level_tiles(grid, tiles_folder, tile_set, level):
+    # Sparse, only the non empty cells are written, grouped by the tile they fall in
+    mz_tiles = grid.shape[1] // TILE_SIZE
+
+    cell_rt_bins, cell_mz_bins = np.nonzero(grid)
+    cell_tiles = (cell_rt_bins // TILE_SIZE) * mz_tiles + (cell_mz_bins // TILE_SIZE)
+
+    tile_order = np.argsort(cell_tiles, kind="stable")
+    cell_rt_bins = cell_rt_bins[tile_order]
+    cell_mz_bins = cell_mz_bins[tile_order]
+    cell_tiles = cell_tiles[tile_order]
+
+    tile_ids, tile_starts = np.unique(cell_tiles, return_index=True)
+    tile_positions = np.stack([tile_ids // mz_tiles, tile_ids % mz_tiles], axis=1)
+
+    level_prefix = os.path.join(tiles_folder, "{}_{:02d}".format(tile_set, level))
+    np.save(level_prefix + "_positions.npy", tile_positions.astype(np.int32))
+    np.save(level_prefix + "_offsets.npy", np.r_[tile_starts, len(cell_tiles)].astype(np.int64))
+    np.save(level_prefix + "_rt_bins.npy", cell_rt_bins.astype(np.int32))
+    np.save(level_prefix + "_mz_bins.npy", cell_mz_bins.astype(np.int32))
+    np.save(level_prefix + "_i.npy", grid[cell_rt_bins, cell_mz_bins].astype(np.float32))
+
+def build_tiles(filename):
+    """
+    Pre-aggregates the peak store into a pyramid of RT x m/z intensity grids
+
+    The rt axis of the grids is binned by spectrum rather than by time, so the deepest level holds a single spectrum per
+    bin for all but the largest files. Every level is stored sparse, as its non empty cells grouped by TILE_SIZE x TILE_SIZE tile.
+
+    There is a pyramid per rank tier of the store, summing the top peaks of every whole spectrum. The raw peaks rank
+    within the mz window instead, so aggregate_map only uses the tiles where the two agree, see _tiles_match_raw_peaks.
+
+    Args:
+        filename (str): local mzML filename, the peak store has to exist
+    """
+
+    store_folder = lcms_store._get_store_folder(filename)
+    manifest = lcms_store.load_manifest(filename)
+
+    if "rank_tiers" not in manifest:
+        raise Exception("The store has no rank tiers")
+
+    chunk_filenames = [os.path.join(store_folder, chunk["filename"]) for chunk in manifest["chunks"]]
+
+    # First pass, rt and polarity of every spectrum
+    number_spectra = 0
+    for chunk_filename in chunk_filenames:
+        index_values = lcms_store._read_table(chunk_filename, columns=["index"])["index"].to_numpy()
+        if len(index_values) > 0:
+            number_spectra = max(number_spectra, int(index_values.max()))
+
+    spectra_rt = np.full(number_spectra, np.nan)
+    spectra_polarity = np.zeros(number_spectra, dtype=np.int8)
+    spectra_peaks = np.zeros(number_spectra, dtype=np.int64)
+    for chunk_filename in chunk_filenames:
+        chunk_table = lcms_store._read_table(chunk_filename, columns=["index", "rt", "polarity", "i"])
+        spectrum_positions = chunk_table["index"].to_numpy() - 1
+        spectra_rt[spectrum_positions] = chunk_table["rt"].to_numpy()
+        spectra_polarity[spectrum_positions] = chunk_table["polarity"].to_numpy()
+        spectra_peaks += np.bincount(spectrum_positions[chunk_table["i"].to_numpy() >= lcms_store.MAP_MIN_INTENSITY], minlength=number_spectra)
+
+    rt_bins = _deepest_rt_bins(number_spectra)
+    mz_bins = MAX_MZ_BINS
+    level_shapes = _level_shapes(rt_bins, mz_bins)
+
+    if len(manifest["chunks"]) > 0:
+        mz_min = min([chunk["mz_min"] for chunk in manifest["chunks"]])
+        mz_max = max([chunk["mz_max"] for chunk in manifest["chunks"]])
+    else:
+        mz_min, mz_max = 0.0, 0.0
+    mz_width = max(mz_max - mz_min, 1e-6)
+
+    # Spectrum to deepest rt bin
+    spectra_bin = (np.arange(number_spectra, dtype=np.int64) * rt_bins) // max(number_spectra, 1)
+
+    # Mixed polarity files also get a set of tiles per polarity
+    present_polarities = sorted(set(np.unique(spectra_polarity).tolist()) & set([POLARITY_POS, POLARITY_NEG]))
+    polarity_sets = ["None"]
+    if len(present_polarities) > 1:
+        polarity_sets += ["Positive", "Negative"]
+
+    tiles_folder = _get_tiles_folder(filename)
+    temp_tiles_folder = "{}.tmp-{}".format(tiles_folder, str(uuid.uuid4()).replace("-", ""))
+    os.makedirs(temp_tiles_folder)
+
+    # Representative rt of each bin at each level, the mean of its spectra
+    has_rt = ~np.isnan(spectra_rt)
+    rt_sum = np.bincount(spectra_bin[has_rt], weights=spectra_rt[has_rt], minlength=rt_bins)
+    rt_count = np.bincount(spectra_bin[has_rt], minlength=rt_bins).astype(np.float64)
+    for level, (level_rt_bins, level_mz_bins) in enumerate(reversed(level_shapes)):
+        rt_factor = rt_bins // level_rt_bins
+        level_rt_sum = rt_sum.reshape(level_rt_bins, rt_factor).sum(axis=1)
+        level_rt_count = rt_count.reshape(level_rt_bins, rt_factor).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            level_rt = np.where(level_rt_count > 0, level_rt_sum / level_rt_count, np.nan)
+        np.save(os.path.join(temp_tiles_folder, "rt_{:02d}.npy".format(level)), level_rt)
+
+    tile_sets = []
+    for polarity_set in polarity_sets:
+        grid = np.zeros((rt_bins, mz_bins), dtype=np.float64)
+
+        # The top peaks of every tier are a prefix of each chunk, so each tier only adds the rows past the previous one
+        previous_tier_rows = [0] * len(manifest["chunks"])
+        for rank_tier in manifest["rank_tiers"]:
+            for chunk_position, (chunk, chunk_filename) in enumerate(zip(manifest["chunks"], chunk_filenames)):
+                tier_rows = lcms_store._tier_rows(manifest, chunk, rank_tier)
+                chunk_table = lcms_store._read_table(chunk_filename, columns=["index", "mz", "i", "polarity"])
+                chunk_table = chunk_table.slice(previous_tier_rows[chunk_position], tier_rows - previous_tier_rows[chunk_position])
+                previous_tier_rows[chunk_position] = tier_rows
+
+                if polarity_set != "None":
+                    chunk_table = lcms_store._filter_polarity(chunk_table, polarity_set)
+
+                # Fainter peaks rank below all the others, so dropping them keeps the top peaks of the map
+                chunk_table = chunk_table.filter(pc.greater_equal(chunk_table["i"], lcms_store.MAP_MIN_INTENSITY))
+
+                rt_positions = spectra_bin[chunk_table["index"].to_numpy() - 1]
+                mz_positions = np.clip(((chunk_table["mz"].to_numpy() - mz_min) / mz_width * mz_bins).astype(np.int64), 0, mz_bins - 1)
+
+                _accumulate_grid(grid, rt_positions * mz_bins + mz_positions, chunk_table["i"].to_numpy())
+
+            tile_set = _tile_set_name(polarity_set, rank_tier)
+            tile_sets.append(tile_set)
+
+            # Coarser levels are sums over the deeper ones
+            level = len(level_shapes) - 1
+            _write_level_tiles(grid, temp_tiles_folder, tile_set, level)
+            level_grid = grid
+            for level_rt_bins, level_mz_bins in level_shapes[1:]:
+                level -= 1
+                level_grid = _downsample(level_grid, level_grid.shape[0] // level_rt_bins, level_grid.shape[1] // level_mz_bins)
+                _write_level_tiles(level_grid, temp_tiles_folder, tile_set, level)
+
+    np.save(os.path.join(temp_tiles_folder, "spectra_rt.npy"), spectra_rt)
+    np.save(os.path.join(temp_tiles_folder, "spectra_polarity.npy"), spectra_polarity)
+    np.save(os.path.join(temp_tiles_folder, "spectra_peaks.npy"), spectra_peaks)
+
+    tiles_manifest = {}
+    tiles_manifest["version"] = TILES_VERSION
+    tiles_manifest["tile_size"] = TILE_SIZE
+    tiles_manifest["number_spectra"] = number_spectra
+    tiles_manifest["rt_min"] = float(np.nanmin(spectra_rt)) if np.any(has_rt) else 0.0
+    tiles_manifest["rt_max"] = float(np.nanmax(spectra_rt)) if np.any(has_rt) else 0.0
+    tiles_manifest["mz_min"] = float(mz_min)
+    tiles_manifest["mz_max"] = float(mz_max)
+    tiles_manifest["polarities"] = present_polarities
+    tiles_manifest["tile_sets"] = tile_sets
+    tiles_manifest["rank_tiers"] = manifest["rank_tiers"]
+    tiles_manifest["levels"] = [{"rt_bins": int(level_rt_bins), "mz_bins": int(level_mz_bins)} for level_rt_bins, level_mz_bins in reversed(level_shapes)]
+
+    # The manifest goes last, it marks the tiles as complete
+    with open(os.path.join(temp_tiles_folder, "manifest.json"), "w") as manifest_file:
+        json.dump(tiles_manifest, manifest_file)
+
+    if os.path.exists(tiles_folder):
+        shutil.rmtree(tiles_folder)
+    os.rename(temp_tiles_folder, tiles_folder)
+
+def _load_npy_arrays(folder, names):
+    return {name: np.load(os.path.join(folder, "{}.npy".format(name)), mmap_mode="r") for name in names}
+
+def _spectra_in_window(filename, min_rt, max_rt, polarity_filter="None", array_loader=_load_npy_arrays):
+    spectra_arrays = array_loader(_get_tiles_folder(filename), ["spectra_rt", "spectra_polarity"])
+    spectra_rt = spectra_arrays["spectra_rt"]
+    spectra_polarity = spectra_arrays["spectra_polarity"]
+
+    spectra_mask = (spectra_rt >= min_rt) & (spectra_rt <= max_rt)
+    if polarity_filter == "Positive":
+        spectra_mask &= spectra_polarity == POLARITY_POS
+    elif polarity_filter == "Negative":
+        spectra_mask &= spectra_polarity == POLARITY_NEG
+
+    return spectra_mask
+
+def count_spectra(filename, min_rt, max_rt, polarity_filter="None", array_loader=_load_npy_arrays):
+    return int(np.sum(_spectra_in_window(filename, min_rt, max_rt, polarity_filter=polarity_filter, array_loader=array_loader)))
+
+def _tiles_match_raw_peaks(filename, tiles_manifest, min_rt, max_rt, min_mz, max_mz, polarity_filter, top_spectrum_peaks, array_loader=_load_npy_arrays):
+    # The tiles hold the top peaks of every whole spectrum, the raw peaks the top peaks within the mz window,
+    # which are the same when the window covers every peak or no spectrum in view has more peaks than we keep
+    if min_mz <= tiles_manifest["mz_min"] and max_mz >= tiles_manifest["mz_max"]:
+        return True
+
+    spectra_peaks = array_loader(_get_tiles_folder(filename), ["spectra_peaks"])["spectra_peaks"]
+    spectra_mask = _spectra_in_window(filename, min_rt, max_rt, polarity_filter=polarity_filter, array_loader=array_loader)
+
+    return not np.any(spectra_peaks[spectra_mask] > top_spectrum_peaks)
+
+def _resolve_tile_set(tiles_manifest, polarity_filter, top_spectrum_peaks):
+    # Only the rank tiers of the store have tiles, other peak counts go back to the raw peaks
+    if top_spectrum_peaks not in tiles_manifest["rank_tiers"]:
+        return None
+
+    if _tile_set_name(polarity_filter, top_spectrum_peaks) in tiles_manifest["tile_sets"]:
+        return _tile_set_name(polarity_filter, top_spectrum_peaks)
+
+    # Single polarity files only have the unfiltered sets
+    if polarity_filter == "Positive" and tiles_manifest["polarities"] == [POLARITY_POS]:
+        return _tile_set_name("None", top_spectrum_peaks)
+    if polarity_filter == "Negative" and tiles_manifest["polarities"] == [POLARITY_NEG]:
+        return _tile_set_name("None", top_spectrum_peaks)
+
+    return None
+
+def aggregate_map(filename, min_rt, max_rt, min_mz, max_mz, width, height, polarity_filter="None", top_spectrum_peaks=100, array_loader=_load_npy_arrays):
+    """
+    Assembles the summed intensity grid of a view from the tile pyramid
+
+    Picks the coarsest level that is at least as fine as the requested grid, and returns None when even the deepest level
+    is too coarse for the view, or when the top peaks of the tiles are not the top peaks within the mz window, so that
+    the caller can go back to the raw peaks.
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): lower rt bound
+        max_rt (float): upper rt bound
+        min_mz (float): lower mz bound
+        max_mz (float): upper mz bound
+        width (int): rt bins of the output
+        height (int): mz bins of the output
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+        top_spectrum_peaks (int, optional): most intense peaks summed per spectrum, has to be a rank tier of the store. Defaults to 100.
+        array_loader (function, optional): reads named .npy files of a folder, e.g. shared_cache.load_npy_arrays. Defaults to memory mapping them.
+
+    Returns:
+        xarray.DataArray: grid with mz and rt dimensions in the same layout as datashader, or None
+    """
+
+    tiles_manifest = load_tiles_manifest(filename)
+    tiles_folder = _get_tiles_folder(filename)
+
+    tile_set = _resolve_tile_set(tiles_manifest, polarity_filter, top_spectrum_peaks)
+    if tile_set is None:
+        return None
+
+    # Like datashader, the view does not extend past the data
+    x_range = (max(min_rt, tiles_manifest["rt_min"]), min(max_rt, tiles_manifest["rt_max"]))
+    y_range = (max(min_mz, tiles_manifest["mz_min"]), min(max_mz, tiles_manifest["mz_max"]))
+    if x_range[1] <= x_range[0] or y_range[1] <= y_range[0]:
+        return None
+
+    number_spectra = count_spectra(filename, x_range[0], x_range[1], polarity_filter=polarity_filter, array_loader=array_loader)
+    if number_spectra == 0:
+        return None
+
+    if not _tiles_match_raw_peaks(filename, tiles_manifest, x_range[0], x_range[1], min_mz, max_mz, polarity_filter, top_spectrum_peaks, array_loader=array_loader):
+        return None
+
+    output_mz_bin = (y_range[1] - y_range[0]) / height
+    output_spectra_per_bin = max(number_spectra / width, 1)
+    file_mz_width = max(tiles_manifest["mz_max"] - tiles_manifest["mz_min"], 1e-6)
+
+    selected_level = None
+    for level, level_shape in enumerate(tiles_manifest["levels"]):
+        level_mz_bin = file_mz_width / level_shape["mz_bins"]
+        level_spectra_per_bin = tiles_manifest["number_spectra"] / level_shape["rt_bins"]
+
+        if level_mz_bin * LEVEL_OVERSAMPLING <= output_mz_bin and level_spectra_per_bin <= output_spectra_per_bin:
+            selected_level = level
+            break
+
+    # Deepest zoom, the raw peaks are needed
+    if selected_level is None:
+        return None
+
+    level_shape = tiles_manifest["levels"][selected_level]
+    level_prefix = "{}_{:02d}".format(tile_set, selected_level)
+    level_arrays = array_loader(tiles_folder, ["rt_{:02d}".format(selected_level)] + [level_prefix + suffix for suffix in ["_positions", "_offsets", "_rt_bins", "_mz_bins", "_i"]])
+    level_rt = level_arrays["rt_{:02d}".format(selected_level)]
+    positions = level_arrays[level_prefix + "_positions"]
+    offsets = level_arrays[level_prefix + "_offsets"]
+
+    # Finding the tiles that overlap the view
+    rt_bins_in_view = np.flatnonzero((level_rt >= x_range[0]) & (level_rt <= x_range[1]))
+    rt_tiles_in_view = np.unique(rt_bins_in_view // TILE_SIZE)
+
+    level_mz_bin = file_mz_width / level_shape["mz_bins"]
+    first_mz_tile = int((y_range[0] - tiles_manifest["mz_min"]) / level_mz_bin) // TILE_SIZE
+    last_mz_tile = int((y_range[1] - tiles_manifest["mz_min"]) / level_mz_bin) // TILE_SIZE
+
+    tile_mask = np.isin(positions[:, 0], rt_tiles_in_view) & (positions[:, 1] >= first_mz_tile) & (positions[:, 1] <= last_mz_tile)
+    selected_tiles = np.flatnonzero(tile_mask)
+
+    grid = np.zeros(height * width, dtype=np.float64)
+    if len(selected_tiles) > 0:
+        # Cell rows of the selected tiles
+        tile_lengths = offsets[selected_tiles + 1] - offsets[selected_tiles]
+        cell_rows = np.repeat(offsets[selected_tiles] - np.cumsum(np.r_[0, tile_lengths[:-1]]), tile_lengths) + np.arange(np.sum(tile_lengths))
+
+        # Representative rt and mz extent of every cell
+        cell_rt = level_rt[level_arrays[level_prefix + "_rt_bins"][cell_rows]]
+        cell_mz_low = tiles_manifest["mz_min"] + level_arrays[level_prefix + "_mz_bins"][cell_rows] * level_mz_bin
+        cell_intensity = level_arrays[level_prefix + "_i"][cell_rows]
+
+        cell_mask = (cell_rt >= x_range[0]) & (cell_rt <= x_range[1]) & (cell_mz_low + level_mz_bin > y_range[0]) & (cell_mz_low < y_range[1])
+
+        cell_values = cell_intensity[cell_mask]
+        cell_mz_low = cell_mz_low[cell_mask]
+        cell_mz_high = cell_mz_low + level_mz_bin
+
+        x_positions = np.clip(((cell_rt[cell_mask] - x_range[0]) / (x_range[1] - x_range[0]) * width).astype(np.int64), 0, width - 1)
+
+        # A cell is never taller than an output bin, so its intensity is split over at most two of them by overlap
+        mz_step = (y_range[1] - y_range[0]) / height
+        low_positions = np.clip(((cell_mz_low - y_range[0]) / mz_step).astype(np.int64), 0, height - 1)
+        high_positions = np.clip(((cell_mz_high - y_range[0]) / mz_step).astype(np.int64), 0, height - 1)
+        low_boundary = np.minimum(y_range[0] + (low_positions + 1) * mz_step, y_range[1])
+
+        low_overlap = np.clip(np.minimum(cell_mz_high, low_boundary) - np.maximum(cell_mz_low, y_range[0]), 0, None)
+        high_overlap = np.where(high_positions > low_positions, np.clip(np.minimum(cell_mz_high, y_range[1]) - low_boundary, 0, None), 0)
+
+        grid = np.bincount(low_positions * width + x_positions, weights=cell_values * low_overlap / level_mz_bin, minlength=height * width)
+        grid += np.bincount(high_positions * width + x_positions, weights=cell_values * high_overlap / level_mz_bin, minlength=height * width)
+
+    grid = grid.reshape(height, width)
+    grid[grid == 0] = np.nan
+
+    rt_step = (x_range[1] - x_range[0]) / width
+    mz_step = (y_range[1] - y_range[0]) / height
+    rt_coords = x_range[0] + (np.arange(width) + 0.5) * rt_step
+    mz_coords = y_range[0] + (np.arange(height) + 0.5) * mz_step
+
+    return xarray.DataArray(grid, coords=[("mz", mz_coords), ("rt", rt_coords)], attrs={"x_range": x_range, "y_range": y_range})
@@ -138,6 +138,12 @@ def _get_ms2_peaks(usi, local_filename, scan_number):
     return peaks, precursor_mz, spectrum_details_string, spectrum_metadata
 
 def determine_scan_by_rt(usi, local_filename, rt, ms_level=1):
+    import scan_index
+
+    # Looking up in the scan index if we have it
+    if scan_index.scan_index_exists(local_filename):
+        return scan_index.closest_scan_by_rt(local_filename, rt, ms_level=ms_level)
+
     # Understand parameters
     min_rt_delta = 1000
     closest_scan = 0
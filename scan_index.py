@@ -0,0 +1,398 @@
+import os
+import uuid
+import numpy as np
+import pandas as pd
+import pymzml
+import pyarrow as pa
+import pyarrow.feather as feather
+from xml.etree.ElementTree import XML
+
+from utils import MS_precisions
+from utils import _get_scan_polarity, _get_spectrum_identifier
+
+# Enum for polarity, matching lcms_map, zero is unknown
+POLARITY_UNKNOWN = 0
+POLARITY_POS = 1
+POLARITY_NEG = 2
+
+# Loaded indices and their lookup tables, keyed by filename and modification time
+_loaded_scan_indices = {}
+
+def _get_scan_index_filename(filename):
+    return filename + ".scans.feather"
+
+def scan_index_exists(filename):
+    scan_index_filename = _get_scan_index_filename(filename)
+    if not os.path.exists(scan_index_filename):
+        return False
+
+    # Indices written before the native ids were kept are treated as missing until they are rebuilt
+    try:
+        with pa.memory_map(scan_index_filename) as source:
+            return "native_id" in pa.ipc.open_file(source).schema.names
+    except:
+        return False
+
+def _get_offset_dict(run):
+    try:
+        return run.info["file_object"].offset_dict
+    except:
+        return {}
+
+def _get_spectrum_offset(offset_dict, spec):
+    offset = offset_dict.get(spec.ID, -1)
+    if isinstance(offset, tuple):
+        offset = offset[0]
+
+    try:
+        return int(offset)
+    except:
+        return -1
+
+def build_scan_index(filename):
+    """
+    Walks the file once and writes one row per spectrum next to the file
+
+    Args:
+        filename (str): local mzML filename
+    """
+
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+    offset_dict = _get_offset_dict(run)
+
+    use_scans = None
+
+    all_scan = []
+    all_native_id = []
+    all_native_id_numeric = []
+    all_rt = []
+    all_ms_level = []
+    all_polarity = []
+    all_tic = []
+    all_bpi = []
+    all_precursor_mz = []
+    all_offset = []
+
+    for spec in run:
+        # Checking the first spectrum to see if we should use scans or nativeIDs
+        if use_scans is None:
+            use_scans = "scan" in spec.id_dict
+
+        # Spectra without an rt keep their row, so the MS1 numbering still lines up with the index column of the peak store
+        try:
+            rt = float(spec.scan_time_in_minutes())
+        except:
+            rt = np.nan
+
+        scan_polarity = _get_scan_polarity(spec)
+        if scan_polarity == "Positive":
+            polarity = POLARITY_POS
+        elif scan_polarity == "Negative":
+            polarity = POLARITY_NEG
+        else:
+            polarity = POLARITY_UNKNOWN
+
+        try:
+            intensity = spec.i
+            tic = float(np.sum(intensity)) if len(intensity) > 0 else 0.0
+            bpi = float(np.max(intensity)) if len(intensity) > 0 else 0.0
+        except:
+            tic = 0.0
+            bpi = 0.0
+
+        precursor_mz = np.nan
+        if spec.ms_level > 1:
+            try:
+                precursor_mz = float(spec.selected_precursors[0]["mz"])
+            except:
+                pass
+
+        all_scan.append(str(_get_spectrum_identifier(spec, use_scans=use_scans)))
+        all_native_id.append(str(spec.ID))
+        all_native_id_numeric.append(isinstance(spec.ID, int))
+        all_rt.append(rt)
+        all_ms_level.append(spec.ms_level)
+        all_polarity.append(polarity)
+        all_tic.append(tic)
+        all_bpi.append(bpi)
+        all_precursor_mz.append(precursor_mz)
+        all_offset.append(_get_spectrum_offset(offset_dict, spec))
+
+    scans_df = pd.DataFrame()
+    scans_df["scan"] = all_scan
+    scans_df["native_id"] = all_native_id
+    scans_df["native_id_numeric"] = np.array(all_native_id_numeric, dtype=bool)
+    scans_df["rt"] = np.array(all_rt, dtype=np.float64)
+    scans_df["ms_level"] = np.array(all_ms_level, dtype=np.int8)
+    scans_df["polarity"] = np.array(all_polarity, dtype=np.int8)
+    scans_df["tic"] = np.array(all_tic, dtype=np.float64)
+    scans_df["bpi"] = np.array(all_bpi, dtype=np.float64)
+    scans_df["precursor_mz"] = np.array(all_precursor_mz, dtype=np.float64)
+    scans_df["offset"] = np.array(all_offset, dtype=np.int64)
+
+    write_scan_index(filename, scans_df)
+
+def write_scan_index(filename, scans_df):
+    output_filename = _get_scan_index_filename(filename)
+    # Compute workers build it too when it is missing, so every writer gets its own temp file
+    temp_output_filename = "{}.tmp-{}".format(output_filename, str(uuid.uuid4()).replace("-", ""))
+
+    table = pa.Table.from_pandas(scans_df, preserve_index=False)
+    feather.write_feather(table, temp_output_filename, compression="uncompressed")
+
+    os.replace(temp_output_filename, output_filename)
+
+def _load_scan_index_lookups(filename):
+    scan_index_filename = _get_scan_index_filename(filename)
+    modified_time = os.path.getmtime(scan_index_filename)
+
+    cache_key = (scan_index_filename, modified_time)
+    if cache_key in _loaded_scan_indices:
+        return _loaded_scan_indices[cache_key]
+
+    scans_df = feather.read_table(scan_index_filename, memory_map=True).to_pandas()
+
+    # Numbering that matches the index column in the peak store
+    is_ms1 = (scans_df["ms_level"] == 1).values
+    scans_df["ms1_index"] = np.where(is_ms1, np.cumsum(is_ms1), 0)
+
+    lookups = {}
+    lookups["scans_df"] = scans_df
+    lookups["rt_sorted"] = bool(scans_df["rt"].is_monotonic_increasing)
+    lookups["scan_positions"] = {scan: position for position, scan in enumerate(scans_df["scan"].values)}
+
+    # Positions of each ms level, in rt order, for nearest scan lookups
+    lookups["level_positions"] = {}
+    lookups["level_rts"] = {}
+    for ms_level in np.unique(scans_df["ms_level"].values):
+        level_positions = np.flatnonzero((scans_df["ms_level"].values == ms_level) & ~np.isnan(scans_df["rt"].values))
+        level_positions = level_positions[np.argsort(scans_df["rt"].values[level_positions], kind="stable")]
+        lookups["level_positions"][int(ms_level)] = level_positions
+        lookups["level_rts"][int(ms_level)] = scans_df["rt"].values[level_positions]
+
+    # Only keeping the latest version of a file around
+    for key in [key for key in _loaded_scan_indices if key[0] == scan_index_filename]:
+        del _loaded_scan_indices[key]
+    _loaded_scan_indices[cache_key] = lookups
+
+    return lookups
+
+def load_scan_index(filename):
+    """
+    Loads the scan index, keeping it in memory for subsequent lookups in this process
+
+    Args:
+        filename (str): local mzML filename
+
+    Returns:
+        pd.DataFrame: one row per spectrum in file order, with an ms1_index column counting MS1 spectra from 1
+    """
+
+    return _load_scan_index_lookups(filename)["scans_df"]
+
+def query_scans(filename, min_rt, max_rt, ms_level=None, polarity_filter="None"):
+    """
+    Returns the scans within an rt window, inclusive on both ends
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): lower rt bound
+        max_rt (float): upper rt bound
+        ms_level (int, optional): only this ms level when set. Defaults to None.
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+
+    Returns:
+        pd.DataFrame: scan rows in file order
+    """
+
+    lookups = _load_scan_index_lookups(filename)
+    scans_df = lookups["scans_df"]
+
+    if lookups["rt_sorted"]:
+        rt_values = scans_df["rt"].values
+        start = np.searchsorted(rt_values, min_rt, side="left")
+        end = np.searchsorted(rt_values, max_rt, side="right")
+        scans_df = scans_df.iloc[start:end]
+    else:
+        scans_df = scans_df[(scans_df["rt"] >= min_rt) & (scans_df["rt"] <= max_rt)]
+
+    if ms_level is not None:
+        scans_df = scans_df[scans_df["ms_level"] == ms_level]
+
+    if polarity_filter == "Positive":
+        scans_df = scans_df[scans_df["polarity"] == POLARITY_POS]
+    elif polarity_filter == "Negative":
+        scans_df = scans_df[scans_df["polarity"] == POLARITY_NEG]
+
+    return scans_df
+
+def get_tic(filename, tic_option="TIC", polarity_filter="None"):
+    """
+    TIC or BPI of the MS1 spectra from the summaries saved per spectrum, nothing is read from the file
+
+    Args:
+        filename (str): local mzML filename
+        tic_option (str, optional): "TIC" or "BPI". Defaults to "TIC".
+        polarity_filter (str, optional): "None", "Positive" or "Negative". Defaults to "None".
+
+    Returns:
+        pd.DataFrame: tic and rt columns in file order
+    """
+
+    lookups = _load_scan_index_lookups(filename)
+    scans_df = lookups["scans_df"]
+
+    # Spectra without an rt can't be plotted
+    ms1_positions = np.flatnonzero((scans_df["ms_level"].values == 1) & ~np.isnan(scans_df["rt"].values))
+    if polarity_filter == "Positive":
+        ms1_positions = ms1_positions[scans_df["polarity"].values[ms1_positions] == POLARITY_POS]
+    elif polarity_filter == "Negative":
+        ms1_positions = ms1_positions[scans_df["polarity"].values[ms1_positions] == POLARITY_NEG]
+
+    if tic_option == "TIC":
+        summary_column = "tic"
+    elif tic_option == "BPI":
+        summary_column = "bpi"
+    else:
+        raise Exception("Unknown TIC option {}".format(tic_option))
+
+    tic_df = pd.DataFrame()
+    tic_df["tic"] = scans_df[summary_column].values[ms1_positions]
+    tic_df["rt"] = scans_df["rt"].values[ms1_positions]
+
+    return tic_df
+
+def native_ids(scans_df):
+    """
+    The spectrum ids the reader gives as spec.ID, ints for files numbered by scan and strings otherwise
+
+    Args:
+        scans_df (pd.DataFrame): rows of the scan index
+
+    Returns:
+        list: one id per row
+    """
+
+    return [int(native_id) if numeric else native_id for native_id, numeric in zip(scans_df["native_id"].values, scans_df["native_id_numeric"].values)]
+
+def get_scan(filename, scan):
+    """
+    Looks up a single scan by its identifier
+
+    Returns:
+        dict: the scan row, or None if not present
+    """
+
+    lookups = _load_scan_index_lookups(filename)
+
+    position = lookups["scan_positions"].get(str(scan))
+    if position is None:
+        return None
+
+    return lookups["scans_df"].iloc[position].to_dict()
+
+def closest_scan_by_rt(filename, rt, ms_level=1, rt_tolerance=0.1):
+    """
+    Finds the scan of an ms level closest in rt, like reading the file it only looks within rt_tolerance
+
+    Returns:
+        the spec.ID of the scan, same as reading the file, or 0 when there is none close enough
+    """
+
+    lookups = _load_scan_index_lookups(filename)
+
+    level_positions = lookups["level_positions"].get(ms_level)
+    if level_positions is None or len(level_positions) == 0:
+        return 0
+
+    scans_df = lookups["scans_df"]
+    rt_values = lookups["level_rts"][ms_level]
+
+    insert_position = np.searchsorted(rt_values, rt)
+    candidates = [position for position in [insert_position - 1, insert_position] if 0 <= position < len(rt_values)]
+    closest_position = min(candidates, key=lambda position: abs(rt_values[position] - rt))
+
+    if abs(rt_values[closest_position] - rt) > rt_tolerance:
+        return 0
+
+    return native_ids(scans_df.iloc[[level_positions[closest_position]]])[0]
+
+def get_file_summary(filename):
+    scans_df = load_scan_index(filename)
+
+    summary = {}
+    summary["Scans"] = len(scans_df)
+    summary["MS1s"] = int((scans_df["ms_level"] == 1).sum())
+    summary["MS2s"] = int((scans_df["ms_level"] == 2).sum())
+
+    return summary
+
+def _read_spectrum_element(file_handle, offset, read_size=65536):
+    file_handle.seek(offset)
+
+    data = b""
+    end = -1
+    while end == -1:
+        read_data = file_handle.read(read_size)
+        if len(read_data) == 0:
+            raise Exception("Spectrum end not found")
+
+        # Only searching the new data, with enough overlap to catch a split tag
+        search_start = max(len(data) - len("</spectrum>"), 0)
+        data += read_data
+        end = data.find(b"</spectrum>", search_start)
+
+    return XML(data[:end + len("</spectrum>")])
+
+def has_offsets(filename):
+    scans_df = load_scan_index(filename)
+
+    return len(scans_df) > 0 and bool(np.all(scans_df["offset"].values >= 0))
+
+def _offsets_spectrum_generator(filename, offsets):
+    # The reader is still needed to decode the spectra
+    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+
+    # A spectrum ends before the next one starts, so we know how much to read
+    all_offsets = np.sort(load_scan_index(filename)["offset"].values)
+    next_positions = np.searchsorted(all_offsets, offsets, side="right")
+
+    with open(filename, "rb") as file_handle:
+        for offset, next_position in zip(offsets, next_positions):
+            read_size = 65536
+            if next_position < len(all_offsets):
+                read_size = int(all_offsets[next_position] - offset)
+
+            spec = pymzml.spec.Spectrum(_read_spectrum_element(file_handle, int(offset), read_size=read_size))
+            spec.calling_instance = run
+            spec.measured_precision = MS_precisions.get(spec.ms_level, 20e-6)
+
+            yield spec
+
+def spectrum_generator(filename, min_rt, max_rt):
+    """
+    Yields the spectra within an rt window, seeking straight to each of them with the stored byte offsets
+
+    Args:
+        filename (str): local mzML filename
+        min_rt (float): lower rt bound
+        max_rt (float): upper rt bound
+    """
+
+    scans_df = query_scans(filename, min_rt, max_rt)
+
+    return _offsets_spectrum_generator(filename, scans_df["offset"].values)
+
+def spectrum_range_generator(filename, start, end):
+    """
+    Yields the spectra at positions start to end (exclusive) of the index, in file order
+
+    Args:
+        filename (str): local mzML filename
+        start (int): first position
+        end (int): position after the last one
+    """
+
+    scans_df = load_scan_index(filename)
+
+    return _offsets_spectrum_generator(filename, scans_df["offset"].values[start:end])
@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import fcntl
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Segments live in shared memory so that all the gunicorn workers map the same pages instead of keeping their own copies
+if os.path.isdir("/dev/shm"):
+    SHARED_CACHE_FOLDER = os.environ.get("SHARED_CACHE_FOLDER", "/dev/shm/gnpslcms-cache")
+else:
+    SHARED_CACHE_FOLDER = os.environ.get("SHARED_CACHE_FOLDER", os.path.join("temp", "shared_cache"))
+
+# Total bytes of segments we keep around before evicting the least recently used
+SHARED_CACHE_BUDGET_BYTES = int(os.environ.get("SHARED_CACHE_BUDGET_BYTES", 1024 * 1024 * 1024))
+
+# Counters summed over all processes, each process only ever adds to its own so counting needs no lock
+METRIC_NAMES = ["hits", "misses", "stores", "evictions", "bytes_served"]
+
+# Counter arrays of this process per cache folder, and the lock the threads of this process share for them
+_process_metrics = {}
+_process_metrics_lock = threading.Lock()
+
+def _segments_folder(cache_folder):
+    return os.path.join(cache_folder, "segments")
+
+def _metrics_folder(cache_folder):
+    return os.path.join(cache_folder, "metrics")
+
+def _segment_name(key):
+    key_string = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha1(key_string.encode("utf-8")).hexdigest()
+
+def _segment_manifest_filename(segment_folder):
+    return os.path.join(segment_folder, "segment.json")
+
+@contextmanager
+def _locked(cache_folder):
+    # Taken to change the set of segments or fold the counters of exited processes, reads and counting go without it
+    os.makedirs(_segments_folder(cache_folder), exist_ok=True)
+
+    with open(os.path.join(cache_folder, "lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except:
+        pass
+
+    return True
+
+def _fold_exited_metrics(cache_folder):
+    # Counts of processes that exited go into one totals file, so a file per worker ever started does not pile up, call with the lock held
+    metrics_folder = _metrics_folder(cache_folder)
+    totals_filename = os.path.join(metrics_folder, "totals.bin")
+
+    try:
+        totals = np.fromfile(totals_filename, dtype=np.int64)
+        if len(totals) != len(METRIC_NAMES):
+            totals = np.zeros(len(METRIC_NAMES), dtype=np.int64)
+    except:
+        totals = np.zeros(len(METRIC_NAMES), dtype=np.int64)
+
+    exited_filenames = []
+    for metrics_filename in os.listdir(metrics_folder):
+        pid_string = metrics_filename[:-len(".bin")]
+        if not metrics_filename.endswith(".bin") or not pid_string.isdigit() or _process_alive(int(pid_string)):
+            continue
+
+        try:
+            metrics = np.fromfile(os.path.join(metrics_folder, metrics_filename), dtype=np.int64)
+            if len(metrics) == len(METRIC_NAMES):
+                totals += metrics
+        except:
+            pass
+        exited_filenames.append(metrics_filename)
+
+    if len(exited_filenames) == 0:
+        return
+
+    # Totals are replaced whole before the files they include go away
+    temp_filename = "{}.{}.tmp".format(totals_filename, uuid.uuid4())
+    totals.tofile(temp_filename)
+    os.replace(temp_filename, totals_filename)
+
+    for metrics_filename in exited_filenames:
+        try:
+            os.remove(os.path.join(metrics_folder, metrics_filename))
+        except:
+            pass
+
+def _metrics_array(cache_folder):
+    # One file per process, created on first use, which is also when the files of exited processes are folded into the totals
+    metrics_key = (cache_folder, os.getpid())
+    if metrics_key not in _process_metrics:
+        os.makedirs(_metrics_folder(cache_folder), exist_ok=True)
+        metrics_filename = os.path.join(_metrics_folder(cache_folder), "{}.bin".format(os.getpid()))
+        with _locked(cache_folder):
+            _fold_exited_metrics(cache_folder)
+            if not os.path.exists(metrics_filename) or os.path.getsize(metrics_filename) != len(METRIC_NAMES) * 8:
+                np.zeros(len(METRIC_NAMES), dtype=np.int64).tofile(metrics_filename)
+        _process_metrics[metrics_key] = np.memmap(metrics_filename, dtype=np.int64, mode="r+", shape=(len(METRIC_NAMES),))
+
+    return _process_metrics[metrics_key]
+
+def _update_metrics(cache_folder, **increments):
+    try:
+        with _process_metrics_lock:
+            metrics = _metrics_array(cache_folder)
+            for name in increments:
+                metrics[METRIC_NAMES.index(name)] += increments[name]
+    except:
+        print("SHARED CACHE METRICS FAILED")
+
+def _bytes_cached_filename(cache_folder):
+    return os.path.join(cache_folder, "bytes_cached.bin")
+
+def get_metrics(cache_folder=SHARED_CACHE_FOLDER):
+    """
+    Sums the counters of all processes, the ones that exited included
+
+    Returns:
+        dict: counter name to value, plus the bytes currently cached, the segment count and the budget
+    """
+
+    metrics_dict = {name: 0 for name in METRIC_NAMES}
+    if os.path.isdir(_metrics_folder(cache_folder)):
+        # Under the lock, so a file being folded is counted exactly once
+        with _locked(cache_folder):
+            try:
+                _fold_exited_metrics(cache_folder)
+            except:
+                print("SHARED CACHE METRICS FOLD FAILED")
+
+            # The totals file and one file per live process
+            for metrics_filename in os.listdir(_metrics_folder(cache_folder)):
+                if not metrics_filename.endswith(".bin"):
+                    continue
+                try:
+                    metrics = np.fromfile(os.path.join(_metrics_folder(cache_folder), metrics_filename), dtype=np.int64)
+                    for position, name in enumerate(METRIC_NAMES):
+                        metrics_dict[name] += int(metrics[position])
+                except:
+                    pass
+
+    try:
+        metrics_dict["bytes_cached"] = int(np.fromfile(_bytes_cached_filename(cache_folder), dtype=np.int64)[0])
+    except:
+        metrics_dict["bytes_cached"] = 0
+
+    metrics_dict["segments"] = len(os.listdir(_segments_folder(cache_folder))) if os.path.isdir(_segments_folder(cache_folder)) else 0
+    metrics_dict["budget_bytes"] = SHARED_CACHE_BUDGET_BYTES
+
+    return metrics_dict
+
+def get_segment(key, cache_folder=SHARED_CACHE_FOLDER):
+    """
+    Maps a cached segment, the arrays are read only views on shared pages, nothing is copied
+
+    Args:
+        key: anything json serializable that identifies the data
+        cache_folder (str, optional): where the segments live. Defaults to SHARED_CACHE_FOLDER.
+
+    Returns:
+        tuple: (dict of arrays, metadata dict), or None on a miss
+    """
+
+    try:
+        arrays, manifest = _map_segment(key, cache_folder)
+    except:
+        _update_metrics(cache_folder, misses=1)
+        return None
+
+    _update_metrics(cache_folder, hits=1, bytes_served=manifest["bytes"])
+
+    return arrays, manifest["metadata"]
+
+def _map_segment(key, cache_folder):
+    # Raises when the segment is missing
+    segment_folder = os.path.join(_segments_folder(cache_folder), _segment_name(key))
+    manifest_filename = _segment_manifest_filename(segment_folder)
+
+    with open(manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    arrays = {}
+    for position, name in enumerate(manifest["arrays"]):
+        arrays[name] = np.load(os.path.join(segment_folder, "{}.npy".format(position)), mmap_mode="r")
+
+    # Recently used segments are the last to go
+    os.utime(manifest_filename)
+
+    return arrays, manifest
+
+def _evict(cache_folder, budget_bytes):
+    # Only call while holding the lock, removes the least recently used segments until we are within the budget
+    segments_folder = _segments_folder(cache_folder)
+
+    all_segments = []
+    for segment_name in os.listdir(segments_folder):
+        segment_folder = os.path.join(segments_folder, segment_name)
+        try:
+            manifest_filename = _segment_manifest_filename(segment_folder)
+            with open(manifest_filename) as manifest_file:
+                segment_bytes = json.load(manifest_file)["bytes"]
+            all_segments.append((os.path.getmtime(manifest_filename), segment_bytes, segment_folder))
+        except:
+            # Leftovers from a writer that died, they don't count as cached
+            shutil.rmtree(segment_folder, ignore_errors=True)
+
+    total_bytes = sum([segment[1] for segment in all_segments])
+    evictions = 0
+
+    # Processes that still have an evicted segment mapped keep their pages until they let go of them
+    for access_time, segment_bytes, segment_folder in sorted(all_segments):
+        if total_bytes <= budget_bytes:
+            break
+
+        shutil.rmtree(segment_folder, ignore_errors=True)
+        total_bytes -= segment_bytes
+        evictions += 1
+
+    return total_bytes, evictions
+
+def put_segment(key, arrays, metadata=None, cache_folder=SHARED_CACHE_FOLDER, budget_bytes=SHARED_CACHE_BUDGET_BYTES):
+    """
+    Saves arrays into the shared cache, evicting the least recently used segments to stay within the budget
+
+    Args:
+        key: anything json serializable that identifies the data
+        arrays (dict): name to numpy array, object arrays are stored as fixed width strings
+        metadata (dict, optional): small json serializable extras. Defaults to None.
+        cache_folder (str, optional): where the segments live. Defaults to SHARED_CACHE_FOLDER.
+        budget_bytes (int, optional): most bytes to keep cached. Defaults to SHARED_CACHE_BUDGET_BYTES.
+
+    Returns:
+        bool: True if the segment was saved
+    """
+
+    all_names = list(arrays.keys())
+    all_arrays = []
+    for name in all_names:
+        array = np.asarray(arrays[name])
+
+        # Pickled objects can't be mapped
+        if array.dtype == object:
+            array = array.astype(str)
+
+        all_arrays.append(array)
+
+    segment_bytes = int(sum([array.nbytes for array in all_arrays]))
+    if segment_bytes > budget_bytes:
+        return False
+
+    segments_folder = _segments_folder(cache_folder)
+    segment_folder = os.path.join(segments_folder, _segment_name(key))
+    temp_segment_folder = os.path.join(cache_folder, "tmp-{}".format(uuid.uuid4()))
+
+    try:
+        os.makedirs(segments_folder, exist_ok=True)
+        os.makedirs(temp_segment_folder)
+
+        for position, array in enumerate(all_arrays):
+            np.save(os.path.join(temp_segment_folder, "{}.npy".format(position)), array)
+
+        manifest = {}
+        manifest["arrays"] = all_names
+        manifest["bytes"] = segment_bytes
+        manifest["metadata"] = metadata if metadata is not None else {}
+        manifest["created"] = time.time()
+
+        with open(_segment_manifest_filename(temp_segment_folder), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        with _locked(cache_folder):
+            # Another worker got here first
+            if os.path.exists(segment_folder):
+                shutil.rmtree(temp_segment_folder, ignore_errors=True)
+                return False
+
+            total_bytes, evictions = _evict(cache_folder, budget_bytes - segment_bytes)
+            os.rename(temp_segment_folder, segment_folder)
+
+            np.array([total_bytes + segment_bytes], dtype=np.int64).tofile(_bytes_cached_filename(cache_folder))
+
+        _update_metrics(cache_folder, stores=1, evictions=evictions)
+    except:
+        print("SHARED CACHE STORE FAILED")
+        shutil.rmtree(temp_segment_folder, ignore_errors=True)
+        return False
+
+    return True
+
+def dataframe_to_arrays(df, prefix=""):
+    return {prefix + str(column): df[column].values for column in df.columns}
+
+def arrays_to_dataframe(arrays, prefix=""):
+    # Numeric columns stay as views on the shared pages
+    columns = {name[len(prefix):]: arrays[name] for name in arrays if name.startswith(prefix)}
+    return pd.DataFrame(columns, copy=False)
+
+def load_npy_arrays(folder, names, cache_folder=SHARED_CACHE_FOLDER, budget_bytes=SHARED_CACHE_BUDGET_BYTES):
+    """
+    Reads .npy files of a folder through the shared cache, so every process maps the same copy of them
+
+    The folder is identified by its inode and modification time too, a folder that is rebuilt and renamed into place is a new segment.
+
+    Args:
+        folder (str): folder with the .npy files
+        names (list): file names without the .npy extension
+        cache_folder (str, optional): where the segments live. Defaults to SHARED_CACHE_FOLDER.
+        budget_bytes (int, optional): most bytes to keep cached. Defaults to SHARED_CACHE_BUDGET_BYTES.
+
+    Returns:
+        dict: name to read only array
+    """
+
+    folder_stat = os.stat(folder)
+    key = ["npy", os.path.abspath(folder), folder_stat.st_ino, folder_stat.st_mtime_ns, list(names)]
+
+    segment = get_segment(key, cache_folder=cache_folder)
+    if segment is not None:
+        return segment[0]
+
+    arrays = {name: np.load(os.path.join(folder, "{}.npy".format(name))) for name in names}
+
+    # Mapping what was just saved, or what another process saved first, so this process doesn't hold on to a copy of its own
+    put_segment(key, arrays, cache_folder=cache_folder, budget_bytes=budget_bytes)
+    try:
+        return _map_segment(key, cache_folder)[0]
+    except:
+        return arrays
@@ -4,6 +4,8 @@ import download
 import os
 import uuid
 import lcms_map
+import lcms_store
+import utils_generation
 import feature_finding
 import xic
 import tic
@@ -37,13 +39,19 @@ redis_client = redis.Redis(host='gnpslcms-redis', port=6379, db=0)
 # Compute Data
 #################################
 @celery_instance.task(time_limit=120)
-def task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", cache=True):
+def task_lcms_aggregate(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter="None", map_plot_quantization_level="Medium", cache=True, map_viewport=None, generation=None):
     if cache:
         print("Caching Disabled, because with memory, it takes almost as long to cache the result as it takes to run")
 
-    _aggregate_lcms_map = lcms_map._aggregate_lcms_map
-    aggregation, msn_df = _aggregate_lcms_map(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level)
-    return aggregation, msn_df.to_dict(orient="records")
+    # The user already zoomed somewhere else while this waited in the queue
+    if not utils_generation.is_current(redis_client, generation):
+        print("SKIPPING STALE AGGREGATION", generation)
+        return None
+
+    aggregation, msn_df = lcms_map._aggregate_lcms_map_grid(filename, min_rt, max_rt, min_mz, max_mz, polarity_filter=polarity_filter, map_plot_quantization_level=map_plot_quantization_level, map_viewport=map_viewport)
+
+    # One packed buffer, nested lists through json cost more than the aggregation itself
+    return lcms_map._encode_aggregation(aggregation, msn_df)
 
 @celery_instance.task(time_limit=90, base=QueueOnce)
 def task_tic(input_filename, tic_option="TIC", polarity_filter="None"):
@@ -55,8 +63,8 @@ def task_tic(input_filename, tic_option="TIC", polarity_filter="None"):
 
 @celery_instance.task(time_limit=60, base=QueueOnce)
 def task_xic(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
-    # Caching
-    xic_file = memory.cache(xic.xic_file)
+    # Caching, traces are kept per mz window so other windows and rt ranges reuse them
+    xic_file = xic.xic_file_cached
 
     # This is necesary for celery once because tuples are not serializable, causing issues
     all_xic_values = json.loads(all_xic_values)
@@ -137,6 +145,7 @@ def task_computeheartbeat():
 #################################
 import datetime
 import sys
+import shutil
 @celery_instance.task(time_limit=480)
 def _task_cleanup():
     all_temp_files = glob.glob("/app/temp/*")
@@ -162,6 +171,36 @@ def _task_cleanup():
                 print("REMOVING", filename)
                 os.remove(filename)
 
+    # The chunked stores are folders, we age them by their manifest
+    for store_folder in glob.glob("/app/temp/*.lcmsstore"):
+        if "mzspecLOCAL" in store_folder:
+            continue
+
+        manifest_filename = os.path.join(store_folder, "manifest.json")
+        if not os.path.exists(manifest_filename):
+            continue
+
+        access_datetime = datetime.datetime.fromtimestamp(os.stat(manifest_filename).st_atime)
+        time_delta = datetime.datetime.now() - access_datetime
+
+        if time_delta.total_seconds() > MAX_TIME_SECONDS:
+            print("REMOVING", store_folder)
+            shutil.rmtree(store_folder)
+        else:
+            lcms_store.remove_superseded_builds(store_folder)
+
+    # Saved XIC traces, aged by the folder which changes whenever a new trace is added
+    for xic_cache_folder in glob.glob("/app/temp/*.xiccache"):
+        if "mzspecLOCAL" in xic_cache_folder:
+            continue
+
+        access_datetime = datetime.datetime.fromtimestamp(os.stat(xic_cache_folder).st_mtime)
+        time_delta = datetime.datetime.now() - access_datetime
+
+        if time_delta.total_seconds() > MAX_TIME_SECONDS:
+            print("REMOVING", xic_cache_folder)
+            shutil.rmtree(xic_cache_folder)
+
     return "Cleanup"
 
 
@@ -3,6 +3,10 @@ from celery_once import QueueOnce
 import download
 import os
 import lcms_map
+import lcms_store
+import lcms_tiles
+import ion_index
+import scan_index
 
 # Setting up celery
 celery_instance = Celery('lcms_tasks', backend='redis://gnpslcms-redis', broker='redis://gnpslcms-redis')
@@ -41,18 +45,31 @@ def _download_convert_file(usi, temp_folder="temp"):
 @celery_instance.task(time_limit=480, base=QueueOnce)
 def _convert_file_feather(usi, temp_folder="temp"):
     """
-        This function does the serialization of conversion to feather format
+        This function does the serialization of conversion to the RT chunked feather store
     """
 
     if download._resolve_exists_local(usi, temp_folder=temp_folder):
         local_filename = os.path.join(temp_folder, download._usi_to_local_filename(usi))
-        ms1_filename, msn_filename = lcms_map._get_feather_filenames(local_filename)
 
-        if os.path.exists(ms1_filename):
+        if lcms_store.store_complete(local_filename) and scan_index.scan_index_exists(local_filename) and lcms_tiles.tiles_exist(local_filename):
             return
 
+        # Per scan metadata, used for lookups without parsing the file
+        if not scan_index.scan_index_exists(local_filename):
+            scan_index.build_scan_index(local_filename)
+
         # Let's do stuff here
-        lcms_map._save_lcms_data_feather(local_filename)
+        # Published as it is read, so the map can show the early part of the run while this runs
+        if not lcms_store.store_complete(local_filename):
+            lcms_map._save_lcms_data_feather(local_filename)
+
+        # Pre-aggregated map tiles, built from the store
+        if not lcms_tiles.tiles_exist(local_filename):
+            lcms_tiles.build_tiles(local_filename)
+
+        # Mz sorted peaks for XICs, skipped for files too large to sort in memory
+        if not ion_index.ion_index_exists(local_filename) and ion_index.can_build_ion_index(local_filename):
+            ion_index.build_ion_index(local_filename)
 
 
 
@@ -2,7 +2,9 @@ import sys
 sys.path.insert(0, "..")
 import xic
 import lcms_map
+import lcms_tiles
 import pandas as pd
+import numpy as np
 import download
 
 
@@ -22,4 +24,97 @@ def test_2d_mapping_many():
         print(record["usi"])
         remote_link, local_filename = download._resolve_usi(record["usi"])
         agg_dict, msn_results = lcms_map._aggregate_lcms_map(local_filename, 0, 300, 0, 2000)
-        lcms_map._create_map_fig(agg_dict, msn_results)
\ No newline at end of file
+        lcms_map._create_map_fig(agg_dict, msn_results)
+
+def test_2d_mapping_tiles():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    lcms_map._save_lcms_data_feather(local_filename)
+    lcms_tiles.build_tiles(local_filename)
+
+    # Full view comes from the tiles, the deep zoom from the peaks
+    agg = lcms_map._aggregate_lcms_map_tiles(local_filename, 0, 1000000, 0, 2000)
+    assert(agg is not None)
+
+    agg = lcms_map._aggregate_lcms_map_tiles(local_filename, 3, 3.5, 300, 301)
+    assert(agg is None)
+
+    # Tiles sum the same top peaks per spectrum as the raw peaks
+    agg, msn_results = lcms_map._aggregate_lcms_map_tiles(local_filename, 0, 1000000, 0, 2000, map_plot_quantization_level="Low", top_spectrum_peaks=50)
+    ms1_results, number_spectra, msn_results = lcms_map._gather_lcms_data_cached(local_filename, 0, 1000000, 0, 2000, top_spectrum_peaks=50)
+    assert(abs(np.nansum(agg.values) - ms1_results["i"].astype(float).sum()) <= ms1_results["i"].astype(float).sum() * 0.0001)
+
+    agg_dict, msn_results = lcms_map._aggregate_lcms_map(local_filename, 0, 1000000, 0, 2000)
+    lcms_map._create_map_fig(agg_dict, msn_results)
+
+def test_2d_mapping_tiles_zoomed():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    lcms_map._save_lcms_data_feather(local_filename)
+    lcms_tiles.build_tiles(local_filename)
+
+    # The raw peaks rank within the mz window, the tiles are only used where that gives the same peaks
+    for top_spectrum_peaks in [50, 100, 200]:
+        ms1_results, number_spectra, msn_results = lcms_map._gather_lcms_data(local_filename, 1, 2, 300, 500, top_spectrum_peaks=top_spectrum_peaks)
+        raw_sum = ms1_results["i"].astype(float).sum()
+
+        agg = lcms_tiles.aggregate_map(local_filename, 1, 2, 300, 500, 200, 200, top_spectrum_peaks=top_spectrum_peaks)
+        if agg is not None:
+            assert(abs(np.nansum(agg.values) - raw_sum) <= raw_sum * 0.01)
+
+def test_2d_mapping_encoding():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    agg, msn_results = lcms_map._aggregate_lcms_map_grid(local_filename, 3, 7, 300, 500)
+
+    payload = lcms_map._encode_aggregation(agg, msn_results)
+    decoded_agg, decoded_msn_results = lcms_map._decode_aggregation(payload)
+
+    assert(decoded_agg.shape == agg.shape)
+    assert(len(decoded_msn_results) == len(msn_results))
+    lcms_map._create_map_fig(decoded_agg, decoded_msn_results)
+
+def test_2d_mapping_image():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    agg_dict, msn_results = lcms_map._aggregate_lcms_map(local_filename, 0, 1000000, 0, 2000, map_plot_quantization_level="High")
+
+    heatmap_fig = lcms_map._create_map_fig(agg_dict, msn_results)
+    image_fig = lcms_map._create_map_fig(agg_dict, msn_results, render_mode="Image")
+
+    assert(len(image_fig.layout.images) == 1)
+    assert(len(image_fig.to_json()) < len(heatmap_fig.to_json()))
+
+def test_2d_mapping_viewport():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    map_viewport = {"width": 600, "height": 400, "pixel_ratio": 2}
+
+    agg, msn_results = lcms_map._aggregate_lcms_map_grid(local_filename, 3, 7, 300, 500, map_viewport=map_viewport)
+    assert(agg.shape == (800, 1200))
+
+def test_msn_marker_decimation():
+    msn_results = pd.DataFrame()
+    msn_results["precursor_mz"] = np.linspace(100, 1000, 20000)
+    msn_results["rt"] = np.linspace(0, 10, 20000)
+    msn_results["scan"] = np.arange(20000)
+    msn_results["level"] = 2
+    msn_results["polarity"] = 1
+
+    decimated_results = lcms_map._decimate_msn_markers(msn_results, (0, 10), (100, 1000), 800, 400)
+    assert(len(decimated_results) < len(msn_results))
+    assert(decimated_results["count"].sum() == len(msn_results))
+
+    # Zoomed in far enough, everything is drawn
+    detailed_results = lcms_map._decimate_msn_markers(msn_results.iloc[:100], (0, 0.05), (100, 105), 800, 400)
+    assert(len(detailed_results) == 100)
+
+def test_2d_mapping_coarse():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    lcms_map._save_lcms_data_feather(local_filename)
+
+    # Only drawn from the tiles
+    assert(lcms_map._aggregate_lcms_map_grid(local_filename, 0, 1000000, 0, 2000, coarse=True) is None)
+    lcms_tiles.build_tiles(local_filename)
+
+    coarse_agg, coarse_msn_results = lcms_map._aggregate_lcms_map_grid(local_filename, 0, 1000000, 0, 2000, coarse=True)
+    agg, msn_results = lcms_map._aggregate_lcms_map_grid(local_filename, 0, 1000000, 0, 2000)
+
+    assert(coarse_agg.shape[0] < agg.shape[0])
+    assert(coarse_agg.shape[1] < agg.shape[1])
+    lcms_map._create_map_fig(coarse_agg, coarse_msn_results)
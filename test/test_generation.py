@@ -0,0 +1,25 @@
+import sys
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import utils_generation
+
+def test_generation_superseded():
+    first_generation = utils_generation.begin_generation(None, "test_session", "map")
+    assert(not utils_generation.is_stale())
+
+    second_generation = utils_generation.begin_generation(None, "test_session", "map")
+    assert(not utils_generation.is_current(None, first_generation))
+    assert(utils_generation.is_current(None, second_generation))
+
+    # Other components and sessions don't supersede each other
+    utils_generation.begin_generation(None, "test_session", "xic")
+    utils_generation.begin_generation(None, "other_session", "map")
+    assert(utils_generation.is_current(None, second_generation))
+
+def test_generation_untracked():
+    utils_generation.clear_generation()
+    assert(utils_generation.current_generation() is None)
+    assert(not utils_generation.is_stale())
+
+    assert(utils_generation.begin_generation(None, None, "map") is None)
+    assert(not utils_generation.is_stale())
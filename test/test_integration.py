@@ -0,0 +1,47 @@
+import sys
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import numpy as np
+import pandas as pd
+from scipy import integrate
+import integration
+
+def _long_data():
+    df_list = []
+    for usi in ["mzspec:MSV000085852:QC_1", "mzspec:MSV000085852:QC_0"]:
+        for variable in ["XIC 278.1902", "XIC 500"]:
+            df = pd.DataFrame()
+            df["rt"] = np.linspace(0, 2, 21)
+            df["variable"] = variable
+            df["value"] = np.exp(-(df["rt"] - 1) ** 2 / 0.02) * 1000 + 10
+            df["USI"] = usi
+            df["GROUP"] = "TOP"
+            df_list.append(df)
+
+    return pd.concat(df_list)
+
+def test_integration():
+    long_data_df = _long_data()
+
+    auc_df = integration.integrate_xic(long_data_df, "AUC")
+    sum_df = integration.integrate_xic(long_data_df, "MS1SUM")
+    max_df = integration.integrate_xic(long_data_df, "MAXPEAKHEIGHT")
+
+    assert(list(auc_df.columns) == ["variable", "USI", "GROUP", "value"])
+    assert(len(auc_df) == 4)
+    assert(auc_df["USI"].iloc[0] == "mzspec:MSV000085852:QC_0")
+
+    for (name, group_df), auc, ms1_sum, max_height in zip(long_data_df.groupby(["variable", "USI", "GROUP"]), auc_df["value"], sum_df["value"], max_df["value"]):
+        assert(abs(auc - integrate.trapezoid(group_df["value"], x=group_df["rt"])) < 0.001)
+        assert(abs(ms1_sum - group_df["value"].sum()) < 0.001)
+        assert(abs(max_height - group_df["value"].max()) < 0.001)
+
+def test_integration_peak_bounded():
+    long_data_df = _long_data()
+
+    auc_df = integration.integrate_xic(long_data_df, "AUC")
+    peak_auc_df = integration.integrate_xic(long_data_df, "AUC", peak_bounded=True)
+
+    # The baseline outside the peak is left out
+    assert((peak_auc_df["value"] < auc_df["value"]).all())
+    assert((peak_auc_df["value"] > 0.9 * (auc_df["value"] - 20)).all())
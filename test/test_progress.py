@@ -3,6 +3,10 @@ sys.path.insert(0, "..")
 sys.path.insert(0, ".")
 import pandas as pd
 import utils_progressbar
+import download
+import scan_index
+import lcms_map
+import lcms_store
 import json
 
 def test_progress():
@@ -16,6 +20,25 @@ def test_progress():
 
     print(html_progress)
 
+def test_partial_store_progress():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+
+    # Publishing only the first batch of spectra
+    manifest = lcms_store.begin_store(local_filename, spectra_total=len(scan_index.load_scan_index(local_filename)))
+    batch_result, batch_spectra = next(lcms_map._iterate_lcms_batches(local_filename))
+    lcms_store.append_store(local_filename, manifest, batch_result[0], batch_result[2], spectra_ingested=batch_spectra)
+
+    assert(lcms_store.store_exists(local_filename))
+    assert(not lcms_store.store_complete(local_filename))
+    assert(0 < lcms_store.store_progress(local_filename) < 1)
+
+    status = utils_progressbar.determine_usi_progress("mzspec:MSV000085852:QC_0")
+    assert(status["mzspec:MSV000085852:QC_0"]["readstatus"] == "reading")
+
+    lcms_map._save_lcms_data_feather(local_filename)
+    assert(lcms_store.store_complete(local_filename))
+
 def main():
     test_progress()
 
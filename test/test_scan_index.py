@@ -0,0 +1,68 @@
+import sys
+sys.path.insert(0, "..")
+import pandas as pd
+import download
+import scan_index
+import ms2
+import lcms_map
+import utils
+import tic
+
+def test_build_scan_index():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+
+    assert(scan_index.scan_index_exists(local_filename))
+
+    summary = scan_index.get_file_summary(local_filename)
+    assert(summary["Scans"] == summary["MS1s"] + summary["MS2s"])
+
+def test_scan_index_lookups():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+
+    closest_scan = ms2.determine_scan_by_rt("mzspec:MSV000085852:QC_0", local_filename, 5.0)
+    scan_record = scan_index.get_scan(local_filename, closest_scan)
+    assert(abs(scan_record["rt"] - 5.0) < 0.1)
+
+    # Same id and type as reading the file, it goes into the MS1 USI
+    slow_closest_scan = 0
+    min_rt_delta = 1000
+    for spec in utils._spectrum_generator(local_filename, 4.9, 5.1):
+        if spec.ms_level == 1 and abs(spec.scan_time_in_minutes() - 5.0) < min_rt_delta:
+            slow_closest_scan = spec.ID
+            min_rt_delta = abs(spec.scan_time_in_minutes() - 5.0)
+    assert(closest_scan == slow_closest_scan)
+    assert(type(closest_scan) == type(slow_closest_scan))
+
+    # Nothing close enough, same as reading the file
+    assert(scan_index.closest_scan_by_rt(local_filename, 100000.0) == 0)
+
+    # Making sure seeking through the index gives the same spectra as the reader
+    all_spectra = list(utils._spectrum_generator(local_filename, 5, 6))
+    scans_df = scan_index.query_scans(local_filename, 5, 6)
+    assert(len(all_spectra) == len(scans_df))
+
+def test_scan_index_tic():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+
+    for tic_option in ["TIC", "BPI"]:
+        for polarity_filter in ["None", "Positive"]:
+            index_tic_df = scan_index.get_tic(local_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+            slow_tic_df = tic._tic_file_slow(local_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+
+            assert(len(index_tic_df) == len(slow_tic_df))
+            assert(((index_tic_df["tic"] - slow_tic_df["tic"]).abs() <= slow_tic_df["tic"].abs() * 0.0001 + 1).all())
+
+def test_parallel_gather():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+
+    ms1_results, number_spectra, msn_results = lcms_map._gather_lcms_data(local_filename, 0, 1000000, 0, 10000, top_spectrum_peaks=100000, include_polarity=True)
+    parallel_ms1_results, parallel_msn_results = lcms_map._gather_lcms_data_parallel(local_filename, processes=4)
+
+    # Shards have to give the same peaks and numbering as a single pass
+    assert(len(ms1_results) == len(parallel_ms1_results))
+    assert(len(msn_results) == len(parallel_msn_results))
+    assert(ms1_results["index"].max() == parallel_ms1_results["index"].max())
@@ -0,0 +1,63 @@
+import sys
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import os
+import subprocess
+import numpy as np
+import pandas as pd
+import shared_cache
+
+def test_shared_cache_roundtrip():
+    cache_folder = "temp/test_shared_cache"
+
+    df = pd.DataFrame()
+    df["rt"] = np.arange(10, dtype=np.float32)
+    df["scan"] = [str(scan) for scan in range(10)]
+
+    assert(shared_cache.get_segment(["test", 1], cache_folder=cache_folder) is None)
+    assert(shared_cache.put_segment(["test", 1], shared_cache.dataframe_to_arrays(df), metadata={"rows": 10}, cache_folder=cache_folder))
+
+    arrays, metadata = shared_cache.get_segment(["test", 1], cache_folder=cache_folder)
+    assert(metadata["rows"] == 10)
+    assert(shared_cache.arrays_to_dataframe(arrays).equals(df))
+
+    # Only one of these fits in the budget
+    shared_cache.put_segment(["test", 2], {"rt": np.zeros(1000)}, cache_folder=cache_folder, budget_bytes=10000)
+    shared_cache.put_segment(["test", 3], {"rt": np.zeros(1000)}, cache_folder=cache_folder, budget_bytes=10000)
+    assert(shared_cache.get_segment(["test", 2], cache_folder=cache_folder) is None)
+
+    metrics = shared_cache.get_metrics(cache_folder=cache_folder)
+    assert(metrics["hits"] >= 1)
+    assert(metrics["evictions"] >= 2)
+
+def test_shared_cache_npy_arrays():
+    cache_folder = "temp/test_shared_cache_npy"
+    npy_folder = "temp/test_shared_cache_npy_files"
+    os.makedirs(npy_folder, exist_ok=True)
+
+    np.save(os.path.join(npy_folder, "mz.npy"), np.arange(100, dtype=np.float64))
+    np.save(os.path.join(npy_folder, "i.npy"), np.ones(100, dtype=np.float32))
+
+    arrays = shared_cache.load_npy_arrays(npy_folder, ["mz", "i"], cache_folder=cache_folder)
+    assert(np.array_equal(arrays["mz"], np.arange(100)))
+
+    # Served from the segment the first call saved
+    hits = shared_cache.get_metrics(cache_folder=cache_folder)["hits"]
+    arrays = shared_cache.load_npy_arrays(npy_folder, ["mz", "i"], cache_folder=cache_folder)
+    assert(np.array_equal(arrays["i"], np.ones(100)))
+    assert(shared_cache.get_metrics(cache_folder=cache_folder)["hits"] == hits + 1)
+
+def test_shared_cache_exited_metrics():
+    cache_folder = "temp/test_shared_cache_exited"
+    shared_cache.get_segment(["test", 1], cache_folder=cache_folder)
+    misses = shared_cache.get_metrics(cache_folder=cache_folder)["misses"]
+
+    # Counts left behind by a process that is gone
+    exited_process = subprocess.Popen(["true"])
+    exited_process.wait()
+    exited_filename = os.path.join(cache_folder, "metrics", "{}.bin".format(exited_process.pid))
+    np.array([0, 5, 0, 0, 0], dtype=np.int64).tofile(exited_filename)
+
+    assert(shared_cache.get_metrics(cache_folder=cache_folder)["misses"] == misses + 5)
+    assert(not os.path.exists(exited_filename))
+    assert(shared_cache.get_metrics(cache_folder=cache_folder)["misses"] == misses + 5)
@@ -5,6 +5,7 @@ import pandas as pd
 
 import download
 import lcms_map
+import lcms_store
 
 # Testing remote link calculation
 def test_resolve_remote_url():
@@ -24,21 +25,26 @@ def test_resolve_download_convert():
 
         assert(os.path.exists(local_filename))
 
-# Testing we can make a feather file
+# Testing we can make the chunked feather store
 def test_feather_download_convert():
     df = pd.read_csv("usi_list.tsv", sep='\t')
     for record in df.to_dict(orient="records"):
         print(record["usi"])
         remote_link, local_filename = download._resolve_usi(record["usi"])
-        output_ms1_filename, output_msn_filename = lcms_map._get_feather_filenames(local_filename)
         lcms_map._save_lcms_data_feather(local_filename)
 
-        # Making sure the filename exists
-        assert(os.path.exists(output_ms1_filename))
+        # Making sure the store exists
+        assert(lcms_store.store_exists(local_filename))
 
         # Making sure it includes polarity
-        ms1_results = pd.read_feather(output_ms1_filename)
+        ms1_results = lcms_store.query_ms1(local_filename, 0, 1000000, 0, 10000)
         assert("polarity" in ms1_results)
+        assert(ms1_results["i"].dtype == "float32")
+        assert(ms1_results["polarity"].dtype == "int8")
+
+        # Making sure the top peaks per spectrum come straight from the ranks
+        top_results = lcms_store.query_ms1(local_filename, 0, 1000000, 0, 10000, max_rank=10)
+        assert(top_results.groupby("index").size().max() <= 10)
         
 
 # Testing to local filenames
@@ -3,6 +3,9 @@ sys.path.insert(0, "..")
 import xic
 import pandas as pd
 import download
+import scan_index
+import lcms_map
+import ion_index
 
 def test_xic_slow():
     remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
@@ -17,6 +20,90 @@ def test_xic_slow():
 
     xic._xic_file_slow(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
     
+def test_xic_slow_multiple_targets():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+
+    all_xic_values = [["278.1902", 278.1902], ["279.1902", 279.1902], ["500", 500.0]]
+    xic_tolerance = 0.5
+    xic_ppm_tolerance = 10
+    xic_tolerance_unit = "Da"
+    rt_min = 5
+    rt_max = 6
+    polarity_filter = "Positive"
+
+    xic_df, ms2_data = xic._xic_file_slow(local_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+
+    # Extracting all the targets in one pass matches extracting them one at a time
+    for target_mz in all_xic_values:
+        single_xic_df, single_ms2_data = xic._xic_file_slow(local_filename, [target_mz], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+        target_name = "XIC {}".format(target_mz[0])
+        assert((xic_df[target_name] - single_xic_df[target_name]).abs().max() < 1e-3)
+
+def test_xic_store():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+    lcms_map._save_lcms_data_feather(local_filename)
+
+    all_xic_values = [["278.1902", 278.1902], ["500", 500.0]]
+    rt_min = 5
+    rt_max = 6
+    polarity_filter = "Positive"
+
+    for xic_tolerance_unit in ["Da", "ppm"]:
+        store_xic_df, store_ms2_data = xic._xic_file_store(local_filename, all_xic_values, 0.5, 10, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+        slow_xic_df, slow_ms2_data = xic._xic_file_slow(local_filename, all_xic_values, 0.5, 10, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+
+        assert(len(store_xic_df) == len(slow_xic_df))
+        for target_mz in all_xic_values:
+            target_name = "XIC {}".format(target_mz[0])
+            assert((store_xic_df[target_name] - slow_xic_df[target_name]).abs().max() < 1)
+
+def test_xic_ion_index():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+    lcms_map._save_lcms_data_feather(local_filename)
+    ion_index.build_ion_index(local_filename)
+
+    all_xic_values = [["278.1902", 278.1902], ["500", 500.0]]
+
+    index_xic_df, index_ms2_data = xic._xic_file_ion_index(local_filename, all_xic_values, 0.5, 10, "ppm", 5, 6, "Positive")
+    store_xic_df, store_ms2_data = xic._xic_file_store(local_filename, all_xic_values, 0.5, 10, "ppm", 5, 6, "Positive")
+
+    assert(list(index_xic_df.columns) == list(store_xic_df.columns))
+    assert((index_xic_df - store_xic_df).abs().max().max() < 1)
+
+def test_xic_ms2_scan_index():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+    scan_index.build_scan_index(local_filename)
+    lcms_map._save_lcms_data_feather(local_filename)
+
+    all_xic_values = [["278.1902", 278.1902]]
+
+    # MS2 scans are placed from the scan index instead of reading the file
+    xic_df, ms2_data = xic.xic_file(local_filename, all_xic_values, 0.5, 10, "Da", 0, 1000, "Positive", get_ms2=True)
+    slow_xic_df, slow_ms2_data = xic._xic_file_slow(local_filename, all_xic_values, 0.5, 10, "Da", 0, 1000, "Positive")
+
+    # Same ids and types as the reader gives
+    assert(ms2_data["all_ms2_scan"] == slow_ms2_data["all_ms2_scan"])
+    assert([type(scan) for scan in ms2_data["all_ms2_scan"]] == [type(scan) for scan in slow_ms2_data["all_ms2_scan"]])
+    assert(max([abs(rt - slow_rt) for rt, slow_rt in zip(ms2_data["all_ms2_rt"], slow_ms2_data["all_ms2_rt"])] + [0]) < 0.001)
+    assert(max([abs(intensity - slow_intensity) for intensity, slow_intensity in zip(ms2_data["all_ms2_ms1_int"], slow_ms2_data["all_ms2_ms1_int"])] + [0]) < 1)
+
+def test_xic_cached():
+    remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
+
+    all_xic_values = [["278.1902", 278.1902], ["500", 500.0]]
+
+    # Narrower rt windows and extra targets come from the saved full run traces
+    xic.xic_file_cached(local_filename, all_xic_values[:1], 0.5, 10, "Da", 0, 1000, "Positive")
+    cached_xic_df, cached_ms2_data = xic.xic_file_cached(local_filename, all_xic_values, 0.5, 10, "Da", 5, 6, "Positive")
+    xic_df, ms2_data = xic.xic_file(local_filename, all_xic_values, 0.5, 10, "Da", 5, 6, "Positive")
+
+    assert(len(cached_xic_df) == len(xic_df))
+    for target_mz in all_xic_values:
+        target_name = "XIC {}".format(target_mz[0])
+        assert((cached_xic_df[target_name] - xic_df[target_name]).abs().max() < 1)
+
 def test_xic_fast():
     remote_link, local_filename = download._resolve_usi("mzspec:MSV000085852:QC_0")
 
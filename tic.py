@@ -6,6 +6,7 @@ import uuid
 import os
 import glob
 import shutil
+import scan_index
 
 def tic_file(input_filename, tic_option="TIC", polarity_filter="None"):
     """
@@ -19,12 +20,20 @@ def tic_file(input_filename, tic_option="TIC", polarity_filter="None"):
     Returns:
         [type]: [description]
     """
+    # Every option and polarity comes from the summaries in the scan index
+    if scan_index.scan_index_exists(input_filename):
+        try:
+            return scan_index.get_tic(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
+        except:
+            pass
+
     if tic_option == "TIC" and polarity_filter == "None":
         try:
             return _tic_file_fast(input_filename)
         except:
             pass
 
+    # The scan index is built by the conversion, never on the request path
     return _tic_file_slow(input_filename, tic_option=tic_option, polarity_filter=polarity_filter)
 
 def _tic_file_slow(input_filename, tic_option="TIC", polarity_filter="None"):
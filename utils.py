@@ -28,12 +28,19 @@ import subprocess, io
 
 
 def _calculate_file_stats(usi, local_filename):
-    run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
-    number_scans = run.get_spectrum_count()
+    import scan_index
 
     response_dict = {}
     response_dict["USI"] = usi
-    response_dict["Scans"] = number_scans
+
+    # Counting from the scan index if we have it
+    index_summary = {}
+    if scan_index.scan_index_exists(local_filename):
+        index_summary = scan_index.get_file_summary(local_filename)
+        response_dict["Scans"] = index_summary["Scans"]
+    else:
+        run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
+        response_dict["Scans"] = run.get_spectrum_count()
 
     try:
         cmd = ["./bin/msaccess", local_filename, "-x",  'run_summary delimiter=tab']
@@ -61,6 +68,11 @@ def _calculate_file_stats(usi, local_filename):
                 response_dict[field] = "N/A"
     except:
         pass
+
+    # The index counts are exact, so they take precedence
+    for field in ["MS1s", "MS2s"]:
+        if field in index_summary:
+            response_dict[field] = index_summary[field]
     
     return response_dict
 
@@ -78,6 +90,18 @@ def _get_scan_polarity(spec):
      
     return polarity
 
+def _get_spectrum_identifier(spec, use_scans=True):
+    spectrum_identifier = spec.ID
+    if use_scans is False:
+        try:
+            # Keys that matter for Sciex Data
+            key_order = ['sample', 'period', 'cycle', 'experiment']
+            spectrum_identifier = " ".join(["{}={}".format(key, spec.id_dict[key]) for key in key_order])
+        except:
+            pass
+
+    return spectrum_identifier
+
 # Given URL, will try to parse and get key
 def _get_param_from_url(search, url_hash, param_key, default, session_dict={}, old_value=None, no_change_default=None):
     try:
@@ -113,6 +137,20 @@ def _get_param_from_url(search, url_hash, param_key, default, session_dict={}, o
         return no_change_default
     return param_value
 
+def _get_scan_rt_precursor(local_filename, scan_number):
+    import scan_index
+
+    # Looking up in the scan index, without touching the file
+    if scan_index.scan_index_exists(local_filename):
+        scan_record = scan_index.get_scan(local_filename, scan_number)
+        if scan_record is not None and scan_record["precursor_mz"] > 0:
+            return scan_record["rt"], scan_record["precursor_mz"]
+
+    run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
+    spec = run[scan_number]
+
+    return spec.scan_time_in_minutes(), spec.selected_precursors[0]["mz"]
+
 def _resolve_map_plot_selection(url_search, usi, local_filename, 
                 ui_map_selection=None, 
                 map_plot_rt_min="",
@@ -160,10 +198,7 @@ def _resolve_map_plot_selection(url_search, usi, local_filename,
                 # Lets get out of here and not set anything
                 raise Exception
             
-            run = pymzml.run.Reader(local_filename, MS_precisions=MS_precisions)
-            spec = run[scan_number]
-            rt = spec.scan_time_in_minutes()
-            mz = spec.selected_precursors[0]["mz"]
+            rt, mz = _get_scan_rt_precursor(local_filename, scan_number)
 
             min_rt = max(rt - 0.5, 0)
             max_rt = rt + 0.5
@@ -304,13 +339,20 @@ def _find_lcms_rt(run, rt_query):
 
 
 def _spectrum_generator(filename, min_rt, max_rt):
-    run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+    import scan_index
 
     # Don't do this if the min_rt and max_rt are not reasonable values
     if min_rt <= 0 and max_rt > 1000:
+        run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
         for spec in run:
             yield spec
+    elif scan_index.scan_index_exists(filename) and scan_index.has_offsets(filename):
+        # Seeking directly to the spectra in the window
+        for spec in scan_index.spectrum_generator(filename, min_rt, max_rt):
+            yield spec
     else:
+        run = pymzml.run.Reader(filename, MS_precisions=MS_precisions)
+
         try:
             min_rt_index = _find_lcms_rt(run, min_rt) # These are inclusive on left
             max_rt_index = _find_lcms_rt(run, max_rt) + 1 # Exclusive on the right
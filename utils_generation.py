@@ -0,0 +1,133 @@
+import threading
+
+# Generation counters are only needed while a user is actively looking at the dashboard
+GENERATION_EXPIRY_SECONDS = 60 * 60
+
+# Used when there is no redis, e.g. the dev server, everything then runs in this one process
+_local_generations = {}
+_local_lock = threading.Lock()
+
+# Every server thread handles one callback at a time, so the callback tells the functions it calls which generation they work for
+_context = threading.local()
+
+def _generation_key(session_id, component):
+    return "generation:{}:{}".format(session_id, component)
+
+def _lookup_generation(redis_client, key):
+    if redis_client is None:
+        with _local_lock:
+            return _local_generations.get(key, 0)
+
+    value = redis_client.get(key)
+    if value is None:
+        return 0
+
+    return int(value)
+
+def clear_generation():
+    """
+    Forgets the generation of this thread, call at the start of every request so a thread never inherits one
+    """
+    _context.generation = None
+    _context.redis_client = None
+
+def begin_generation(redis_client, session_id, component):
+    """
+    Starts a new request for a component of a browser session, everything started before it for the same component is now stale
+
+    Args:
+        redis_client: shared redis, None when running in a single process
+        session_id (str): random id of the browser tab
+        component (str): which part of the page is being drawn, e.g. map or xic
+
+    Returns:
+        dict: the generation, json serializable so it can be handed to tasks, or None if we can't track it
+    """
+
+    clear_generation()
+
+    if session_id is None or len(str(session_id)) == 0:
+        return None
+
+    key = _generation_key(session_id, component)
+
+    try:
+        if redis_client is None:
+            with _local_lock:
+                generation_number = _local_generations.get(key, 0) + 1
+                _local_generations[key] = generation_number
+        else:
+            generation_number = int(redis_client.incr(key))
+            redis_client.expire(key, GENERATION_EXPIRY_SECONDS)
+    except:
+        print("GENERATION TRACKING FAILED", key)
+        return None
+
+    generation = {}
+    generation["session_id"] = session_id
+    generation["component"] = component
+    generation["generation"] = generation_number
+
+    _context.generation = generation
+    _context.redis_client = redis_client
+
+    return generation
+
+def current_generation():
+    return getattr(_context, "generation", None)
+
+def is_current(redis_client, generation):
+    """
+    Checks if a newer request for the same component has come in
+
+    Args:
+        redis_client: shared redis, None when running in a single process
+        generation (dict): from begin_generation
+
+    Returns:
+        bool: False only if we know for sure the generation was superseded
+    """
+
+    if generation is None:
+        return True
+
+    try:
+        latest_generation = _lookup_generation(redis_client, _generation_key(generation["session_id"], generation["component"]))
+    except:
+        # We'd rather finish some extra work than drop a request
+        return True
+
+    return latest_generation <= generation["generation"]
+
+def is_stale():
+    """
+    Checks the generation of the callback running on this thread
+
+    Returns:
+        bool: True if the user has since asked for something else in the same component
+    """
+
+    return not is_current(getattr(_context, "redis_client", None), current_generation())
+
+def cancel_task(result, task=None, args=None, kwargs=None):
+    """
+    Revokes a celery task we no longer need, if it is already running it finishes on its own
+
+    Args:
+        result: AsyncResult of the task
+        task (optional): the task, for QueueOnce tasks its lock is released so the same request isn't blocked later. Defaults to None.
+        args (tuple, optional): positional arguments it was called with. Defaults to None.
+        kwargs (dict, optional): keyword arguments it was called with. Defaults to None.
+    """
+
+    try:
+        result.revoke()
+    except:
+        print("REVOKE FAILED")
+
+    # A revoked task never gets to release its once lock
+    try:
+        if task is not None and hasattr(task, "once_backend"):
+            task.once_backend.clear_lock(task.get_key(args, kwargs))
+    except:
+        print("RELEASING ONCE LOCK FAILED")
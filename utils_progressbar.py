@@ -1,6 +1,7 @@
 import os
 import requests
 from download import _usi_to_local_filename
+import lcms_store
 
 def _determine_usi_size(usi):
     try:
@@ -68,13 +69,19 @@ def determine_usi_progress(usis):
                 status_dict[usi]["downloadpercent"] = 0
 
         
-        # checking the feather file
-        local_feather_filename = local_usi_filename + ".ms1.feather"
-        if os.path.exists(local_feather_filename):
+        # checking the store, it is published while the file is being read
+        store_progress = lcms_store.store_progress(local_usi_filename)
+        if store_progress is None:
+            status_dict[usi]["readstatus"] = "pending"
+            status_dict[usi]["readpercent"] = 0
+        elif store_progress >= 1.0:
             status_dict[usi]["readstatus"] = "done"
+            status_dict[usi]["readpercent"] = 100
             full_percent_complete += 20
         else:
-            status_dict[usi]["readstatus"] = "pending"
+            status_dict[usi]["readstatus"] = "reading"
+            status_dict[usi]["readpercent"] = int(store_progress * 100)
+            full_percent_complete += int(store_progress * 20)
 
         status_dict[usi]["completionpercent"] = full_percent_complete
 
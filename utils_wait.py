@@ -0,0 +1,130 @@
+import sys
+import time
+
+# How long a callback waits on each kind of task, the task time limit plus time spent in the queue, all within the gunicorn timeout of 600s
+TASK_WAIT_TIMEOUT_SECONDS = {
+    "download": 540,
+    "lcms_aggregate": 180,
+    "tic": 150,
+    "xic": 240,
+    "featurefinding": 150,
+}
+DEFAULT_TASK_WAIT_TIMEOUT_SECONDS = 300
+
+# Results wake us up right away, this is only how often we look at the deadline and whether the request is still wanted
+WAIT_CHECK_INTERVAL_SECONDS = 0.5
+
+# Only used when we can't subscribe to the result
+FALLBACK_POLL_SECONDS = 0.1
+
+def task_deadline(task_name):
+    return time.time() + TASK_WAIT_TIMEOUT_SECONDS.get(task_name, DEFAULT_TASK_WAIT_TIMEOUT_SECONDS)
+
+def _subscribe_results(results, redis_client):
+    # The redis result backend publishes every state change on the key it stores the result under
+    if redis_client is None or len(results) == 0:
+        return None, {}
+
+    try:
+        channel_positions = {}
+        for position, result in enumerate(results):
+            channel = result.backend.get_key_for_task(result.id)
+            if isinstance(channel, str):
+                channel = channel.encode("utf-8")
+            channel_positions[channel] = position
+
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channel_positions.keys())
+        return pubsub, channel_positions
+    except:
+        print("RESULT SUBSCRIPTION FAILED, POLLING", file=sys.stderr, flush=True)
+        return None, {}
+
+def _close_subscription(pubsub):
+    try:
+        pubsub.close()
+    except:
+        pass
+
+def iterate_results(results, redis_client, task_name, deadline=None, on_check=None, propagate=True):
+    """
+    Yields the results of celery tasks in the order they finish, waking up as soon as each one is published
+
+    Args:
+        results (list): AsyncResult of each task
+        redis_client: redis that holds the celery results, None to poll
+        task_name (str): which kind of task, decides the timeout and is used when reporting it
+        deadline (float, optional): time.time() by which we give up. Defaults to the timeout of task_name from now.
+        on_check (function, optional): called every time we wake up, it can raise to stop waiting. Defaults to None.
+        propagate (bool, optional): re-raise the error of a failed task, otherwise it is yielded as its result. Defaults to True.
+
+    Raises:
+        TimeoutError: some of the tasks didn't finish before the deadline
+
+    Yields:
+        tuple: position of the task in results, and its result
+    """
+
+    start_time = time.time()
+    if deadline is None:
+        deadline = task_deadline(task_name)
+
+    pending_positions = set(range(len(results)))
+    pubsub, channel_positions = _subscribe_results(results, redis_client)
+
+    try:
+        # Everything is checked once after subscribing, so results that landed before we subscribed aren't missed
+        check_positions = sorted(pending_positions)
+
+        while len(pending_positions) > 0:
+            for position in check_positions:
+                if position in pending_positions and results[position].ready():
+                    pending_positions.discard(position)
+                    yield position, results[position].get(propagate=propagate)
+
+            if len(pending_positions) == 0:
+                break
+
+            if on_check is not None:
+                on_check()
+
+            remaining_seconds = deadline - time.time()
+            if remaining_seconds <= 0:
+                print("TASK WAIT TIMEOUT", task_name, "{} of {} tasks pending".format(len(pending_positions), len(results)), "waited {:.1f}s".format(time.time() - start_time), file=sys.stderr, flush=True)
+                raise TimeoutError("{} of {} {} tasks did not finish in time".format(len(pending_positions), len(results), task_name))
+
+            wait_seconds = min(WAIT_CHECK_INTERVAL_SECONDS, remaining_seconds)
+
+            if pubsub is not None:
+                try:
+                    message = pubsub.get_message(timeout=wait_seconds)
+                except:
+                    print("RESULT SUBSCRIPTION LOST, POLLING", file=sys.stderr, flush=True)
+                    _close_subscription(pubsub)
+                    pubsub = None
+                    check_positions = sorted(pending_positions)
+                    continue
+
+                # A message tells us which task to look at, waking up without one we look at all of them in case one was missed
+                if message is not None and message.get("channel") in channel_positions:
+                    check_positions = [channel_positions[message["channel"]]]
+                else:
+                    check_positions = sorted(pending_positions)
+                continue
+
+            time.sleep(min(wait_seconds, FALLBACK_POLL_SECONDS))
+            check_positions = sorted(pending_positions)
+    finally:
+        if pubsub is not None:
+            _close_subscription(pubsub)
+
+def wait_for_result(result, redis_client, task_name, deadline=None, on_check=None):
+    """
+    Waits for a single celery task, see iterate_results
+
+    Returns:
+        the result of the task
+    """
+
+    for position, value in iterate_results([result], redis_client, task_name, deadline=deadline, on_check=on_check):
+        return value
@@ -4,12 +4,20 @@ from collections import defaultdict
 import numpy as np
 import uuid
 import os
+import json
 import shutil
 import glob
 import logging
+import traceback
 
 from utils import _get_scan_polarity, _spectrum_generator
 from utils import MS_precisions
+import lcms_store
+import scan_index
+import ion_index
+
+# Upper rt bound that covers any run, traces in the XIC cache are always over the whole run
+XIC_FULL_RUN_RT = 1000000
 
 def _calculate_upper_lower_tolerance(target_mz, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit):
     if xic_tolerance_unit == "Da":
@@ -35,6 +43,25 @@ def xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, x
     Returns:
         [type]: [description]
     """
+    # The ion index and the store are built by the conversion, so once they are there a failure is worth knowing about
+    fast_xic_files = []
+    if ion_index.ion_index_exists(input_filename):
+        fast_xic_files.append(_xic_file_ion_index)
+    if lcms_store.store_complete(input_filename) and scan_index.scan_index_exists(input_filename):
+        fast_xic_files.append(_xic_file_store)
+
+    for fast_xic_file in fast_xic_files:
+        try:
+            xic_df, ms2_data = fast_xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+            if get_ms2 is False:
+                return xic_df, ms2_data
+
+            # Both report the MS1 spectra of the scan index, so the MS2 scans are placed on the trace without reading the file
+            return xic_df, _xic_ms2_scan_index(input_filename, xic_df, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+        except:
+            print("XIC FAILED", fast_xic_file.__name__, input_filename)
+            traceback.print_exc()
+
     if get_ms2 is False:
         try:
             return _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
@@ -43,6 +70,206 @@ def xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, x
 
     return _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
 
+def _xic_ms2_scan_index(input_filename, xic_df, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
+    """
+        MS2 scans of the target from the precursors in the scan index, each one takes the XIC value of the closest MS1 spectrum before it,
+        xic_df has to hold the MS1 spectra of the scan index within the rt window, in file order
+    """
+
+    ms2_data = {}
+    ms2_data["all_ms2_ms1_int"] = []
+    ms2_data["all_ms2_rt"] = []
+    ms2_data["all_ms2_scan"] = []
+
+    spectra_df = scan_index.query_scans(input_filename, rt_min, rt_max)
+    ms_level = spectra_df["ms_level"].values
+
+    is_ms1 = ms_level == 1
+    if polarity_filter == "Positive":
+        is_ms1 &= spectra_df["polarity"].values == scan_index.POLARITY_POS
+    elif polarity_filter == "Negative":
+        is_ms1 &= spectra_df["polarity"].values == scan_index.POLARITY_NEG
+
+    ms1_positions = np.flatnonzero(is_ms1)
+    if len(ms1_positions) != len(xic_df):
+        raise Exception("XIC does not line up with the scan index")
+
+    # Same as reading the file, markers are only shown for a single target
+    if len(all_xic_values) != 1:
+        return ms2_data
+
+    target_mz = all_xic_values[0]
+    lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+
+    precursor_mz = spectra_df["precursor_mz"].values
+    ms2_positions = np.flatnonzero((ms_level == 2) & (precursor_mz >= lower_tolerance) & (precursor_mz <= upper_tolerance))
+
+    # Closest MS1 before each MS2 scan, scans before the first MS1 in the window get zero
+    preceding_ms1 = np.searchsorted(ms1_positions, ms2_positions, side="right") - 1
+    xic_values = xic_df["XIC {}".format(target_mz[0])].values.astype(np.float64)
+    ms2_ms1_int = np.where(preceding_ms1 >= 0, xic_values[np.maximum(preceding_ms1, 0)] if len(xic_values) > 0 else 0, 0)
+
+    ms2_data["all_ms2_ms1_int"] = [float(value) for value in ms2_ms1_int]
+    ms2_data["all_ms2_rt"] = [float(value) for value in spectra_df["rt"].values[ms2_positions]]
+    ms2_data["all_ms2_scan"] = scan_index.native_ids(spectra_df.iloc[ms2_positions])
+
+    return ms2_data
+
+
+def _get_xic_cache_folder(input_filename):
+    return input_filename + ".xiccache"
+
+def _xic_trace_name(lower_tolerance, upper_tolerance, polarity_filter):
+    # The window is what decides the trace, whatever the target is called and however the tolerance was given
+    return "{}_{:.6f}_{:.6f}".format(polarity_filter, lower_tolerance, upper_tolerance)
+
+def _save_xic_array(cache_folder, name, values):
+    # Written whole and renamed into place, so concurrent readers never see half a trace
+    temp_filename = os.path.join(cache_folder, "{}.{}.tmp.npy".format(name, uuid.uuid4()))
+    np.save(temp_filename, values)
+    os.replace(temp_filename, os.path.join(cache_folder, "{}.npy".format(name)))
+
+def _xic_cache_source(input_filename):
+    # The traces come from the store when it is complete, so a rebuilt or upgraded store makes them stale
+    try:
+        if lcms_store.store_complete(input_filename):
+            return {"build": lcms_store.load_manifest(input_filename).get("build"), "schema_version": lcms_store.STORE_SCHEMA_VERSION}
+    except:
+        pass
+
+    return {"build": None, "schema_version": None}
+
+def _open_xic_cache(input_filename):
+    cache_folder = _get_xic_cache_folder(input_filename)
+    cache_source = _xic_cache_source(input_filename)
+    source_filename = os.path.join(cache_folder, "cache.json")
+
+    try:
+        with open(source_filename) as source_file:
+            saved_source = json.load(source_file)
+    except:
+        saved_source = None
+
+    if saved_source != cache_source:
+        shutil.rmtree(cache_folder, ignore_errors=True)
+        os.makedirs(cache_folder, exist_ok=True)
+
+        temp_filename = "{}.{}.tmp".format(source_filename, uuid.uuid4())
+        with open(temp_filename, "w") as source_file:
+            json.dump(cache_source, source_file)
+        os.replace(temp_filename, source_filename)
+
+    return cache_folder
+
+def _load_xic_array(cache_folder, name):
+    try:
+        return np.load(os.path.join(cache_folder, "{}.npy".format(name)))
+    except:
+        return None
+
+def _xic_full_run(input_filename, target_mz_list, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, polarity_filter):
+    # Named by position, the caller's names might repeat
+    numbered_xic_values = [[str(position), target_mz] for position, target_mz in enumerate(target_mz_list)]
+    xic_df, ms2_data = xic_file(input_filename, numbered_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, 0, XIC_FULL_RUN_RT, polarity_filter)
+
+    all_traces = [xic_df["XIC {}".format(position)].values.astype(np.float64) for position in range(len(target_mz_list))]
+
+    return xic_df["rt"].values.astype(np.float64), all_traces
+
+def xic_file_cached(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=False):
+    """
+    Same as xic_file, but keeps the trace of every mz window over the whole run, so a request only computes the
+    targets that have never been asked for and other rt windows are slices of the saved traces
+
+    Returns:
+        tuple: xic_df with an rt column and an XIC column per target, and the ms2 data
+    """
+
+    if len(all_xic_values) == 0:
+        return xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+
+    cache_folder = _open_xic_cache(input_filename)
+
+    all_trace_names = []
+    window_target_mz = {}
+    for target_mz in all_xic_values:
+        lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+        trace_name = _xic_trace_name(lower_tolerance, upper_tolerance, polarity_filter)
+        all_trace_names.append(trace_name)
+        window_target_mz[trace_name] = target_mz[1]
+
+    rt_name = "rt_{}".format(polarity_filter)
+    rt_trace = _load_xic_array(cache_folder, rt_name)
+
+    all_traces = {}
+    if rt_trace is not None:
+        for trace_name in window_target_mz:
+            trace = _load_xic_array(cache_folder, trace_name)
+            if trace is not None and len(trace) == len(rt_trace):
+                all_traces[trace_name] = trace
+
+    missing_trace_names = [trace_name for trace_name in window_target_mz if trace_name not in all_traces]
+    if len(missing_trace_names) > 0:
+        full_rt, missing_traces = _xic_full_run(input_filename, [window_target_mz[trace_name] for trace_name in missing_trace_names], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, polarity_filter)
+
+        # The spectra came out differently from the saved ones, e.g. through another extraction path, so we start over with these
+        if rt_trace is not None and (len(rt_trace) != len(full_rt) or not np.allclose(rt_trace, full_rt)):
+            all_traces = {}
+            missing_trace_names = list(window_target_mz.keys())
+            full_rt, missing_traces = _xic_full_run(input_filename, [window_target_mz[trace_name] for trace_name in missing_trace_names], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, polarity_filter)
+            rt_trace = None
+
+            shutil.rmtree(cache_folder, ignore_errors=True)
+            cache_folder = _open_xic_cache(input_filename)
+
+        for trace_name, trace in zip(missing_trace_names, missing_traces):
+            all_traces[trace_name] = trace
+            _save_xic_array(cache_folder, trace_name, trace)
+
+        # Saved last, so traces are never read against the wrong spectra
+        if rt_trace is None:
+            rt_trace = full_rt
+            _save_xic_array(cache_folder, rt_name, rt_trace)
+
+    # Rt windows are slices of the full run
+    rt_mask = (rt_trace >= rt_min) & (rt_trace <= rt_max)
+
+    xic_columns = {}
+    xic_columns["rt"] = rt_trace[rt_mask]
+    for target_mz, trace_name in zip(all_xic_values, all_trace_names):
+        xic_columns["XIC {}".format(target_mz[0])] = all_traces[trace_name][rt_mask]
+
+    xic_df = pd.DataFrame(xic_columns)
+
+    # The MS2 scans come from the scan index, when the traces don't line up with it we read them from the file
+    if get_ms2 is True:
+        try:
+            return xic_df, _xic_ms2_scan_index(input_filename, xic_df, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter)
+        except:
+            return xic_file(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, get_ms2=get_ms2)
+
+    return xic_df, {}
+
+def _sum_peaks_in_windows(peaks, lower_tolerances, upper_tolerances):
+    # All windows at once, the intensity between two binary searches is a difference of cumulative sums
+    if len(peaks) == 0:
+        return np.zeros(len(lower_tolerances))
+
+    peaks_mz = peaks[:, 0]
+    peaks_i = peaks[:, 1]
+
+    if np.any(peaks_mz[1:] < peaks_mz[:-1]):
+        sorted_order = np.argsort(peaks_mz, kind="stable")
+        peaks_mz = peaks_mz[sorted_order]
+        peaks_i = peaks_i[sorted_order]
+
+    cumulative_i = np.concatenate([[0], np.cumsum(peaks_i, dtype=np.float64)])
+
+    # Both ends are inclusive
+    lower_index = np.searchsorted(peaks_mz, lower_tolerances, side="left")
+    upper_index = np.searchsorted(peaks_mz, upper_tolerances, side="right")
+
+    return cumulative_i[upper_index] - cumulative_i[lower_index]
 
 def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
     # Saving out MS2 locations
@@ -50,8 +277,12 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
     all_ms2_rt = []
     all_ms2_scan = []
 
-    # Performing XIC Plot
-    xic_trace = defaultdict(list)
+    # Windows for all targets, so every spectrum is read once however many targets there are
+    target_mz_array = np.array([target_mz[1] for target_mz in all_xic_values], dtype=np.float64)
+    lower_tolerances, upper_tolerances = _calculate_upper_lower_tolerance(target_mz_array, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+
+    # Performing XIC Plot, one row of summed intensities per MS1 spectrum
+    xic_rows = []
     rt_trace = []
     
     sum_i = 0 # Used by MS2 height
@@ -75,20 +306,15 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
                     continue
 
             try:
-                for target_mz in all_xic_values:
-                    lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
-
-                    # Filtering peaks by mz
-                    peaks_full = spec.peaks("raw")
-                    peaks = peaks_full[
-                        np.where(np.logical_and(peaks_full[:, 0] >= lower_tolerance, peaks_full[:, 0] <= upper_tolerance))
-                    ]
-
-                    # summing intensity
-                    sum_i = sum([peak[1] for peak in peaks])
-                    xic_trace[target_mz[0]].append(sum_i)
+                summed_intensities = _sum_peaks_in_windows(spec.peaks("raw"), lower_tolerances, upper_tolerances)
             except:
-                pass
+                summed_intensities = np.zeros(len(all_xic_values))
+
+            xic_rows.append(summed_intensities)
+
+            # summing intensity
+            if len(summed_intensities) > 0:
+                sum_i = summed_intensities[-1]
 
             rt_trace.append(spec.scan_time_in_minutes())
 
@@ -96,11 +322,8 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
         elif spec.ms_level == 2:
             if len(all_xic_values) == 1:
                 try:
-                    target_mz = all_xic_values[0]
-                    lower_tolerance, upper_tolerance = _calculate_upper_lower_tolerance(target_mz[1], xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
-
                     ms2_mz = spec.selected_precursors[0]["mz"]
-                    if ms2_mz < lower_tolerance or ms2_mz > upper_tolerance:
+                    if ms2_mz < lower_tolerances[0] or ms2_mz > upper_tolerances[0]:
                         continue
                     all_ms2_ms1_int.append(float(sum_i))
                     all_ms2_rt.append(float(spec.scan_time_in_minutes()))
@@ -109,24 +332,73 @@ def _xic_file_slow(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolera
                     pass
 
     # Formatting Data Frame
-    xic_df = pd.DataFrame()
-    for target_xic in xic_trace:
-        target_name = "XIC {}".format(target_xic)
-        xic_df[target_name] = xic_trace[target_xic]
-    xic_df["rt"] = rt_trace
+    xic_matrix = np.array(xic_rows, dtype=np.float64).reshape(len(rt_trace), len(all_xic_values))
+
+    xic_columns = {}
+    for target_position, target_mz in enumerate(all_xic_values):
+        target_name = "XIC {}".format(target_mz[0])
+        xic_columns[target_name] = xic_matrix[:, target_position]
+    xic_columns["rt"] = rt_trace
+
+    xic_df = pd.DataFrame(xic_columns)
 
     ms2_data = {}
     ms2_data["all_ms2_ms1_int"] = all_ms2_ms1_int
     ms2_data["all_ms2_rt"] = all_ms2_rt
     ms2_data["all_ms2_scan"] = all_ms2_scan
 
-    
-
     return xic_df, ms2_data
 
+def _xic_file_store(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter):
+    """
+        Reads the XIC out of the RT chunked store, this only touches the chunks inside of the rt window
+    """
+
+    # A store that is still being written would be missing the later spectra
+    if not lcms_store.store_complete(input_filename) or not scan_index.scan_index_exists(input_filename):
+        raise Exception("Store not present")
+
+    # All the MS1 scans, so scans without a matching peak are reported as zero
+    spectra_df = scan_index.query_scans(input_filename, rt_min, rt_max, ms_level=1, polarity_filter=polarity_filter)
+
+    # All the targets together, the store is mz sorted within each chunk so every target is a handful of slices
+    target_mz_array = np.array([target_mz[1] for target_mz in all_xic_values], dtype=np.float64)
+    lower_tolerances, upper_tolerances = _calculate_upper_lower_tolerance(target_mz_array, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+
+    xic_matrix = lcms_store.query_ms1_windows(input_filename, rt_min, rt_max, lower_tolerances, upper_tolerances, spectra_df["ms1_index"].values)
+
+    xic_columns = {}
+    xic_columns["rt"] = spectra_df["rt"].values
+    for target_position, target_mz in enumerate(all_xic_values):
+        xic_columns["XIC {}".format(target_mz[0])] = xic_matrix[:, target_position]
+
+    return pd.DataFrame(xic_columns), {}
+
+def _xic_file_ion_index(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, array_loader=ion_index._load_npy_arrays):
+    """
+        Reads the XIC out of the mz sorted ion index, which is built by the conversion, array_loader is passed on to ion_index.query_ion_index
+    """
+
+    if not ion_index.ion_index_exists(input_filename):
+        raise Exception("Ion index not present")
+
+    target_mz_array = np.array([target_mz[1] for target_mz in all_xic_values], dtype=np.float64)
+    lower_tolerances, upper_tolerances = _calculate_upper_lower_tolerance(target_mz_array, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit)
+
+    spectra_rt, xic_matrix = ion_index.query_ion_index(input_filename, rt_min, rt_max, lower_tolerances, upper_tolerances, polarity_filter=polarity_filter, array_loader=array_loader)
+
+    xic_columns = {}
+    xic_columns["rt"] = spectra_rt
+    for target_position, target_mz in enumerate(all_xic_values):
+        xic_columns["XIC {}".format(target_mz[0])] = xic_matrix[:, target_position]
+
+    return pd.DataFrame(xic_columns), {}
+
 def _xic_file_fast(input_filename, all_xic_values, xic_tolerance, xic_ppm_tolerance, xic_tolerance_unit, rt_min, rt_max, polarity_filter, temp_folder="temp"):
     """
         xic values are tuples where the first value is the string and the second is the value
+
+        Runs msaccess once per target, only used for files that don't have a complete store yet
     """
 
     xic_df = pd.DataFrame()